@@ -0,0 +1,139 @@
+"""Successive halving search for the most cost efficient run settings.
+
+A config to tune lists candidate values under 'tune', for example:
+
+  tune:
+    ps_servers: [2, 4, 8]
+    ps_server: [cpu, gpu]
+    variable_update: [parameter_server, distributed_replicated]
+    batch_size: [32, 64]
+
+Every candidate first runs a few batches; only the best 1/eta of them run
+again with eta times more batches, until one is left.
+"""
+import math
+
+import cluster_partition
+import command_builder
+
+# Fields BuildDistributedCommandWorker/BuildDistributedCommandPS understand
+# that can be tuned.
+TUNABLE_FIELDS = ('ps_servers', 'ps_server', 'variable_update', 'staged_vars',
+                  'batch_size', 'num_intra_threads', 'num_inter_threads')
+
+# On demand USD per hour in us-east-1, override with 'instance_price'.
+HOURLY_PRICE = {
+    'p2.xlarge': 0.90,
+    'p2.8xlarge': 7.20,
+    'p2.16xlarge': 14.40,
+    'p3.2xlarge': 3.06,
+    'p3.8xlarge': 12.24,
+    'p3.16xlarge': 24.48,
+}
+
+
+def _HourlyPrice(run_config):
+  price = run_config.get('instance_price')
+  if price is None:
+    price = HOURLY_PRICE.get(run_config.get('instance_type'))
+  return price
+
+
+def ImagesPerDollar(run_config, images_per_sec):
+  """Returns images processed per USD of instance time.
+
+  returns None if the instance type has no HOURLY_PRICE and the config sets
+  no 'instance_price'.
+
+  """
+  price = _HourlyPrice(run_config)
+  if price is None:
+    return None
+  hosts = cluster_partition.InstancesNeeded(run_config)
+  return images_per_sec * 3600 / (hosts * float(price))
+
+
+def Candidates(run_config):
+  """Returns one run config per combination of the values under 'tune'.
+
+  Only the fields under 'tune' vary. The model is pinned to 'model', or the
+  first of 'models', and the other sweeps of the config are left out.
+
+  """
+  tune = run_config['tune']
+  unknown = set(tune) - set(TUNABLE_FIELDS)
+  if unknown:
+    raise ValueError('Fields cannot be tuned: {}'.format(sorted(unknown)))
+  base = {}
+  dropped = []
+  for k, v in run_config.items():
+    if k in ('tune', 'repeat', 'repeat_ci_width', 'models'):
+      continue
+    if isinstance(v, list):
+      dropped.append(k)
+      continue
+    base[k] = v
+  if 'model' not in base:
+    if not run_config.get('models'):
+      raise ValueError('Config to tune has no model: {}'.format(
+          run_config.get('name')))
+    base['model'] = run_config['models'][0]
+  dropped = sorted(set(dropped) - set(tune))
+  if dropped:
+    print('Tuning {} without the sweeps over {}'.format(base['model'], dropped))
+  for field, values in tune.items():
+    base[field] = list(values)
+  return list(
+      command_builder.LoadYamlRunConfig({
+          'run_configs': [base]
+      }, 0, order_by_topology=False))
+
+
+def Tune(run_config, run_fn, eta=3, min_batches=20, max_batches=None):
+  """Finds the candidate with the most images per dollar.
+
+  Candidates are ranked by images/sec instead if the instance type has no
+  price, see ImagesPerDollar.
+
+  Args:
+    run_config: config with a 'tune' section, see the module docstring.
+    run_fn: function running a config and returning its images/sec, or None
+      if the run failed.
+    eta: factor by which candidates are cut and num_batches grows per rung.
+    min_batches: num_batches of the first rung.
+    max_batches: num_batches cap, defaults to the config's num_batches.
+
+  returns (best run config, list of (num_batches, run config, score)).
+
+  """
+  max_batches = max_batches or int(run_config.get('num_batches', 100))
+  candidates = Candidates(run_config)
+  priced = _HourlyPrice(run_config) is not None
+  unit = 'images/$' if priced else 'images/sec'
+  if not priced:
+    print('No price for instance type {}, ranking by images/sec'.format(
+        run_config.get('instance_type')))
+  history = []
+  num_batches = min_batches
+  while True:
+    scored = []
+    for candidate in candidates:
+      candidate = candidate.copy()
+      candidate['num_batches'] = num_batches
+      images_per_sec = run_fn(candidate)
+      if not images_per_sec:
+        score = float('-inf')
+      elif priced:
+        score = ImagesPerDollar(candidate, images_per_sec)
+      else:
+        score = images_per_sec
+      history.append((num_batches, candidate, score))
+      scored.append((score, candidate))
+    scored.sort(key=lambda s: s[0], reverse=True)
+    print('Rung with {} batches: best {:.0f} {} of {} candidates'.format(
+        num_batches, scored[0][0], unit, len(scored)))
+    if len(scored) == 1 or num_batches >= max_batches:
+      return scored[0][1], history
+    keep = int(math.ceil(len(scored) / float(eta)))
+    candidates = [candidate for _, candidate in scored[:keep]]
+    num_batches = min(num_batches * eta, max_batches)
@@ -0,0 +1,178 @@
+"""Runs commands on many hosts from one thread with a select() loop.
+
+util.ExecuteCommandInThread uses one thread per command plus one per output
+stream, so a 32 worker + 32 ps launch blocks ~200 threads in paramiko reads.
+Paramiko channels are selectable, so ChannelExecutor multiplexes all of them
+in the calling thread instead, with the same contract as the util functions:
+output is streamed to a log file and a line extractor, and a task succeeds
+when its exit status is in ok_exit_status.
+"""
+import select
+
+import log_sink
+
+
+class Task(object):
+  """A command to run on an ssh client.
+
+  Args:
+    ssh_client: connected paramiko SSHClient.
+    command: command to run.
+    stdout_file: local file the output is written to.
+    line_extractor: method called with each line of output.
+    ok_exit_status: exit codes that are not errors.
+    compression: None, 'gzip' or 'zstd' to compress the log file.
+
+  """
+
+  def __init__(self,
+               ssh_client,
+               command,
+               stdout_file=None,
+               line_extractor=None,
+               ok_exit_status=(0,),
+               compression=None):
+    self.ssh_client = ssh_client
+    self.command = command
+    self.stdout_file = stdout_file
+    self.line_extractor = line_extractor
+    self.ok_exit_status = ok_exit_status
+    self.compression = compression
+    self.channel = None
+    self.exit_status = None
+    self.cancelled = False
+    self.eof = False
+    self._sink = None
+    self._partial = b''
+
+  @property
+  def ok(self):
+    return not self.cancelled and self.exit_status in self.ok_exit_status
+
+  def Open(self):
+    """Opens the channel and log file, closing both again if either fails."""
+    try:
+      self.channel = self.ssh_client.get_transport().open_session()
+      # A pty, as in util, makes closing the channel hang up the remote
+      # process.
+      self.channel.get_pty()
+      if self.stdout_file:
+        self._sink = log_sink.LogSink(
+            self.stdout_file, compression=self.compression)
+        self._sink.Write(self.command.encode('utf-8') + b'\n')
+    except:
+      self._Close()
+      raise
+
+  def Start(self):
+    self.channel.exec_command(self.command)
+
+  def _Lines(self, data):
+    if self._sink:
+      self._sink.Write(data)
+    if not self.line_extractor:
+      return
+    lines = (self._partial + data).split(b'\n')
+    self._partial = lines.pop()
+    for line in lines:
+      self.line_extractor(line.decode('utf-8', 'ignore') + u'\n')
+
+  def Read(self):
+    """Reads available output, returns False once the channel hit EOF."""
+    data = self.channel.recv(32768)
+    if data:
+      self._Lines(data)
+      return True
+    self.eof = True
+    return False
+
+  def _Close(self):
+    if self.channel is not None:
+      self.channel.close()
+    if self._sink:
+      self._sink.Close()
+      self._sink = None
+
+  def Finish(self, cancelled=False):
+    self.cancelled = cancelled
+    if self._partial and self.line_extractor:
+      self.line_extractor(self._partial.decode('utf-8', 'ignore'))
+    self._partial = b''
+    if not cancelled:
+      self.exit_status = self.channel.recv_exit_status()
+    self._Close()
+
+
+class ChannelExecutor(object):
+  """Runs Tasks concurrently from the calling thread.
+
+  Args:
+    max_concurrency: maximum tasks running at the same time.
+    poll_interval: seconds select() waits before checking exit statuses.
+
+  """
+
+  def __init__(self, max_concurrency=256, poll_interval=0.5):
+    self.max_concurrency = max_concurrency
+    self.poll_interval = poll_interval
+
+  def _Cancel(self, running):
+    for task in running:
+      task.Finish(cancelled=True)
+    print('Cancelled {} tasks after a failure.'.format(len(running)))
+
+  def Run(self, tasks, barrier=True, fail_fast=True, print_error=True):
+    """Runs tasks and returns True if all of them succeeded.
+
+    Args:
+      tasks: list of Task.
+      barrier: True to open every channel before starting any command, so
+        all ps and worker tasks start together. Requires all tasks to fit in
+        max_concurrency.
+      fail_fast: True to cancel every running task when one fails.
+      print_error: True to print the command of failed tasks.
+
+    """
+    if barrier and len(tasks) > self.max_concurrency:
+      raise ValueError('{} tasks behind a start barrier exceed the limit of {}'
+                       .format(len(tasks), self.max_concurrency))
+    pending = list(tasks)
+    running = []
+    try:
+      while pending or running:
+        starting = pending[:self.max_concurrency - len(running)]
+        pending = pending[len(starting):]
+        for task in starting:
+          task.Open()
+          # Running from here on, so a failure below also closes it.
+          running.append(task)
+        for task in starting:
+          task.Start()
+
+        # A channel at EOF stays readable until it is closed, so waiting on
+        # it would spin until its exit status arrives.
+        readable, _, _ = select.select(
+            [t.channel for t in running if not t.eof], [], [],
+            self.poll_interval)
+        finished = []
+        for task in running:
+          if task.channel in readable and task.Read():
+            continue
+          if task.channel.exit_status_ready() and not task.channel.recv_ready():
+            finished.append(task)
+        for task in finished:
+          running.remove(task)
+          task.Finish()
+          if not task.ok:
+            if print_error:
+              print('Command execution failed! Exit Status({}):{}'.format(
+                  task.exit_status, task.command))
+            if fail_fast:
+              self._Cancel(running)
+              for t in pending:
+                t.cancelled = True
+              return False
+    except:
+      self._Cancel(running)
+      raise
+    return all(task.ok for task in tasks)
@@ -0,0 +1,179 @@
+"""Tests ChannelExecutor against an in-process paramiko ssh server.
+
+Run from benchmark/runner with:
+
+  python -m unittest discover -p '*_test.py'
+"""
+import os
+import select
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+import paramiko
+
+import channel_executor
+
+
+class _Server(paramiko.ServerInterface):
+  """Accepts any password and runs exec requests with sh.
+
+  The exit status is sent status_delay seconds after the end of the output,
+  like a process that closes its output before it exits.
+
+  """
+
+  def __init__(self, status_delay):
+    self.status_delay = status_delay
+
+  def get_allowed_auths(self, username):
+    return 'password'
+
+  def check_auth_password(self, username, password):
+    return paramiko.AUTH_SUCCESSFUL
+
+  def check_channel_request(self, kind, chanid):
+    if kind == 'session':
+      return paramiko.OPEN_SUCCEEDED
+    return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_REQUEST
+
+  def check_channel_pty_request(self, channel, term, width, height,
+                                pixelwidth, pixelheight, modes):
+    return True
+
+  def check_channel_exec_request(self, channel, command):
+    t = threading.Thread(target=self._Exec, args=(channel, command))
+    t.daemon = True
+    t.start()
+    return True
+
+  def _Exec(self, channel, command):
+    p = subprocess.Popen(
+        command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    channel.sendall(p.communicate()[0])
+    channel.shutdown_write()
+    time.sleep(self.status_delay)
+    channel.send_exit_status(p.returncode)
+    channel.close()
+
+
+class ChannelExecutorTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.host_key = paramiko.RSAKey.generate(1024)
+
+  def setUp(self):
+    self.status_delay = 0.0
+    self.transports = []
+    self.listener = socket.socket()
+    self.listener.bind(('127.0.0.1', 0))
+    self.listener.listen(8)
+    t = threading.Thread(target=self._Accept)
+    t.daemon = True
+    t.start()
+    self.log_dir = tempfile.mkdtemp()
+    self.clients = []
+
+  def tearDown(self):
+    for client in self.clients:
+      client.close()
+    for transport in self.transports:
+      transport.close()
+    self.listener.close()
+    shutil.rmtree(self.log_dir)
+
+  def _Accept(self):
+    while True:
+      try:
+        conn, _ = self.listener.accept()
+      except socket.error:
+        return
+      transport = paramiko.Transport(conn)
+      transport.add_server_key(self.host_key)
+      transport.start_server(server=_Server(self.status_delay))
+      self.transports.append(transport)
+
+  def _Client(self):
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(
+        '127.0.0.1',
+        port=self.listener.getsockname()[1],
+        username='test',
+        password='test',
+        look_for_keys=False,
+        allow_agent=False)
+    self.clients.append(client)
+    return client
+
+  def _Task(self, command, name, lines=None):
+    return channel_executor.Task(
+        self._Client(),
+        command,
+        stdout_file=os.path.join(self.log_dir, name),
+        line_extractor=lines.append if lines is not None else None)
+
+  def testStreamsOutputAndExitStatus(self):
+    lines = []
+    tasks = [
+        self._Task('echo one; echo two', 'a.log', lines),
+        self._Task('echo three', 'b.log'),
+    ]
+
+    self.assertTrue(channel_executor.ChannelExecutor().Run(tasks))
+
+    self.assertEqual([u'one\n', u'two\n'], lines)
+    self.assertEqual([0, 0], [t.exit_status for t in tasks])
+    with open(os.path.join(self.log_dir, 'b.log')) as f:
+      self.assertEqual('echo three\nthree\n', f.read())
+
+  def testFailFastCancelsOtherTasks(self):
+    tasks = [self._Task('exit 3', 'a.log'), self._Task('sleep 5', 'b.log')]
+
+    start = time.time()
+    self.assertFalse(
+        channel_executor.ChannelExecutor().Run(tasks, print_error=False))
+
+    self.assertLess(time.time() - start, 4)
+    self.assertEqual(3, tasks[0].exit_status)
+    self.assertTrue(tasks[1].cancelled)
+
+  def testDoesNotSpinBetweenEofAndExitStatus(self):
+    self.status_delay = 1.0
+    task = self._Task('echo done', 'a.log')
+    calls = []
+    original = select.select
+
+    def CountingSelect(*args):
+      calls.append(args)
+      return original(*args)
+
+    channel_executor.select.select = CountingSelect
+    try:
+      self.assertTrue(
+          channel_executor.ChannelExecutor(poll_interval=0.2).Run([task]))
+    finally:
+      channel_executor.select.select = original
+    # About status_delay / poll_interval waits, not thousands of polls.
+    self.assertLess(len(calls), 20)
+
+  def testOpenFailureClosesOpenedTasks(self):
+    opened = self._Task('echo never', 'a.log')
+    broken = self._Task('echo never', 'b.log')
+    broken.ssh_client.close()
+
+    with self.assertRaises(Exception):
+      channel_executor.ChannelExecutor().Run([opened, broken])
+
+    self.assertTrue(opened.channel.closed)
+    self.assertIsNone(opened._sink)
+    self.assertIsNone(broken.channel)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,8 +1,50 @@
 import boto3
+import calendar
+import functools
 import os
+import ssh_pool
+import threading
 import time
+import tracing
 import util
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+# describe_instance_status accepts at most 100 explicit instance ids per call.
+_MAX_DESCRIBE_IDS = 100
+
+# Tags of warm pool instances, see WarmPool.
+POOL_TAG = 'tf-tools:pool'
+IDLE_SINCE_TAG = 'tf-tools:idle-since'
+
+
+class Backoff(object):
+  """Adaptive delay between polls of the EC2 API.
+
+  The delay starts at `initial` seconds and grows by `factor` on every call to
+  Next() until it reaches `maximum`. Reset() is called whenever a poll makes
+  progress so the next poll happens quickly again.
+
+  """
+
+  def __init__(self, initial=5, maximum=30, factor=1.5):
+    self.initial = initial
+    self.maximum = maximum
+    self.factor = factor
+    self.delay = initial
+
+  def Next(self):
+    delay = self.delay
+    self.delay = min(self.delay * self.factor, self.maximum)
+    return delay
+
+  def Reset(self):
+    self.delay = self.initial
+
+
+def _Chunks(items, size):
+  for i in range(0, len(items), size):
+    yield items[i:i + size]
 
 
 class AWSInstance(object):
@@ -12,61 +54,68 @@ class AWSInstance(object):
     self.aws_instance = instance
     self.ssh_key = ssh_key
     self.username = username
+    self.hostname = None
+    # Set once the instance passes both EC2 status checks.
+    self.ready = threading.Event()
+    # Set for hosts found unhealthy, see straggler.Quarantine.
+    self.quarantined = False
     if name:
       self.SetNameTag(name)
     self.opened_ssh_client = []
+    self._ssh_pool = None
+    self._ssh_pool_lock = threading.Lock()
 
   def __del__(self):
     self.CleanSshClient()
 
-  def WaitUntilReady(self):
-    self.aws_instance.wait_until_running()
-    # Sometimes the wait doesn't work, wait longer and check status
-    client = boto3.client('ec2')
-    while True:
-      res = client.describe_instance_status(
-          InstanceIds=[self.aws_instance.instance_id])
-      try:
-        if (res['InstanceStatuses'][0]['InstanceStatus']['Status'] == 'ok' and
-            res['InstanceStatuses'][0]['SystemStatus']['Status'] == 'ok'):
-          break
-      except:
-        print('instance has no status')
-      time.sleep(30)
+  def WaitUntilReady(self, client=None):
+    for _ in WaitForInstancesReady([self], client=client):
+      pass
 
-    self.aws_instance.load()
-    self.hostname = self.aws_instance.public_dns_name
+  def MarkReady(self, hostname):
+    """Records the public hostname and flags the instance as usable."""
+    self.hostname = hostname
+    self.ready.set()
 
   def CreateSshClient(self):
     assert self.hostname is not None
-    ssh_client = util.SshToHost(self.hostname, ssh_key=self.ssh_key, username=self.username)
+    ssh_client = util.SshToHost(self.hostname, ssh_key=self.ssh_key,
+                                username=self.username,
+                                instance_id=self.instance_id)
     self.opened_ssh_client.append(ssh_client)
     return ssh_client
 
-  def reuse_ssh_client(self):
+  def SshPool(self):
+    """Returns the connection pool shared by all commands on this host."""
     assert self.hostname is not None
-    if not hasattr(self, 'ssh_client') or self.ssh_client == None:
-      self.ssh_client = util.SshToHost(self.hostname, ssh_key=self.ssh_key, username=self.username)
-    return self.ssh_client
+    with self._ssh_pool_lock:
+      if self._ssh_pool is None:
+        self._ssh_pool = ssh_pool.SshConnectionPool(
+            self.hostname, ssh_key=self.ssh_key, username=self.username,
+            instance_id=self.instance_id)
+      return self._ssh_pool
+
+  def reuse_ssh_client(self):
+    return self.SshPool().Primary()
 
   def CleanSshClient(self):
-    if hasattr(self, 'ssh_client'):
-      self.opened_ssh_client.append(self.ssh_client)
-    for ssh_client in self.opened_ssh_client:
+    for ssh_client in getattr(self, 'opened_ssh_client', []):
       try:
         ssh_client.close()
       except:
         pass
     self.opened_ssh_client = []
-    self.ssh_client = None
+    if getattr(self, '_ssh_pool', None) is not None:
+      self._ssh_pool.Close()
+      self._ssh_pool = None
 
   @property
   def state(self):
     return self.aws_instance.state.get('Name', None)
 
-  def SetNameTag(self, name='tf'):
-    ec2 = boto3.resource('ec2')
-    self.tag = ec2.create_tags(
+  def SetNameTag(self, name='tf', client=None):
+    client = client or boto3.client('ec2')
+    self.tag = client.create_tags(
         Resources=[self.aws_instance.id], Tags=[{
             'Key': 'Name',
             'Value': name
@@ -76,16 +125,20 @@ class AWSInstance(object):
     self.aws_instance.start()
 
   def Stop(self):
-    self.CleanSshClient()
-    self.aws_instance.stop()
+    with tracing.Span('teardown', self.instance_id, host=self.hostname,
+                      action='stop'):
+      self.CleanSshClient()
+      self.aws_instance.stop()
 
   def StopAndWaitUntilStopped(self):
     self.Stop()
     self.aws_instance.wait_until_stopped()
 
   def Terminate(self):
-    self.CleanSshClient()
-    self.aws_instance.terminate()
+    with tracing.Span('teardown', self.instance_id, host=self.hostname,
+                      action='terminate'):
+      self.CleanSshClient()
+      self.aws_instance.terminate()
 
   def TerminateAndWaitUntilTerminated(self):
     self.Terminate()
@@ -95,12 +148,18 @@ class AWSInstance(object):
   def instance_id(self):
     return self.aws_instance.instance_id
 
+  @property
+  def private_ip(self):
+    return self.aws_instance.private_ip_address
+
   def ExecuteCommandAndWait(self, cmd, print_error=False):
-    util.ExecuteCommandAndWait(
-        self.reuse_ssh_client(), cmd, print_error=print_error)
+    return self.SshPool().Call(
+        functools.partial(
+            util.ExecuteCommandAndWait, command=cmd, print_error=print_error))
 
   def ExecuteCommandAndReturnStdout(self, cmd):
-    return util.ExecuteCommandAndReturnStdout(self.reuse_ssh_client(), cmd)
+    return self.SshPool().Call(
+        functools.partial(util.ExecuteCommandAndReturnStdout, command=cmd))
 
   def ExecuteCommandAndStreamOutput(self, 
                                     cmd,
@@ -108,61 +167,196 @@ class AWSInstance(object):
                                     stderr_file=None,
                                     line_extractor=None,
                                     print_error=False,
-                                    ok_exit_status=[0]):
+                                    ok_exit_status=[0],
+                                    compression=None):
   
-    return util.ExecuteCommandAndStreamOutput(self.reuse_ssh_client(),
-                                              cmd,
-                                              stdout_file=stdout_file,
-                                              stderr_file=stderr_file,
-                                              line_extractor=line_extractor,
-                                              print_error=print_error,
-                                              ok_exit_status=ok_exit_status) 
+    trace = tracing.CommandTrace(self.instance_id, cmd, line_extractor)
+    try:
+      return self.SshPool().Call(
+          functools.partial(
+              util.ExecuteCommandAndStreamOutput,
+              command=cmd,
+              stdout_file=stdout_file,
+              stderr_file=stderr_file,
+              line_extractor=trace,
+              print_error=print_error,
+              ok_exit_status=ok_exit_status,
+              compression=compression))
+    finally:
+      trace.Finish()
 
   def ExecuteCommandInThread(self,
                              command,
                              stdout_file=None,
                              stderr_file=None,
                              line_extractor=None,
-                             print_error=False):
-    ssh_client = self.CreateSshClient()
-    return util.ExecuteCommandInThread(
-        ssh_client,
-        command,
-        stdout_file=stdout_file,
-        stderr_file=stderr_file,
-        line_extractor=line_extractor,
-        print_error=print_error)
-
-  def RetrieveFile(self, remote_file, local_file):
-    sftp_client = self.reuse_ssh_client().open_sftp()
-    sftp_client.get(remote_file, local_file)
-    sftp_client.close()
+                             print_error=False,
+                             compression=None):
+    """Runs command on a channel of the shared connection pool in a thread."""
+    t = threading.Thread(
+        target=self.ExecuteCommandAndStreamOutput,
+        args=(command, stdout_file, stderr_file, line_extractor, print_error),
+        kwargs={'compression': compression})
+    t.start()
+    return t
+
+  def RetrieveFile(self, remote_file, local_file, resume=False):
+    """Copies remote_file to local_file.
+
+    With resume=True an existing local_file is treated as the start of the
+    remote file and only the rest is transferred.
+
+    """
+
+    def Get(ssh_client):
+      sftp_client = ssh_client.open_sftp()
+      try:
+        if not resume or not os.path.exists(local_file):
+          sftp_client.get(remote_file, local_file)
+          return
+        with sftp_client.open(remote_file, 'rb') as src:
+          with open(local_file, 'ab') as dst:
+            src.seek(os.path.getsize(local_file))
+            src.prefetch()
+            for chunk in iter(lambda: src.read(1 << 20), b''):
+              dst.write(chunk)
+      finally:
+        sftp_client.close()
+
+    with tracing.Span('retrieve', self.instance_id, file=remote_file):
+      self.SshPool().Call(Get)
 
   def UploadFile(self, local_file, remote_file):
-    sftp_client = self.reuse_ssh_client().open_sftp()
-    sftp_client.put(local_file, remote_file)
-    sftp_client.close()
 
-
-def MaybeCreatePlacementGroup(name='tf_bm'):
-  client = boto3.client('ec2')
+    def Put(ssh_client):
+      sftp_client = ssh_client.open_sftp()
+      try:
+        sftp_client.put(local_file, remote_file)
+      finally:
+        sftp_client.close()
+
+    with tracing.Span('upload', self.instance_id, file=remote_file):
+      self.SshPool().Call(Put)
+
+
+# Instance states from which an instance never becomes ready.
+_TERMINAL_STATES = ('shutting-down', 'terminated', 'stopping', 'stopped')
+
+
+def WaitForInstancesReady(instances,
+                          client=None,
+                          initial_delay=5,
+                          max_delay=30,
+                          timeout=1800,
+                          sleep=time.sleep,
+                          clock=time.time):
+  """Yields instances as soon as each one passes its EC2 status checks.
+
+  The whole fleet is checked with one batched describe_instance_status call
+  per poll instead of one call per instance. The hostnames of the instances
+  that became ready are fetched with a single describe_instances call. The
+  delay between polls backs off while nothing changes and is reset whenever
+  an instance becomes ready.
+
+  Args:
+    instances: list of AWSInstance to wait on.
+    client: boto3 ec2 client, created if not passed. Pass a client wrapped in
+      botocore's Stubber to exercise this offline.
+    initial_delay: seconds to wait after the first poll with no progress.
+    max_delay: upper bound in seconds for the delay between polls.
+    timeout: seconds after which instances that are still not ready fail.
+    sleep: function used to wait between polls.
+    clock: function returning the current time in seconds.
+
+  returns a generator of AWSInstance in the order they became ready.
+
+  raises IOError if an instance is stopped or terminated, e.g. a failed
+  launch or a capacity termination, or is not ready within timeout.
+
+  """
+  client = client or boto3.client('ec2')
+  pending = dict((instance.instance_id, instance) for instance in instances)
+  backoff = Backoff(initial=initial_delay, maximum=max_delay)
+  deadline = clock() + timeout
+  while pending:
+    ready_ids = []
+    for ids in _Chunks(sorted(pending), _MAX_DESCRIBE_IDS):
+      try:
+        res = client.describe_instance_status(
+            InstanceIds=ids, IncludeAllInstances=True)
+      except boto3.exceptions.botocore.exceptions.ClientError as e:
+        # Freshly launched instances are not always visible to the API yet.
+        print('Instance status not available yet:{}'.format(e))
+        continue
+      for status in res.get('InstanceStatuses', []):
+        state = status.get('InstanceState', {}).get('Name')
+        if state in _TERMINAL_STATES:
+          raise IOError('Instance {} is {} instead of starting'.format(
+              status['InstanceId'], state))
+        try:
+          if (state == 'running' and
+              status['InstanceStatus']['Status'] == 'ok' and
+              status['SystemStatus']['Status'] == 'ok'):
+            ready_ids.append(status['InstanceId'])
+        except KeyError:
+          print('instance({}) has no status'.format(status.get('InstanceId')))
+
+    if not ready_ids:
+      remaining = deadline - clock()
+      if remaining <= 0:
+        raise IOError('Instances not ready after {} seconds: {}'.format(
+            timeout, ', '.join(sorted(pending))))
+      sleep(min(backoff.Next(), remaining))
+      continue
+
+    backoff.Reset()
+    res = client.describe_instances(InstanceIds=ready_ids)
+    for reservation in res['Reservations']:
+      for description in reservation['Instances']:
+        instance = pending.pop(description['InstanceId'])
+        instance.MarkReady(description.get('PublicDnsName'))
+        yield instance
+
+
+def _WaitForFleet(instances, on_ready=None, client=None):
+  """Waits for all instances and calls on_ready for each as it is ready."""
+  start = time.time()
+  for instance in WaitForInstancesReady(instances, client=client):
+    tracing.Record('wait_until_ready', start, time.time(),
+                   instance.instance_id, host=instance.hostname)
+    print('Instance({}) ready: {}'.format(instance.instance_id,
+                                          instance.hostname))
+    if on_ready:
+      on_ready(instance)
+  print('All {} instances ready!!!'.format(len(instances)))
+
+
+def MaybeCreatePlacementGroup(name='tf_bm',
+                              client=None,
+                              max_attempts=20,
+                              sleep=time.sleep):
+  """Creates the placement group if needed and waits until it is available.
+
+  returns True if the placement group is available.
+
+  """
+  client = client or boto3.client('ec2')
   try:
     client.describe_placement_groups(GroupNames=[name])
   except boto3.exceptions.botocore.exceptions.ClientError as e:
     res = client.create_placement_group(GroupName=name, Strategy='cluster')
 
-  counter = 0
-  while True:
+  backoff = Backoff(initial=1, maximum=10, factor=2)
+  for _ in range(max_attempts):
     try:
       res = client.describe_placement_groups(GroupNames=[name])
       if res['PlacementGroups'][0]['State'] == 'available':
-        break
-    except:
+        return True
+    except boto3.exceptions.botocore.exceptions.ClientError:
       pass
-    counter = counter + 1
-    if counter >= 10:
-      print('Failed to create placement group %s' % name)
-    time.sleep(10)
+    sleep(backoff.Next())
+  print('Failed to create placement group %s' % name)
+  return False
 
 
 def DeletePlacementGroup(name='tf_bm'):
@@ -188,31 +382,42 @@ def CreateAwsInstances(num_instances=1,
                        ssh_key='',
                        instance_tag='tf',
                        security_group='default',
-                       placement_group=''):
-  ec2 = boto3.resource('ec2')
+                       placement_group='',
+                       tags=None,
+                       ec2=None):
+  ec2 = ec2 or boto3.resource('ec2')
+  create_args = dict(
+      ImageId=image_id,
+      InstanceType=instance_type,
+      MinCount=num_instances,
+      MaxCount=num_instances,
+      SecurityGroups=[security_group],
+      KeyName=key_name,
+      # Explicit, since WarmPool.Release relies on a shutdown from inside the
+      # instance stopping it instead of terminating it.
+      InstanceInitiatedShutdownBehavior='stop')
+  launch_tags = [{
+      'Key': k,
+      'Value': v
+  } for k, v in sorted((tags or {}).items())]
+  if instance_tag:
+    launch_tags.append({'Key': 'Name', 'Value': instance_tag})
+  if launch_tags:
+    # Tag at launch instead of one create_tags call per instance.
+    create_args['TagSpecifications'] = [{
+        'ResourceType': 'instance',
+        'Tags': launch_tags
+    }]
   if placement_group:
-    MaybeCreatePlacementGroup(name=placement_group)
-    aws_instances = ec2.create_instances(
-        ImageId=image_id,
-        InstanceType=instance_type,
-        MinCount=num_instances,
-        MaxCount=num_instances,
-        SecurityGroups=[security_group],
-        Placement={'GroupName': placement_group},
-        KeyName=key_name)
-  else:
-    aws_instances = ec2.create_instances(
-        ImageId=image_id,
-        InstanceType=instance_type,
-        MinCount=num_instances,
-        MaxCount=num_instances,
-        SecurityGroups=[security_group],
-        KeyName=key_name)
+    if not MaybeCreatePlacementGroup(
+        name=placement_group, client=ec2.meta.client):
+      raise ValueError(
+          'Placement group {} is not available'.format(placement_group))
+    create_args['Placement'] = {'GroupName': placement_group}
+  aws_instances = ec2.create_instances(**create_args)
   assert len(aws_instances) == num_instances
   print('{} Instances created'.format(len(aws_instances)))
-  instances = [
-      AWSInstance(instance, ssh_key, instance_tag) for instance in aws_instances
-  ]
+  instances = [AWSInstance(instance, ssh_key) for instance in aws_instances]
 
   return instances
 
@@ -221,7 +426,9 @@ def LookupAwsInstances(image_id=None,
                        state=None,
                        instance_tag=None,
                        placement_group=None,
-                       ssh_key=None):
+                       ssh_key=None,
+                       tags=None,
+                       ec2=None):
 
   def FillOneFilter(key, values):
     f = {}
@@ -238,8 +445,10 @@ def LookupAwsInstances(image_id=None,
     filters.append(FillOneFilter('tag:Name', [instance_tag]))
   if placement_group is not None:
     filters.append(FillOneFilter('placement-group-name', [placement_group]))
+  for key, value in sorted((tags or {}).items()):
+    filters.append(FillOneFilter('tag:' + key, [value]))
 
-  ec2 = boto3.resource('ec2')
+  ec2 = ec2 or boto3.resource('ec2')
   instances = ec2.instances.filter(Filters=filters)
 
   return [
@@ -257,7 +466,14 @@ def AwsInstances(num_instances=1,
                  security_group='default',
                  instance_tag='',
                  placement_group='bm_group',
-                 close_behavior=None):
+                 close_behavior=None,
+                 on_ready=None):
+  """Creates instances and yields them once all are ready.
+
+  on_ready, if passed, is called with each instance as soon as that instance
+  is ready so per-host setup can start before the rest of the fleet is up.
+
+  """
   try:
     instances_created = False
     instances = CreateAwsInstances(
@@ -271,11 +487,7 @@ def AwsInstances(num_instances=1,
         placement_group=placement_group)
     instances_created = True
 
-    for instance in instances:
-      print('Waiting for instance({}) to be ready.'.format(
-          instance.instance_id))
-      instance.WaitUntilReady()
-    print('All {} instances ready!!!'.format(len(instances)))
+    _WaitForFleet(instances, on_ready=on_ready)
     yield instances
   finally:
     if not instances_created:
@@ -296,7 +508,9 @@ def ReuseAwsInstances(image_id=None,
                       instance_tag=None,
                       placement_group=None,
                       ssh_key=None,
-                      close_behavior=None):
+                      close_behavior=None,
+                      on_ready=None):
+  """Looks up existing instances, starts them and yields them once ready."""
   try:
     instances = LookupAwsInstances(
         image_id=image_id,
@@ -314,11 +528,7 @@ def ReuseAwsInstances(image_id=None,
         print('Current instance({}) state:{}, trying to start.'.format(
             instance.instance_id, instance.state))
         instance.Start()
-    for instance in instances:
-      print('Waiting for instance({}) to be ready.'.format(
-          instance.instance_id))
-      instance.WaitUntilReady()
-    print('All {} instances ready!!!'.format(len(instances)))
+    _WaitForFleet(instances, on_ready=on_ready)
     yield instances
   finally:
     if close_behavior is not None:
@@ -329,3 +539,191 @@ def ReuseAwsInstances(image_id=None,
           instance.Stop()
       if placement_group and close_behavior == 'terminate':
         DeletePlacementGroup(placement_group)
+
+
+class WarmPool(object):
+  """Instances kept stopped between sweeps instead of terminated.
+
+  Pool members carry the POOL_TAG tag with the pool name. Resize hands out
+  running members first, then starts stopped ones and only launches new
+  instances for the rest, which skips the cold launch and driver init of
+  most sweeps. Members idle for longer than idle_ttl are stopped by a
+  shutdown timer scheduled on the host at release, or by Reap from cron.
+
+  Args:
+    name: pool name, members are tagged with it.
+    image_id, instance_type, key_name, ssh_key, security_group,
+      placement_group: used to launch members, as in CreateAwsInstances.
+    idle_ttl: seconds a released instance keeps running before it stops.
+    max_lease: seconds after which an instance that was never released, e.g.
+      because the runner crashed, counts as idle.
+    ec2: boto3 ec2 resource, created if not passed. Wrap ec2.meta.client in
+      botocore's Stubber to exercise the pool offline.
+    clock: function returning the current time in seconds.
+
+  """
+
+  # Members in a state that can be handed out, in order of preference.
+  _STATE_ORDER = {'running': 0, 'pending': 1, 'stopped': 2, 'stopping': 3}
+
+  def __init__(self,
+               name,
+               image_id='',
+               instance_type='',
+               key_name='',
+               ssh_key='',
+               security_group='default',
+               placement_group='',
+               idle_ttl=3600,
+               max_lease=24 * 3600,
+               ec2=None,
+               clock=time.time):
+    self.name = name
+    self.image_id = image_id
+    self.instance_type = instance_type
+    self.key_name = key_name
+    self.ssh_key = ssh_key
+    self.security_group = security_group
+    self.placement_group = placement_group
+    self.idle_ttl = idle_ttl
+    self.max_lease = max_lease
+    self.ec2 = ec2 or boto3.resource('ec2')
+    self.client = self.ec2.meta.client
+    self.clock = clock
+
+  def Members(self):
+    """Returns the pool instances that are not terminated or terminating."""
+    return [
+        instance
+        for instance in LookupAwsInstances(
+            tags={POOL_TAG: self.name}, ssh_key=self.ssh_key, ec2=self.ec2)
+        if instance.state in self._STATE_ORDER
+    ]
+
+  def _TagIdleSince(self, instances, idle_since):
+    if instances:
+      self.client.create_tags(
+          Resources=[instance.instance_id for instance in instances],
+          Tags=[{
+              'Key': IDLE_SINCE_TAG,
+              'Value': str(int(idle_since))
+          }])
+
+  def IdleSince(self, instance):
+    """Returns when instance was released, its launch time if never used."""
+    for tag in instance.aws_instance.tags or []:
+      if tag['Key'] == IDLE_SINCE_TAG:
+        return int(tag['Value'])
+    return calendar.timegm(instance.aws_instance.launch_time.utctimetuple())
+
+  def Resize(self, num_instances):
+    """Returns num_instances pool members, starting or launching as needed.
+
+    Running members beyond num_instances are stopped so they stay warm
+    without being billed for compute. Members leased by another runner, whose
+    idle-since lies in the future, are neither handed out nor stopped.
+
+    """
+    now = self.clock()
+    members = sorted(
+        [i for i in self.Members() if self.IdleSince(i) <= now],
+        key=lambda i: (self._STATE_ORDER[i.state], i.instance_id))
+    selected, surplus = members[:num_instances], members[num_instances:]
+
+    stopping = [i.instance_id for i in selected if i.state == 'stopping']
+    if stopping:
+      # A stopping instance cannot be started until it has stopped.
+      self.client.get_waiter('instance_stopped').wait(InstanceIds=stopping)
+    to_start = [
+        i.instance_id for i in selected if i.state in ('stopped', 'stopping')
+    ]
+    if to_start:
+      print('Starting {} warm instances of pool {}'.format(
+          len(to_start), self.name))
+      self.client.start_instances(InstanceIds=to_start)
+
+    missing = num_instances - len(selected)
+    if missing > 0:
+      print('Launching {} instances into pool {}'.format(missing, self.name))
+      selected += CreateAwsInstances(
+          num_instances=missing,
+          image_id=self.image_id,
+          instance_type=self.instance_type,
+          key_name=self.key_name,
+          ssh_key=self.ssh_key,
+          instance_tag=self.name,
+          security_group=self.security_group,
+          placement_group=self.placement_group,
+          tags={POOL_TAG: self.name},
+          ec2=self.ec2)
+
+    to_stop = [
+        i.instance_id for i in surplus if i.state in ('running', 'pending')
+    ]
+    if to_stop:
+      print('Stopping {} surplus instances of pool {}'.format(
+          len(to_stop), self.name))
+      self.client.stop_instances(InstanceIds=to_stop)
+
+    # Leased until released, or until max_lease if the runner dies first.
+    self._TagIdleSince(selected, self.clock() + self.max_lease)
+    return selected
+
+  def Release(self, instances):
+    """Marks instances idle and schedules them to stop after idle_ttl."""
+    self._TagIdleSince(instances, self.clock())
+    reachable = [i for i in instances if i.hostname is not None]
+    if not reachable:
+      return
+    # Members are launched to stop, not terminate, when shut down inside.
+    cmd = 'sudo shutdown -h +{}'.format(max(1, int(self.idle_ttl // 60)))
+    pool = ThreadPool(min(len(reachable), 16))
+    try:
+      pool.map(lambda i: i.ExecuteCommandAndWait(cmd, print_error=True),
+               reachable)
+    finally:
+      pool.close()
+    for instance in instances:
+      instance.CleanSshClient()
+
+  def Reap(self):
+    """Stops running members idle for longer than idle_ttl.
+
+    returns the ids of the stopped instances.
+
+    """
+    now = self.clock()
+    idle = [
+        instance.instance_id
+        for instance in self.Members()
+        if instance.state in ('running', 'pending') and
+        now - self.IdleSince(instance) > self.idle_ttl
+    ]
+    if idle:
+      print('Stopping {} idle instances of pool {}'.format(
+          len(idle), self.name))
+      self.client.stop_instances(InstanceIds=idle)
+    return idle
+
+
+@contextmanager
+def WarmAwsInstances(pool, num_instances=1, on_ready=None):
+  """Yields num_instances ready instances of a WarmPool.
+
+  The instances are released back to the pool afterwards instead of being
+  stopped or terminated.
+
+  """
+
+  def CancelShutdown(instance):
+    # Drops the idle shutdown scheduled when the instance was last released.
+    instance.ExecuteCommandAndWait('sudo shutdown -c || true')
+    if on_ready:
+      on_ready(instance)
+
+  instances = pool.Resize(num_instances)
+  try:
+    _WaitForFleet(instances, on_ready=CancelShutdown, client=pool.client)
+    yield instances
+  finally:
+    pool.Release(instances)
@@ -0,0 +1,325 @@
+"""Offline tests of the EC2 calls in cluster_aws, driven by botocore Stubber.
+
+Run from benchmark/runner with:
+
+  python -m unittest discover -p '*_test.py'
+"""
+import datetime
+import unittest
+
+import boto3
+from botocore.stub import Stubber
+
+import cluster_aws
+
+
+def _Client():
+  return boto3.client(
+      'ec2',
+      region_name='us-east-1',
+      aws_access_key_id='testing',
+      aws_secret_access_key='testing')
+
+
+class _FakeAwsInstance(object):
+
+  def __init__(self, instance_id):
+    self.id = instance_id
+    self.instance_id = instance_id
+
+
+def _Instances(count):
+  return [
+      cluster_aws.AWSInstance(_FakeAwsInstance('i-{:04d}'.format(i)))
+      for i in range(count)
+  ]
+
+
+def _Status(instance_id, state='running', status='ok'):
+  return {
+      'InstanceId': instance_id,
+      'InstanceState': {'Code': 16, 'Name': state},
+      'InstanceStatus': {'Status': status},
+      'SystemStatus': {'Status': status},
+  }
+
+
+def _Described(instance_ids):
+  return {
+      'Reservations': [{
+          'Instances': [{
+              'InstanceId': i,
+              'PublicDnsName': i + '.example.com'
+          } for i in instance_ids]
+      }]
+  }
+
+
+class WaitForInstancesReadyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.client = _Client()
+    self.stubber = Stubber(self.client)
+    self.sleeps = []
+
+  def _ExpectStatus(self, instance_ids, statuses):
+    self.stubber.add_response(
+        'describe_instance_status', {'InstanceStatuses': statuses}, {
+            'InstanceIds': instance_ids,
+            'IncludeAllInstances': True
+        })
+
+  def _Wait(self, instances):
+    with self.stubber:
+      ready = list(
+          cluster_aws.WaitForInstancesReady(
+              instances,
+              client=self.client,
+              initial_delay=5,
+              max_delay=10,
+              sleep=self.sleeps.append))
+      self.stubber.assert_no_pending_responses()
+    return ready
+
+  def testYieldsInstancesAsTheyBecomeReadyWithBackoff(self):
+    instances = _Instances(3)
+    ids = [i.instance_id for i in instances]
+    pending = [_Status(i, state='pending', status='initializing') for i in ids]
+    self._ExpectStatus(ids, pending)
+    self._ExpectStatus(ids, pending)
+    self._ExpectStatus(ids, pending)
+    self._ExpectStatus(ids, [_Status(ids[1])] + pending[::2])
+    self.stubber.add_response('describe_instances', _Described([ids[1]]),
+                              {'InstanceIds': [ids[1]]})
+    self._ExpectStatus([ids[0], ids[2]], pending[::2])
+    self._ExpectStatus([ids[0], ids[2]], [_Status(ids[0]), _Status(ids[2])])
+    self.stubber.add_response('describe_instances',
+                              _Described([ids[0], ids[2]]),
+                              {'InstanceIds': [ids[0], ids[2]]})
+
+    ready = self._Wait(instances)
+
+    self.assertEqual([ids[1], ids[0], ids[2]], [i.instance_id for i in ready])
+    self.assertEqual(ids[1] + '.example.com', instances[1].hostname)
+    self.assertTrue(all(i.ready.is_set() for i in instances))
+    # Grows by 1.5x up to max_delay and starts over after progress.
+    self.assertEqual([5, 7.5, 10, 5], self.sleeps)
+
+  def testBatchesDescribeCallsOverOneHundredIds(self):
+    instances = _Instances(150)
+    ids = [i.instance_id for i in instances]
+    self._ExpectStatus(ids[:100], [_Status(i) for i in ids[:100]])
+    self._ExpectStatus(ids[100:], [_Status(i) for i in ids[100:]])
+    self.stubber.add_response('describe_instances', _Described(ids),
+                              {'InstanceIds': ids})
+
+    ready = self._Wait(instances)
+
+    self.assertEqual(150, len(ready))
+    self.assertEqual([], self.sleeps)
+
+  def testRaisesWhenAnInstanceTerminates(self):
+    instances = _Instances(2)
+    ids = [i.instance_id for i in instances]
+    self._ExpectStatus(ids, [
+        _Status(ids[0], state='pending', status='initializing'),
+        _Status(ids[1], state='terminated', status='not-applicable')
+    ])
+    with self.assertRaises(IOError):
+      self._Wait(instances)
+
+  def testRaisesAfterTimeout(self):
+    instances = _Instances(1)
+    ids = [instances[0].instance_id]
+    pending = [_Status(ids[0], state='pending', status='initializing')]
+    for _ in range(3):
+      self._ExpectStatus(ids, pending)
+    now = [0]
+
+    def Sleep(seconds):
+      self.sleeps.append(seconds)
+      now[0] += seconds
+
+    with self.stubber:
+      with self.assertRaises(IOError):
+        list(
+            cluster_aws.WaitForInstancesReady(
+                instances,
+                client=self.client,
+                initial_delay=5,
+                max_delay=10,
+                timeout=12,
+                sleep=Sleep,
+                clock=lambda: now[0]))
+      self.stubber.assert_no_pending_responses()
+    # The last wait is cut short by the deadline.
+    self.assertEqual([5, 7], self.sleeps)
+
+
+class PlacementGroupTest(unittest.TestCase):
+
+  def setUp(self):
+    self.client = _Client()
+    self.stubber = Stubber(self.client)
+    self.sleeps = []
+
+  def _ExpectState(self, state):
+    self.stubber.add_response('describe_placement_groups', {
+        'PlacementGroups': [{
+            'GroupName': 'bm',
+            'State': state,
+            'Strategy': 'cluster'
+        }]
+    }, {'GroupNames': ['bm']})
+
+  def testCreatesGroupAndWaitsUntilAvailable(self):
+    self.stubber.add_client_error(
+        'describe_placement_groups',
+        service_error_code='InvalidPlacementGroup.Unknown',
+        expected_params={'GroupNames': ['bm']})
+    self.stubber.add_response('create_placement_group', {}, {
+        'GroupName': 'bm',
+        'Strategy': 'cluster'
+    })
+    self._ExpectState('pending')
+    self._ExpectState('available')
+    with self.stubber:
+      self.assertTrue(
+          cluster_aws.MaybeCreatePlacementGroup(
+              'bm', client=self.client, sleep=self.sleeps.append))
+      self.stubber.assert_no_pending_responses()
+    self.assertEqual([1], self.sleeps)
+
+  def testGivesUpAfterMaxAttempts(self):
+    for _ in range(4):
+      self._ExpectState('pending')
+    with self.stubber:
+      self.assertFalse(
+          cluster_aws.MaybeCreatePlacementGroup(
+              'bm',
+              client=self.client,
+              max_attempts=3,
+              sleep=self.sleeps.append))
+      self.stubber.assert_no_pending_responses()
+    self.assertEqual([1, 2, 4], self.sleeps)
+
+  def testCreateAwsInstancesRaisesWithoutPlacementGroup(self):
+    ec2 = boto3.resource(
+        'ec2',
+        region_name='us-east-1',
+        aws_access_key_id='testing',
+        aws_secret_access_key='testing')
+    original = cluster_aws.MaybeCreatePlacementGroup
+    cluster_aws.MaybeCreatePlacementGroup = lambda name, client: False
+    try:
+      # No run_instances response is stubbed, so launching would fail too.
+      with Stubber(ec2.meta.client):
+        with self.assertRaises(ValueError):
+          cluster_aws.CreateAwsInstances(
+              image_id='ami-1', placement_group='bm', ec2=ec2)
+    finally:
+      cluster_aws.MaybeCreatePlacementGroup = original
+
+
+class WarmPoolTest(unittest.TestCase):
+
+  NOW = 1500000000
+
+  def setUp(self):
+    self.ec2 = boto3.resource(
+        'ec2',
+        region_name='us-east-1',
+        aws_access_key_id='testing',
+        aws_secret_access_key='testing')
+    self.stubber = Stubber(self.ec2.meta.client)
+    self.pool = cluster_aws.WarmPool(
+        'bm', max_lease=100, ec2=self.ec2, clock=lambda: self.NOW)
+
+  def _ExpectMembers(self, members):
+    instances = []
+    for instance_id, state, idle_since in members:
+      instances.append({
+          'InstanceId': instance_id,
+          'State': {'Code': 16, 'Name': state},
+          'LaunchTime': datetime.datetime(2017, 1, 1),
+          'Tags': [{'Key': cluster_aws.POOL_TAG, 'Value': 'bm'},
+                   {'Key': cluster_aws.IDLE_SINCE_TAG,
+                    'Value': str(idle_since)}],
+      })
+    self.stubber.add_response(
+        'describe_instances', {'Reservations': [{'Instances': instances}]},
+        {'Filters': [{'Name': 'tag:' + cluster_aws.POOL_TAG,
+                      'Values': ['bm']}]})
+
+  def _ExpectLease(self, instance_ids):
+    self.stubber.add_response('create_tags', {}, {
+        'Resources': instance_ids,
+        'Tags': [{'Key': cluster_aws.IDLE_SINCE_TAG,
+                  'Value': str(self.NOW + 100)}]
+    })
+
+  def testResizeSkipsMembersLeasedByAnotherRunner(self):
+    self._ExpectMembers([
+        ('i-leased', 'running', self.NOW + 50),
+        ('i-idle', 'running', self.NOW - 10),
+        ('i-surplus', 'running', self.NOW - 20),
+        ('i-stopped', 'stopped', self.NOW - 30),
+    ])
+    # Only the idle surplus is stopped, the leased member keeps running.
+    self.stubber.add_response('stop_instances', {}, {
+        'InstanceIds': ['i-surplus']
+    })
+    self._ExpectLease(['i-idle'])
+
+    with self.stubber:
+      selected = self.pool.Resize(1)
+      self.stubber.assert_no_pending_responses()
+
+    self.assertEqual(['i-idle'], [i.instance_id for i in selected])
+
+  def testResizeStartsStoppedMembersInsteadOfLeasedOnes(self):
+    self._ExpectMembers([
+        ('i-leased', 'running', self.NOW + 50),
+        ('i-stopped', 'stopped', self.NOW - 30),
+    ])
+    self.stubber.add_response('start_instances', {},
+                              {'InstanceIds': ['i-stopped']})
+    self._ExpectLease(['i-stopped'])
+
+    with self.stubber:
+      selected = self.pool.Resize(1)
+      self.stubber.assert_no_pending_responses()
+
+    self.assertEqual(['i-stopped'], [i.instance_id for i in selected])
+
+  def testResizeLaunchesMembersThatStopOnShutdown(self):
+    pool = cluster_aws.WarmPool(
+        'bm', image_id='ami-1', instance_type='p3.2xlarge', key_name='key',
+        max_lease=100, ec2=self.ec2, clock=lambda: self.NOW)
+    self._ExpectMembers([])
+    self.stubber.add_response(
+        'run_instances', {'Instances': [{'InstanceId': 'i-new'}]}, {
+            'ImageId': 'ami-1',
+            'InstanceType': 'p3.2xlarge',
+            'MinCount': 1,
+            'MaxCount': 1,
+            'SecurityGroups': ['default'],
+            'KeyName': 'key',
+            'InstanceInitiatedShutdownBehavior': 'stop',
+            'TagSpecifications': [{
+                'ResourceType': 'instance',
+                'Tags': [{'Key': cluster_aws.POOL_TAG, 'Value': 'bm'},
+                         {'Key': 'Name', 'Value': 'bm'}]
+            }],
+        })
+    self._ExpectLease(['i-new'])
+
+    with self.stubber:
+      selected = pool.Resize(1)
+      self.stubber.assert_no_pending_responses()
+
+    self.assertEqual(['i-new'], [i.instance_id for i in selected])
+
+
+if __name__ == '__main__':
+  unittest.main()
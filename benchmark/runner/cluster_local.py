@@ -0,0 +1,156 @@
+"""Runs the orchestration layer on the local machine instead of EC2.
+
+LocalInstance has the interface of cluster_aws.AWSInstance but runs commands
+as local subprocesses, so PS/worker topologies built with command_builder and
+cluster_partition can run on localhost, e.g. on a large multi-GPU box or to
+measure the runner's own overhead without cloud costs.
+"""
+import getpass
+import os
+import shutil
+import subprocess
+import threading
+from contextlib import contextmanager
+
+import tracing
+import util
+
+
+class LocalInstance(object):
+  """Local stand-in for an AWSInstance.
+
+  Args:
+    index: position in the local cluster, used for the id and port offset.
+    work_dir: directory commands run in, defaults to the current directory.
+
+  """
+
+  def __init__(self, index=0, work_dir=None):
+    self.instance_id = 'local-{}'.format(index)
+    self.hostname = 'localhost'
+    self.private_ip = '127.0.0.1'
+    self.username = getpass.getuser()
+    self.work_dir = work_dir
+    # All local instances share one ip, so each gets its own ps/worker ports.
+    self.port_offset = 2 * index
+    self.ready = threading.Event()
+    self.ready.set()
+    self.quarantined = False
+
+  @property
+  def state(self):
+    return 'running'
+
+  def WaitUntilReady(self):
+    pass
+
+  def _Popen(self, cmd, stdout, stderr):
+    return subprocess.Popen(
+        cmd,
+        shell=True,
+        cwd=self.work_dir,
+        stdout=stdout,
+        stderr=stderr,
+        close_fds=True)
+
+  def ExecuteCommandAndWait(self, cmd, print_error=False, ok_exit_status=[0]):
+    p = self._Popen(cmd, subprocess.PIPE, subprocess.STDOUT)
+    output = p.communicate()[0]
+    if p.returncode in ok_exit_status:
+      return True
+    if print_error:
+      print('Error({}) executing command:{}'.format(p.returncode, cmd))
+      print(output)
+    return False
+
+  def ExecuteCommandAndReturnStdout(self, cmd):
+    # Merged like the output of a command run with a pty over ssh.
+    return self._Popen(cmd, subprocess.PIPE, subprocess.STDOUT).communicate()[0]
+
+  def ExecuteCommandAndStreamOutput(self,
+                                    cmd,
+                                    stdout_file=None,
+                                    stderr_file=None,
+                                    line_extractor=None,
+                                    print_error=False,
+                                    ok_exit_status=[0],
+                                    compression=None):
+    """Runs cmd and streams its output like util.ExecuteCommandAndStreamOutput.
+
+    Without stderr_file, stderr goes to stdout_file as it does with the pty
+    used over ssh. Output is passed to line_extractor even without a file.
+
+    """
+    trace = tracing.CommandTrace(self.instance_id, cmd, line_extractor)
+    stream_stdout = stdout_file or line_extractor
+    with open(os.devnull, 'w') as devnull:
+      p = self._Popen(cmd, subprocess.PIPE if stream_stdout else devnull,
+                      subprocess.PIPE if stderr_file else subprocess.STDOUT)
+      threads = []
+      if stream_stdout:
+        threads.append(
+            util._StreamOutputToFile(
+                p.stdout, stdout_file, trace, command=cmd,
+                compression=compression))
+      if stderr_file:
+        threads.append(
+            util._StreamOutputToFile(
+                p.stderr, stderr_file, trace, compression=compression))
+      for t in threads:
+        t.join()
+      exit_status = p.wait()
+    trace.Finish()
+    if exit_status in ok_exit_status:
+      return True
+    if print_error:
+      print('Command execution failed! Check log. Exit Status({}):{}'.format(
+          exit_status, cmd))
+    return False
+
+  def ExecuteCommandInThread(self,
+                             command,
+                             stdout_file=None,
+                             stderr_file=None,
+                             line_extractor=None,
+                             print_error=False,
+                             compression=None):
+    t = threading.Thread(
+        target=self.ExecuteCommandAndStreamOutput,
+        args=(command, stdout_file, stderr_file, line_extractor, print_error),
+        kwargs={'compression': compression})
+    t.start()
+    return t
+
+  def _Path(self, path):
+    return os.path.join(self.work_dir or '', path)
+
+  def UploadFile(self, local_file, remote_file):
+    with tracing.Span('upload', self.instance_id, file=remote_file):
+      shutil.copyfile(local_file, self._Path(remote_file))
+
+  def RetrieveFile(self, remote_file, local_file, resume=False):
+    if not resume or not os.path.exists(local_file):
+      shutil.copyfile(self._Path(remote_file), local_file)
+      return
+    with open(self._Path(remote_file), 'rb') as src:
+      with open(local_file, 'ab') as dst:
+        src.seek(os.path.getsize(local_file))
+        shutil.copyfileobj(src, dst)
+
+  def CleanSshClient(self):
+    pass
+
+  def Start(self):
+    pass
+
+  def Stop(self):
+    pass
+
+  def Terminate(self):
+    pass
+
+
+@contextmanager
+def LocalInstances(num_instances=1, work_dir=None):
+  """Yields num_instances LocalInstance, the local version of AwsInstances."""
+  yield [LocalInstance(i, work_dir=work_dir) for i in range(num_instances)]
@@ -0,0 +1,124 @@
+"""Splits an instance fleet into sub-clusters that run configs in parallel."""
+import socket
+import struct
+
+import command_builder
+import gpu_scheduler
+import netbench
+
+PS_PORT = 50000
+WORKER_PORT = 50001
+
+
+def NumWorkers(run_config):
+  """Returns the number of worker tasks of a run config."""
+  return len(command_builder.WorkerUtil(run_config.get('workers', 0)).split(','))
+
+
+def NumPs(run_config):
+  """Returns the number of parameter server tasks of a run config."""
+  ps_servers = run_config.get('ps_servers', 0)
+  if str(ps_servers) == '0':
+    return 0
+  return len(command_builder.WorkerUtil(ps_servers).split(','))
+
+
+def InstancesNeeded(run_config):
+  """Returns the number of hosts a run needs, ps share hosts with workers."""
+  return max(NumWorkers(run_config), NumPs(run_config))
+
+
+def _IpKey(instance):
+  try:
+    return struct.unpack('!I', socket.inet_aton(instance.private_ip))[0]
+  except (socket.error, TypeError):
+    return instance.private_ip
+
+
+def LocalityOrder(instances):
+  """Orders instances by private ip so nearby hosts are partitioned together."""
+  return sorted(instances, key=_IpKey)
+
+
+def BuildHostStrings(instances, run_config):
+  """Returns (worker_hosts, ps_hosts) strings for a run on instances.
+
+  Worker i runs on instances[i] and ps i on instances[i], as in the single
+  fleet runs. ps_hosts is empty for runs without parameter servers. Instances
+  sharing an ip, e.g. cluster_local.LocalInstance, have a port_offset.
+
+  """
+
+  def HostPort(instance, port):
+    return '{}:{}'.format(instance.private_ip,
+                          port + getattr(instance, 'port_offset', 0))
+
+  worker_hosts = ','.join(HostPort(instance, WORKER_PORT)
+                          for instance in instances[:NumWorkers(run_config)])
+  ps_hosts = ','.join(HostPort(instance, PS_PORT)
+                      for instance in instances[:NumPs(run_config)])
+  return worker_hosts, ps_hosts
+
+
+def RunPartitioned(run_configs,
+                   instances,
+                   run_fn,
+                   host_order=None,
+                   measure_network=False):
+  """Runs distributed configs concurrently on disjoint parts of a fleet.
+
+  Each config gets InstancesNeeded(run_config) hosts that no other running
+  config uses, taken as a contiguous block of the fleet in LocalityOrder so
+  a partition stays close together in the placement group. Quarantined
+  instances are not used, including those quarantined while the sweep runs
+  once the config using them has ended.
+
+  Args:
+    run_configs: iterable of run configs, e.g. from LoadYamlRunConfig.
+    instances: fleet from AwsInstances/ReuseAwsInstances.
+    run_fn: function called as run_fn(run_config, instances, worker_hosts,
+      ps_hosts) in a thread per config.
+    host_order: optional function reordering the instances of a partition
+      before ps and worker tasks are assigned, e.g. netbench.PlacementOrder.
+    measure_network: True to measure the netbench.MeasureMatrix of the fleet
+      once before the first run. Partitions are then ordered with
+      netbench.PlacementOrder unless host_order is given, and each run config
+      is passed to run_fn as a copy with the matrix of its partition under
+      'network', see netbench.AttachNetworkMatrix.
+
+  returns list of the configs whose run_fn raised an exception or that need
+  more instances than the fleet has.
+
+  """
+  ordered = LocalityOrder(instances)
+  pool = gpu_scheduler.ResourcePool(len(ordered))
+
+  def Quarantined(slots):
+    return [i for i in slots if getattr(ordered[i], 'quarantined', False)]
+
+  matrix = None
+  if measure_network:
+    matrix = netbench.MeasureMatrix(
+        [i for i in ordered if not getattr(i, 'quarantined', False)])
+    if host_order is None:
+      host_order = lambda partition: netbench.PlacementOrder(partition, matrix)
+
+  def Run(run_config, slots):
+    partition = [ordered[i] for i in slots]
+    if host_order:
+      partition = host_order(partition)
+    if matrix is not None:
+      run_config = netbench.AttachNetworkMatrix(
+          run_config.copy(),
+          netbench.SubMatrix(matrix, [i.instance_id for i in partition]))
+    worker_hosts, ps_hosts = BuildHostStrings(partition, run_config)
+    print('Running {} on {} of {} instances'.format(
+        run_config.get('name'), len(partition), len(ordered)))
+    try:
+      run_fn(run_config, partition, worker_hosts, ps_hosts)
+    finally:
+      # The slots are still ours, so no other config can be given them.
+      pool.Disable(Quarantined(slots))
+
+  pool.Disable(Quarantined(range(len(ordered))))
+  return gpu_scheduler.RunPacked(run_configs, pool, InstancesNeeded, Run)
@@ -1,12 +1,42 @@
+import collections
+import itertools
 import os
+import result_store
 import sys
+import throughput
+
+# Fields that decide which processes run on which hosts.  Sweeps are ordered
+# so consecutive runs share these values.
+TOPOLOGY_FIELDS = ('workers', 'ps_servers', 'gpus')
+# Most runs of a config with 'repeat_ci_width' but neither 'repeat_max' nor
+# 'repeat'.
+DEFAULT_REPEAT_MAX = 10
+# Sweep points held at once while ordering runs by topology.
+TOPOLOGY_WINDOW = 1024
+# Environment variable set on the benchmark processes of a run, see RunMarker.
+RUN_MARKER_ENV = 'TF_TOOLS_RUN'
+
+
+def RunMarker(run_config):
+  """Returns the RUN_MARKER_ENV value of the processes of run_config.
+
+  Runs packed on one host get different markers, which lets
+  steady_state.StopRemoteTasks stop one run without touching the others.
+
+  """
+  return result_store.ConfigHash(run_config)[:16]
 
 
 def BuildDistributedCommandWorker(run_config, worker_hosts, ps_hosts,
                                   task_index):
   """Build command to start distributed worker."""
 
-  run_script = 'python tf_cnn_benchmarks.py'
+  run_script = '{}={} python tf_cnn_benchmarks.py'.format(
+      RUN_MARKER_ENV, RunMarker(run_config))
+  # Limits the run to the GPUs given to it by gpu_scheduler.
+  if 'visible_gpus' in run_config:
+    run_script = 'CUDA_VISIBLE_DEVICES={} {}'.format(run_config['visible_gpus'],
+                                                     run_script)
   # Build command line
   run_cmd_list = []
 
@@ -85,7 +115,8 @@ def BuildDistributedCommandPS(run_config, worker_hosts, ps_hosts, task_index):
   """
   print('Build Distributed Parameter Run Command')
 
-  run_script = "CUDA_VISIBLE_DEVICES='' python tf_cnn_benchmarks.py"
+  run_script = "CUDA_VISIBLE_DEVICES='' {}={} python tf_cnn_benchmarks.py"
+  run_script = run_script.format(RUN_MARKER_ENV, RunMarker(run_config))
   # Build command line
   run_cmd_list = []
 
@@ -123,79 +154,206 @@ def GpuDecode(raw_gpu_input):
     return raw_gpu_input.split(',')
 
 
-def LoadYamlRunConfig(full_config, debug_level):
-  """Processes config file into list of configs
+class AdaptiveRepeat(object):
+  """Decides how many times to repeat a config from its results so far.
+
+  Enabled for configs with 'repeat_ci_width', the target width of the 95%
+  confidence interval of images/sec relative to the mean, e.g. 0.02.  Such a
+  config is run at least 'repeat_min' times (default 3) and then repeated
+  until the interval is narrow enough or 'repeat_max' runs (default twice
+  'repeat', or DEFAULT_REPEAT_MAX without 'repeat') were made.
+
+  Pass an instance to LoadYamlRunConfig and call Record() with each finished
+  run before asking the generator for the next config, e.g. through
+  result_store.RunSweep.  gpu_scheduler.RunPacked pulls a config only when it
+  has free slots for it, so copies that are still running are not counted
+  yet and a packed sweep may make a few more runs than a sequential one.
+
+  """
+
+  def __init__(self):
+    self._samples = collections.defaultdict(list)
+
+  def _Key(self, run_config):
+    return result_store.ConfigHash(run_config, ignore=('copy',))
+
+  def Record(self, run_config, images_per_sec=None):
+    """Records a finished run, by default using run_config['results']."""
+    if images_per_sec is None:
+      images_per_sec = run_config['results']['images_per_sec']
+    self._samples[self._Key(run_config)].append(float(images_per_sec))
+
+  def RelativeWidth(self, run_config):
+    """Returns the 95% interval width over the mean, None below 2 samples."""
+    stats = throughput.RunningStats()
+    for x in self._samples[self._Key(run_config)]:
+      stats.Add(x)
+    return stats.RelativeCiWidth()
+
+  def NeedsMore(self, run_config):
+    width = self.RelativeWidth(run_config)
+    return width is None or width > float(run_config['repeat_ci_width'])
+
+  def Copies(self, run_config):
+    """Yields copies of run_config until its results are stable enough."""
+    repeat_min = int(run_config.get('repeat_min', 3))
+    if 'repeat_max' in run_config:
+      repeat_max = int(run_config['repeat_max'])
+    elif run_config.get('repeat') is not None:
+      repeat_max = 2 * int(run_config['repeat'])
+    else:
+      repeat_max = DEFAULT_REPEAT_MAX
+    for i in range(repeat_max):
+      if i >= repeat_min and not self.NeedsMore(run_config):
+        print('Config:{} stable after {} runs'.format(run_config.get('name'), i))
+        return
+      repeat_config = run_config.copy()
+      repeat_config['copy'] = i
+      yield repeat_config
+
+
+def _DecodeGpuAxis(gpus):
+  """Returns the gpu counts to sweep for the raw 'gpus' field."""
+  if isinstance(gpus, list):
+    return [str(gpu) for gpu in gpus]
+  gpu_list = GpuDecode(gpus)
+  # GpuDecode returns a single string for ints, e.g. '16'.
+  if isinstance(gpu_list, str):
+    return [gpu_list]
+  return gpu_list
+
+
+def _SweepAxes(config):
+  """Returns the (field, values) pairs the config is expanded over.
+
+  'models' is expanded into 'model', 'gpus' may be a comma delimited string
+  and any other list valued field is swept as is. Topology fields come first
+  so they vary slowest in the cartesian product.
+
+  """
+  axes = []
+  if 'models' in config:
+    axes.append(('model', list(config['models'])))
+  if 'gpus' in config:
+    axes.append(('gpus', _DecodeGpuAxis(config['gpus'])))
+  for field in sorted(config):
+    if field not in ('models', 'gpus') and isinstance(config[field], list):
+      axes.append((field, config[field]))
+  axes.sort(key=lambda axis: axis[0] not in TOPOLOGY_FIELDS)
+  return axes
+
+
+def _MergedConfigs(full_config):
+  """Yields each run_config merged with the base config and root settings."""
+  root = dict((k, v) for k, v in full_config.items() if k != 'run_configs')
+  base_config = None
+  for config in full_config['run_configs']:
+    if base_config is None:
+      base_config = config
+    merged = dict(base_config)
+    merged.update(config)
+    # Anything at the root overrides anything in run_configs.
+    merged.update(root)
+    yield merged
+
+
+def _TopologyKey(config, fields, values):
+  swept = dict(zip(fields, values))
+  return tuple(str(swept.get(f, config.get(f))) for f in TOPOLOGY_FIELDS)
+
+
+def _PlanRuns(full_config, order_by_topology, window=TOPOLOGY_WINDOW):
+  """Yields (config, fields, values) for every point of every sweep.
+
+  Only the merged configs and tuples of swept values are held, the run configs
+  themselves are built when they are yielded.  Ordering by topology looks at
+  `window` points at a time, so memory stays bounded for any sweep size.
+
+  """
+  plan = ((config, [f for f, _ in axes], values)
+          for config in _MergedConfigs(full_config)
+          for axes in [_SweepAxes(config)]
+          for values in itertools.product(*[v for _, v in axes]))
+  if not order_by_topology:
+    for item in plan:
+      yield item
+    return
+  # Group by topology in order of first appearance so consecutive runs use
+  # the same workers, ps_servers and gpus, i.e. the same processes and hosts.
+  # A window starts with the topology the previous one ended with.
+  last_key = None
+  while True:
+    chunk = list(itertools.islice(plan, window))
+    if not chunk:
+      return
+    groups = collections.OrderedDict()
+    for item in chunk:
+      groups.setdefault(_TopologyKey(*item), []).append(item)
+    keys = list(groups)
+    if last_key in groups:
+      keys.remove(last_key)
+      keys.insert(0, last_key)
+    for key in keys:
+      for item in groups[key]:
+        yield item
+    last_key = keys[-1]
+
+
+def LoadYamlRunConfig(full_config,
+                      debug_level,
+                      order_by_topology=True,
+                      repeat_controller=None):
+  """Processes config file into a generator of configs
 
   Reads the config made up of repeating 'run_configs'  The first first config as
   is treated as the base. Each config entry after the first is merged with the
   base (first) config.  The idea being the first config is the base and the
-  subsequent configs are variations that override the base config
+  subsequent configs are variations that override the base config.  Settings at
+  the root of the file override everything in 'run_configs'.
 
-  Additionally, multiple configs are created based on the the following fields:
-  'model' (list of models to test), gpu (list of number of GPUs to test), and
-  repeat (number of times to run the test).
+  Each config is then expanded over the cartesian product of its sweep fields:
+  'models' (list of models to test), 'gpus' (list or comma delimited string of
+  gpu counts) and any other list valued field, e.g. batch_size, data_format,
+  variable_update, ps_servers or workers.  Identical configs are only run once
+  and each is repeated 'repeat' times with an index in 'copy'.  With a
+  repeat_controller, configs with 'repeat_ci_width' are instead repeated until
+  their results are stable, see AdaptiveRepeat.
 
   Args:
     full_config: full run_config normally loaded from yaml
     debug_level: controls level of output
-  """
+    order_by_topology: True to order runs so consecutive runs share the same
+      workers, ps_servers and gpus.  Runs are reordered within windows of
+      TOPOLOGY_WINDOW sweep points, so the generator stays lazy.
+    repeat_controller: optional AdaptiveRepeat fed with the results of each
+      run before the next config is requested.
 
-  # base config that subsequent configs merge with
-  base_config = None
-  configs = []
-  for config in full_config['run_configs']:
-    if base_config is None:
-      base_config = config
+  returns a generator of run configs.
+  """
+  seen = set()
+  for config, fields, values in _PlanRuns(full_config, order_by_topology):
+    run_config = dict(config)
+    run_config.update(zip(fields, values))
+    if 'gpus' in config:
+      run_config['raw_gpu'] = config['gpus']
+
+    key = repr(sorted(run_config.items()))
+    if key in seen:
+      continue
+    seen.add(key)
+
+    if debug_level > 0:
+      print('Config:{} \n{}'.format(run_config.get('name'), run_config))
+    # Check if the test should be repeated
+    if (repeat_controller is not None and
+        run_config.get('repeat_ci_width') is not None):
+      for repeat_config in repeat_controller.Copies(run_config):
+        yield repeat_config
+    elif run_config.get('repeat') is not None:
+      for i in range(int(run_config['repeat'])):
+        # Creates copy so each one can have an index, e.g. 'copy'
+        repeat_config = run_config.copy()
+        repeat_config['copy'] = i
+        yield repeat_config
     else:
-      # merges config with base config
-      base = base_config.copy()
-      base.update(config)
-      config = base
-
-    # Copy root settings into config.  Anything
-    # at the root with override anything in run_configs
-    for k, v in full_config.iteritems():
-      if k != 'run_configs':
-        base_config[k] = v
-
-    # breaks configs up to run each model in a seperate config
-    for model in config['models']:
-      #print('Model {}'.format(model))
-      model_config = config.copy()
-      model_config['model'] = model
-
-      # Multiple configs if gpu count is comma delimited
-      if 'gpus' in config:
-        gpus = config['gpus']
-        gpu_list = GpuDecode(gpus)
-        for gpu in gpu_list:
-          gpu_config = model_config.copy()
-          gpu_config['raw_gpu'] = gpus
-          gpu_config['gpus'] = gpu
-          # Check if the test should be repeated
-          if gpu_config.get('repeat') is not None:
-            repeat = int(gpu_config['repeat'])
-            for i in range(repeat):
-              # Creates copy so each one can have an index, e.g. 'copy'
-              repeat_model_config = gpu_config.copy()
-              repeat_model_config['copy'] = i
-              configs.append(repeat_model_config)
-          else:
-            # Add config to list
-            configs.append(gpu_config)
-          if debug_level > 0:
-            print('Config:{} \n{}'.format(gpu_config['name'], gpu_config))
-      # Testing with CPU
-      else:
-        if model_config.get('repeat') is not None:
-          repeat = int(model_config['repeat'])
-          for i in range(repeat):
-            # Creates copy so each one can have an index, e.g. 'copy'
-            repeat_model_config = model_config.copy()
-            repeat_model_config['copy'] = i
-            configs.append(repeat_model_config)
-        else:
-          configs.append(model_config)
-        if debug_level > 0:
-          print('Config:{} \n{}'.format(model_config['name'], model_config))
-  return configs
+      yield run_config
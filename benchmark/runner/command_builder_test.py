@@ -0,0 +1,82 @@
+"""Tests adaptive repeats of LoadYamlRunConfig with the runners feeding them.
+
+Run from benchmark/runner with:
+
+  python -m unittest discover -p '*_test.py'
+"""
+import itertools
+import shutil
+import tempfile
+import unittest
+
+import command_builder
+import gpu_scheduler
+import result_store
+
+
+class AdaptiveRepeatTest(unittest.TestCase):
+
+  def setUp(self):
+    self.store_dir = tempfile.mkdtemp()
+    self.full_config = {
+        'run_configs': [{
+            'name': 'stable',
+            'model': 'resnet50',
+            'gpus': 1,
+            'repeat_ci_width': 0.02,
+            'repeat_max': 10,
+        }]
+    }
+    self.runs = []
+
+  def tearDown(self):
+    shutil.rmtree(self.store_dir)
+
+  def _Configs(self, controller):
+    return command_builder.LoadYamlRunConfig(
+        self.full_config, 0, repeat_controller=controller)
+
+  def _Run(self, run_config):
+    self.runs.append(run_config['copy'])
+    # Low variance, the interval is narrow once repeat_min runs are in.
+    return {'images_per_sec': 100.0 + 0.1 * run_config['copy']}, []
+
+  def testSweepStopsLowVarianceConfigEarly(self):
+    controller = command_builder.AdaptiveRepeat()
+    store = result_store.ResultStore(self.store_dir)
+    self.assertEqual([], result_store.RunSweep(
+        store, self._Configs(controller), self._Run, controller))
+    store.Close()
+    self.assertEqual([0, 1, 2], self.runs)
+
+  def testResumedSweepCountsStoredCopies(self):
+    controller = command_builder.AdaptiveRepeat()
+    store = result_store.ResultStore(self.store_dir, sweep_id='sweep')
+    # The runner dies after two copies.
+    result_store.RunSweep(
+        store, itertools.islice(self._Configs(controller), 2), self._Run,
+        controller)
+    store.Close()
+
+    self.runs = []
+    controller = command_builder.AdaptiveRepeat()
+    store = result_store.ResultStore(self.store_dir, sweep_id='sweep')
+    result_store.RunSweep(
+        store, self._Configs(controller), self._Run, controller)
+    store.Close()
+    self.assertEqual([2], self.runs)
+
+  def testPackedRunsStopLowVarianceConfigEarly(self):
+    controller = command_builder.AdaptiveRepeat()
+
+    def Run(run_config):
+      results, _ = self._Run(run_config)
+      controller.Record(run_config, results['images_per_sec'])
+
+    self.assertEqual([], gpu_scheduler.RunSingleHostConfigs(
+        self._Configs(controller), Run, num_gpus=1))
+    self.assertEqual([0, 1, 2], self.runs)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,253 @@
+"""Moves files between the runner and all instances of a fleet in parallel."""
+import hashlib
+import os
+import pipes
+import tarfile
+from multiprocessing.pool import ThreadPool
+
+import result_store
+
+
+def FileHash(path):
+  """Returns the sha256 hex digest of a local file."""
+  sha = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      sha.update(chunk)
+  return sha.hexdigest()
+
+
+def RemoteHashes(instance, remote_files):
+  """Returns {remote_file: sha256} for the remote files that exist.
+
+  Also creates the parent directories of the files so uploads can follow.
+
+  """
+  dirs = sorted(set(os.path.dirname(f) for f in remote_files) - set(['']))
+  cmd = ''
+  if dirs:
+    cmd = 'mkdir -p {}; '.format(' '.join(pipes.quote(d) for d in dirs))
+  cmd += 'sha256sum {} 2>/dev/null; true'.format(' '.join(
+      pipes.quote(f) for f in remote_files))
+  hashes = {}
+  for line in instance.ExecuteCommandAndReturnStdout(cmd).splitlines():
+    parts = line.strip().split(None, 1)
+    if len(parts) == 2:
+      hashes[parts[1]] = parts[0]
+  return hashes
+
+
+def _Relay(instances, local_file, remote_file, relay_ssh_key, max_workers):
+  """Uploads to one instance and copies host to host in a doubling tree.
+
+  Every round each instance that has the file sends it to one that does not,
+  so the runner uploads once and the fleet is done in log2(n) rounds. The
+  runner uploads directly to the instances a copy failed for.
+
+  returns (number of direct uploads, number of copies relayed).
+
+  """
+  instances[0].UploadFile(local_file, remote_file)
+  have, need = [instances[0]], list(instances[1:])
+  uploaded, relayed = 1, 0
+  pool = ThreadPool(max_workers)
+  try:
+    while need:
+      pairs = list(zip(have, need))
+      scp = 'scp -q -o StrictHostKeyChecking=no -i {} {} {}@{}:{}'
+      cmds = [(src, scp.format(
+          pipes.quote(relay_ssh_key), pipes.quote(remote_file), dst.username,
+          dst.private_ip, pipes.quote(remote_file))) for src, dst in pairs]
+      results = pool.map(lambda src_cmd: src_cmd[0].ExecuteCommandAndWait(
+          src_cmd[1], print_error=True), cmds)
+      failed = [dst for (_, dst), ok in zip(pairs, results) if not ok]
+      if failed:
+        print('Relay of {} failed to {}, uploading directly.'.format(
+            remote_file, ', '.join(i.hostname for i in failed)))
+        pool.map(lambda dst: dst.UploadFile(local_file, remote_file), failed)
+      uploaded += len(failed)
+      relayed += len(pairs) - len(failed)
+      have.extend(dst for _, dst in pairs)
+      need = need[len(pairs):]
+  finally:
+    pool.close()
+  return uploaded, relayed
+
+
+def SyncFiles(instances,
+              file_pairs,
+              max_workers=16,
+              relay_min_bytes=None,
+              relay_ssh_key=None):
+  """Makes remote files on every instance match the local files.
+
+  Content hashes are compared with sha256sum on each host and only files that
+  differ are uploaded, to all hosts in parallel. Files of at least
+  relay_min_bytes needed by more than two hosts are uploaded once and relayed
+  host to host, which requires relay_ssh_key to exist on the instances.
+
+  Args:
+    instances: list of AWSInstance (or anything with the same interface).
+    file_pairs: list of (local_file, remote_file).
+    max_workers: maximum concurrent uploads and remote commands.
+    relay_min_bytes: size from which files are relayed, None to never relay.
+    relay_ssh_key: path on the instances of the key used to scp between them.
+
+  returns dict with the number of 'uploaded', 'relayed' and 'skipped' copies.
+  The first copy of a relayed file and copies the relay failed to deliver
+  count as uploaded.
+
+  """
+  local_hashes = dict((local, FileHash(local)) for local, _ in file_pairs)
+  remote_files = [remote for _, remote in file_pairs]
+  pool = ThreadPool(max_workers)
+  try:
+    remote_hashes = pool.map(lambda i: RemoteHashes(i, remote_files), instances)
+
+    uploads = []
+    relays = []
+    skipped = 0
+    for local, remote in file_pairs:
+      stale = [
+          instance for instance, hashes in zip(instances, remote_hashes)
+          if hashes.get(remote) != local_hashes[local]
+      ]
+      skipped += len(instances) - len(stale)
+      if (relay_min_bytes is not None and relay_ssh_key and len(stale) > 2 and
+          os.path.getsize(local) >= relay_min_bytes):
+        relays.append((stale, local, remote))
+      else:
+        uploads.extend((instance, local, remote) for instance in stale)
+
+    pool.map(lambda upload: upload[0].UploadFile(upload[1], upload[2]),
+             uploads)
+  finally:
+    pool.close()
+  uploaded, relayed = len(uploads), 0
+  for stale, local, remote in relays:
+    relay_uploaded, relay_relayed = _Relay(stale, local, remote, relay_ssh_key,
+                                           max_workers)
+    uploaded += relay_uploaded
+    relayed += relay_relayed
+
+  summary = {
+      'uploaded': uploaded,
+      'relayed': relayed,
+      'skipped': skipped,
+  }
+  print('File sync: {uploaded} uploaded, {relayed} relayed, '
+        '{skipped} unchanged'.format(**summary))
+  return summary
+
+
+def _RemoteSize(instance, remote_file):
+  """Returns the size of a remote file or None if it does not exist."""
+  out = instance.ExecuteCommandAndReturnStdout(
+      'stat -c %s {} 2>/dev/null'.format(pipes.quote(remote_file))).strip()
+  return int(out) if out.isdigit() else None
+
+
+def _SafeExtract(archive, local_dir):
+  """Extracts the files and directories of archive under local_dir.
+
+  Links and special files are skipped since a link could point the members
+  after it outside local_dir. Raises ValueError for members outside it.
+
+  """
+  root = os.path.realpath(local_dir)
+  with tarfile.open(archive, 'r:gz') as tar:
+    members = []
+    for member in tar.getmembers():
+      path = os.path.realpath(os.path.join(root, member.name))
+      if not path.startswith(root + os.sep):
+        raise ValueError('Unsafe path in archive {}: {}'.format(
+            archive, member.name))
+      if member.isfile() or member.isdir():
+        members.append(member)
+      else:
+        print('Skipping link or special file {} in {}'.format(
+            member.name, archive))
+    tar.extractall(root, members=members)
+
+
+def RetrieveDirectories(instance, remote_dirs, local_dir, archive_id=''):
+  """Pulls remote_dirs from instance as one compressed archive.
+
+  The archive name is derived from archive_id and remote_dirs, so archive_id
+  has to tell runs apart, e.g. the result_store.ConfigHash of the run config.
+  An archive left on the host and a partial local copy from an interrupted
+  call are reused, so a retry only transfers the missing bytes. The
+  directories are extracted under local_dir with their paths relative to /.
+
+  """
+  if not os.path.isdir(local_dir):
+    os.makedirs(local_dir)
+  rel_dirs = [d.lstrip('/') for d in remote_dirs]
+  name = hashlib.sha1('\n'.join([archive_id] + rel_dirs).encode(
+      'utf-8')).hexdigest()[:16]
+  remote_archive = '/tmp/retrieve_{}.tgz'.format(name)
+  local_archive = os.path.join(local_dir, 'retrieve_{}.tgz'.format(name))
+  partial = local_archive + '.part'
+
+  remote_size = _RemoteSize(instance, remote_archive)
+  if remote_size is None:
+    if os.path.exists(partial):
+      os.remove(partial)
+    # Built under a temporary name so a half written archive is never reused.
+    instance.ExecuteCommandAndWait(
+        'tar czf {0}.tmp --ignore-failed-read -C / {1}; mv {0}.tmp {0}'.format(
+            remote_archive, ' '.join(pipes.quote(d) for d in rel_dirs)),
+        print_error=True)
+    remote_size = _RemoteSize(instance, remote_archive)
+  if remote_size is None:
+    raise IOError('Failed to archive {} on {}'.format(remote_dirs,
+                                                      instance.hostname))
+
+  instance.RetrieveFile(remote_archive, partial, resume=True)
+  if os.path.getsize(partial) != remote_size:
+    raise IOError('Incomplete transfer of {} from {}'.format(
+        remote_archive, instance.hostname))
+  os.rename(partial, local_archive)
+  _SafeExtract(local_archive, local_dir)
+  os.remove(local_archive)
+  instance.ExecuteCommandAndWait('rm -f {}'.format(remote_archive))
+
+
+def RetrieveFromFleet(instances,
+                      remote_dirs,
+                      log_folder,
+                      run_config,
+                      max_workers=8):
+  """Pulls remote_dirs from all instances into the run's log folder.
+
+  Hosts are retrieved concurrently, at most max_workers at a time, into
+  <log_folder>/<run name>/<config hash>/<copy>/<hostname>. Many configs share
+  a name and each is repeated, so the result_store.ConfigHash and the copy
+  keep their logs apart. A host that fails is reported and can be retried
+  with the same arguments, resuming its transfer.
+
+  returns list of the instances whose retrieval failed.
+
+  """
+  archive_id = result_store.ConfigHash(run_config)
+  run_dir = os.path.join(log_folder, run_config['name'], archive_id,
+                         str(run_config.get('copy', 0)))
+
+  def Retrieve(instance):
+    try:
+      RetrieveDirectories(
+          instance,
+          remote_dirs,
+          os.path.join(run_dir, instance.hostname),
+          archive_id=archive_id)
+    except (IOError, OSError, ValueError) as e:
+      print('Failed to retrieve {} from {}:{}'.format(remote_dirs,
+                                                      instance.hostname, e))
+      return instance
+    return None
+
+  pool = ThreadPool(max_workers)
+  try:
+    return [i for i in pool.map(Retrieve, instances) if i is not None]
+  finally:
+    pool.close()
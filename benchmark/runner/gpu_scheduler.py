@@ -0,0 +1,193 @@
+"""Packs independent runs onto disjoint slots of a shared resource.
+
+Used to run several single host configs at the same time on one multi-GPU
+host, each limited to its own GPUs through CUDA_VISIBLE_DEVICES.
+"""
+import threading
+
+
+class ResourcePool(object):
+  """Tracks which of `size` numbered slots, e.g. GPUs, are in use."""
+
+  def __init__(self, size):
+    self.size = size
+    self.in_use = [False] * size
+    self.disabled = set()
+
+  @property
+  def usable(self):
+    return self.size - len(self.disabled)
+
+  def _Free(self, start, count):
+    return start + count <= self.size and not any(
+        self.in_use[start:start + count])
+
+  def Allocate(self, count):
+    """Marks `count` slots as used and returns their ids, or None if full.
+
+    Prefers a contiguous block aligned to its size, e.g. GPUs 4-7 for a 4 GPU
+    run, since on p2/p3 hosts such blocks share a PCIe switch or NVLink
+    ring. Falls back to any contiguous block and then to any free slots.
+
+    """
+    if count > self.in_use.count(False):
+      return None
+    starts = [s for s in range(0, self.size, max(count, 1))]
+    starts += [s for s in range(self.size) if s not in starts]
+    for start in starts:
+      if self._Free(start, count):
+        slots = list(range(start, start + count))
+        break
+    else:
+      slots = [i for i, used in enumerate(self.in_use) if not used][:count]
+    for slot in slots:
+      self.in_use[slot] = True
+    return slots
+
+  def Release(self, slots):
+    for slot in slots:
+      if slot not in self.disabled:
+        self.in_use[slot] = False
+
+  def Disable(self, slots):
+    """Takes slots out of the pool for good, e.g. quarantined hosts."""
+    for slot in slots:
+      self.disabled.add(slot)
+      self.in_use[slot] = True
+
+
+def RunPacked(items, pool, size_fn, run_fn, exclusive_fn=None, lookahead=8):
+  """Runs items concurrently on disjoint slots of pool.
+
+  Items are started in order. When the next item does not fit, later items
+  that fit in the free slots are started ahead of it, except when the
+  waiting item is exclusive; then nothing new starts until the pool drains.
+
+  Items are pulled from the iterable only when there are free slots to run
+  them, so a generator such as LoadYamlRunConfig with an AdaptiveRepeat sees
+  the results run_fn recorded for the runs that already finished.
+
+  Args:
+    items: iterable of items to run, e.g. run configs.
+    pool: ResourcePool shared by the items.
+    size_fn: function returning the number of slots an item needs.
+    run_fn: function called as run_fn(item, slots) in a thread per item.
+    exclusive_fn: function returning True for items that need the whole pool.
+    lookahead: most items pulled but not started at a time.
+
+  returns list of the items whose run_fn raised an exception or that need
+  more slots than the pool has usable, e.g. after pool.Disable. Such items
+  are reported instead of raised so the runs already started are joined.
+
+  """
+  items = iter(items)
+  exhausted = [False]
+  pending = []
+  failed = []
+  threads = []
+  running = [0]
+  cond = threading.Condition()
+
+  def Slots(item):
+    if exclusive_fn and exclusive_fn(item):
+      return pool.usable
+    return size_fn(item)
+
+  def Run(item, slots):
+    try:
+      run_fn(item, slots)
+    except Exception as e:
+      print('Packed run failed:{}'.format(e))
+      failed.append(item)
+    finally:
+      with cond:
+        pool.Release(slots)
+        running[0] -= 1
+        cond.notify_all()
+
+  def StartNext():
+    """Starts or fails one pending item, returns False if none can start."""
+    for i, item in enumerate(pending):
+      size = Slots(item)
+      if size > pool.usable:
+        print('Item needs {} slots, only {} are usable'.format(
+            size, pool.usable))
+        failed.append(pending.pop(i))
+        return True
+      slots = pool.Allocate(size)
+      if slots is not None:
+        pending.pop(i)
+        running[0] += 1
+        t = threading.Thread(target=Run, args=(item, slots))
+        t.start()
+        threads.append(t)
+        return True
+      if size == pool.usable:
+        # Do not let smaller items jump ahead of one waiting for all slots.
+        return False
+    # Only pull an item that could start now, or fail if nothing is running.
+    if (exhausted[0] or len(pending) >= lookahead or
+        (running[0] and False not in pool.in_use)):
+      return False
+    try:
+      pending.append(next(items))
+    except StopIteration:
+      exhausted[0] = True
+      return False
+    return True
+
+  with cond:
+    while True:
+      if StartNext():
+        continue
+      if exhausted[0] and not pending:
+        break
+      cond.wait()
+  for t in threads:
+    t.join()
+  return failed
+
+
+def IsSingleHost(run_config):
+  """Returns True for configs that run one local worker without ps."""
+  return (str(run_config.get('workers', '0')) == '0' and
+          str(run_config.get('ps_servers', '0')) == '0')
+
+
+def _GpuCount(run_config):
+  return int(run_config['gpus'])
+
+
+def _NeedsWholeHost(run_config):
+  # CPU runs and runs that opted out of co-location get the host to themselves.
+  return 'gpus' not in run_config or bool(run_config.get('exclusive_gpus'))
+
+
+def RunSingleHostConfigs(run_configs, run_fn, num_gpus=8):
+  """Runs single host configs concurrently on disjoint GPUs of one host.
+
+  Each config is copied with 'visible_gpus' set to the comma delimited GPU
+  ids it was given, which BuildDistributedCommandWorker turns into
+  CUDA_VISIBLE_DEVICES. Set 'exclusive_gpus: True' in a config that needs
+  the host's PCIe/NVLink bandwidth to itself.
+
+  Args:
+    run_configs: configs for which IsSingleHost is True.
+    run_fn: function taking the run config with 'visible_gpus' set.
+    num_gpus: number of GPUs on the host.
+
+  returns list of the configs whose run_fn raised an exception.
+
+  """
+
+  def Run(run_config, gpu_ids):
+    run_config = run_config.copy()
+    run_config['visible_gpus'] = ','.join(str(i) for i in gpu_ids)
+    run_fn(run_config)
+
+  return RunPacked(
+      run_configs,
+      ResourcePool(num_gpus),
+      _GpuCount,
+      Run,
+      exclusive_fn=_NeedsWholeHost)
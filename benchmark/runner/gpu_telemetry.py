@@ -0,0 +1,166 @@
+"""Samples GPU telemetry on a host and lines it up with step timings.
+
+nvidia-smi runs on the host in its own query loop and streams one CSV line
+per GPU per interval back over the ssh channel, so each sample is a few
+dozen bytes instead of a full `nvidia-smi -q` dump. Samples are kept in a
+fixed size ring buffer on the runner and timestamped on arrival, on the same
+clock as throughput.StepRecord.
+"""
+import collections
+import time
+import uuid
+
+import numpy
+
+import throughput
+
+QUERY_FIELDS = [
+    'index', 'utilization.gpu', 'clocks.sm', 'temperature.gpu', 'power.draw',
+    'clocks_throttle_reasons.hw_slowdown'
+]
+
+GpuSample = collections.namedtuple('GpuSample', [
+    'timestamp', 'batch', 'gpu', 'utilization', 'sm_clock', 'temperature',
+    'power', 'hw_slowdown'
+])
+
+def SamplerCommand(interval_ms=1000, nvidia_smi='nvidia-smi'):
+  """Returns the command that streams telemetry every interval_ms."""
+  return '{} --query-gpu={} --format=csv,noheader,nounits -lms {}'.format(
+      nvidia_smi, ','.join(QUERY_FIELDS), interval_ms)
+
+
+def _Number(value):
+  try:
+    return float(value)
+  except ValueError:
+    # [N/A] or [Not Supported] on some boards.
+    return None
+
+
+class GpuTelemetry(object):
+  """Line extractor that keeps the latest GPU samples of one host.
+
+  Args:
+    host: host the samples come from.
+    capacity: number of samples kept, one per GPU per interval.
+    line_extractor: optional extractor each line is forwarded to.
+
+  """
+
+  def __init__(self, host=None, capacity=8 * 3600, line_extractor=None):
+    self.host = host
+    self.samples = collections.deque(maxlen=capacity)
+    self.line_extractor = line_extractor
+    self._batch = 0
+    self._last_gpu = None
+    # Written on the host with the pid of the sampler Start ran.
+    self.pid_file = '/tmp/gpu_telemetry_{}.pid'.format(uuid.uuid4().hex[:16])
+
+  def __call__(self, line):
+    fields = [f.strip() for f in line.split(',')]
+    if len(fields) == len(QUERY_FIELDS) and fields[0].isdigit():
+      gpu = int(fields[0])
+      # nvidia-smi lists the GPUs in order every interval.
+      if self._last_gpu is not None and gpu <= self._last_gpu:
+        self._batch += 1
+      self._last_gpu = gpu
+      self.samples.append(
+          GpuSample(
+              timestamp=time.time(),
+              batch=self._batch,
+              gpu=gpu,
+              utilization=_Number(fields[1]),
+              sm_clock=_Number(fields[2]),
+              temperature=_Number(fields[3]),
+              power=_Number(fields[4]),
+              hw_slowdown=fields[5] == 'Active'))
+    if self.line_extractor:
+      self.line_extractor(line)
+
+  def Start(self, instance, log_file=None, interval_ms=1000,
+            nvidia_smi='nvidia-smi'):
+    """Starts sampling on instance, returns the streaming thread.
+
+    Args:
+      instance: AWSInstance or cluster_local.LocalInstance to sample.
+      log_file: optional local file the raw samples are written to.
+      interval_ms: milliseconds between samples.
+      nvidia_smi: nvidia-smi binary on the host.
+
+    """
+    return instance.ExecuteCommandInThread(
+        'echo $$ > {}; exec {}'.format(self.pid_file,
+                                       SamplerCommand(interval_ms, nvidia_smi)),
+        stdout_file=log_file,
+        line_extractor=self)
+
+  def Stop(self, instance):
+    """Stops the sampler Start ran on instance, leaving any other alone."""
+    instance.ExecuteCommandAndWait(
+        'test -f {0} && kill $(cat {0}); rm -f {0}'.format(self.pid_file))
+
+  def Series(self):
+    """Returns the samples as a dict of numpy columns."""
+    samples = list(self.samples)
+    series = {}
+    for i, field in enumerate(GpuSample._fields):
+      series[field] = numpy.array(
+          [numpy.nan if s[i] is None else s[i] for s in samples],
+          dtype=numpy.float64)
+    return series
+
+  def MaxThrottledGpus(self):
+    """Returns the most GPUs with HW Slowdown active in one interval."""
+    series = self.Series()
+    if not len(series['batch']):
+      return 0
+    batches = series['batch'].astype(numpy.int64)
+    return int(numpy.bincount(batches, weights=series['hw_slowdown']).max())
+
+
+def CorrelateWithSteps(telemetry, records):
+  """Joins GPU samples with the step records of a worker on the same host.
+
+  Each step interval (previous record, record] is matched with the samples
+  that arrived during it and gets the images/sec of its own steps, see
+  throughput.IntervalRate.
+
+  Args:
+    telemetry: GpuTelemetry of the host.
+    records: throughput.StepRecord list of one task, in step order.
+
+  returns dict with one entry per interval in 'intervals' and the mean
+  images/sec of intervals with and without throttled GPUs.
+
+  """
+  series = telemetry.Series()
+  timestamps = series['timestamp']
+  intervals = []
+  for prev, record in zip(records, records[1:]):
+    start = numpy.searchsorted(timestamps, prev.timestamp, side='right')
+    end = numpy.searchsorted(timestamps, record.timestamp, side='right')
+    throttled = series['gpu'][start:end][series['hw_slowdown'][start:end] > 0]
+    clocks = series['sm_clock'][start:end]
+    intervals.append({
+        'step': record.step,
+        'images_per_sec': throughput.IntervalRate(
+            record.step, record.images_per_sec, prev.step,
+            prev.images_per_sec),
+        'throttled_gpus': len(numpy.unique(throttled)),
+        'sm_clock_mean': float(numpy.nanmean(clocks)) if end > start else None,
+    })
+
+  def Mean(throttled):
+    values = [
+        i['images_per_sec'] for i in intervals
+        if bool(i['throttled_gpus']) == throttled and
+        i['images_per_sec'] is not None
+    ]
+    return float(numpy.mean(values)) if values else None
+
+  return {
+      'intervals': intervals,
+      'images_per_sec_throttled': Mean(True),
+      'images_per_sec_unthrottled': Mean(False),
+  }
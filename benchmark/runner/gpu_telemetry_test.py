@@ -0,0 +1,105 @@
+"""Tests GpuTelemetry against a fake nvidia-smi on a local instance.
+
+Run from benchmark/runner with:
+
+  python -m unittest discover -p '*_test.py'
+"""
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+import numpy
+
+import cluster_local
+import gpu_telemetry
+import throughput
+
+# Two intervals of a 2 GPU host, GPU 1 throttled in the second one.
+_FAKE_NVIDIA_SMI = """#!/bin/sh
+echo '0, 97, 1530, 61, 250.12, Not Active'
+echo '1, 95, 1530, 63, 248.50, Not Active'
+echo '0, 96, 1530, 62, 251.00, Not Active'
+echo '1, 40, 1005, 85, [N/A], Active'
+"""
+
+
+class GpuTelemetryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp()
+    self.nvidia_smi = os.path.join(self.work_dir, 'nvidia-smi')
+    with open(self.nvidia_smi, 'w') as f:
+      f.write(_FAKE_NVIDIA_SMI)
+    os.chmod(self.nvidia_smi, stat.S_IRWXU)
+    self.instance = cluster_local.LocalInstance(work_dir=self.work_dir)
+    self.log_file = os.path.join(self.work_dir, 'gpu.log')
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+
+  def testCollectsSamplesFromStream(self):
+    telemetry = gpu_telemetry.GpuTelemetry(host='localhost')
+    telemetry.Start(
+        self.instance, self.log_file, nvidia_smi=self.nvidia_smi).join()
+
+    self.assertEqual(4, len(telemetry.samples))
+    series = telemetry.Series()
+    self.assertEqual([0, 0, 1, 1], series['batch'].tolist())
+    self.assertEqual([0, 1, 0, 1], series['gpu'].tolist())
+    self.assertTrue(numpy.isnan(series['power'][3]))
+    self.assertEqual(1, telemetry.MaxThrottledGpus())
+    with open(self.log_file) as f:
+      self.assertIn('Active', f.read())
+
+  def testStreamsWithoutLogFile(self):
+    telemetry = gpu_telemetry.GpuTelemetry()
+    telemetry.Start(self.instance, nvidia_smi=self.nvidia_smi).join()
+
+    self.assertEqual(4, len(telemetry.samples))
+    self.assertFalse(os.path.exists(self.log_file))
+
+  def testStopKillsOnlyItsOwnSampler(self):
+    with open(self.nvidia_smi, 'w') as f:
+      f.write('#!/bin/sh\nwhile true; do echo \'0, 97, 1530, 61, 250, '
+              'Not Active\'; sleep 0.05; done\n')
+    stopped = gpu_telemetry.GpuTelemetry()
+    running = gpu_telemetry.GpuTelemetry()
+    threads = [
+        t.Start(self.instance, nvidia_smi=self.nvidia_smi)
+        for t in (stopped, running)
+    ]
+    while not (os.path.exists(stopped.pid_file) and running.samples):
+      time.sleep(0.05)
+
+    stopped.Stop(self.instance)
+    threads[0].join(5)
+    self.assertFalse(threads[0].is_alive())
+    self.assertTrue(threads[1].is_alive())
+    running.Stop(self.instance)
+    threads[1].join(5)
+    self.assertFalse(threads[1].is_alive())
+
+  def testCorrelatesIntervalsWithThrottling(self):
+    telemetry = gpu_telemetry.GpuTelemetry()
+    for t, line in [(1.0, '0, 97, 1530, 61, 250, Not Active'),
+                    (2.0, '0, 50, 1005, 85, 250, Active')]:
+      telemetry(line)
+      telemetry.samples[-1] = telemetry.samples[-1]._replace(timestamp=t)
+    # Steps 11-20 run at 200 images/sec and steps 21-30 at 100.
+    records = [
+        throughput.StepRecord(s, ips, 0.1, 0.5, None, None, 0, t)
+        for s, ips, t in [(10, 200.0, 0.5), (20, 200.0, 1.5), (30, 150.0, 2.5)]
+    ]
+
+    joined = gpu_telemetry.CorrelateWithSteps(telemetry, records)
+
+    self.assertEqual([0, 1], [i['throttled_gpus'] for i in joined['intervals']])
+    self.assertAlmostEqual(100.0, joined['images_per_sec_throttled'])
+    self.assertAlmostEqual(200.0, joined['images_per_sec_unthrottled'])
+
+
+if __name__ == '__main__':
+  unittest.main()
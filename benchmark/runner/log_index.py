@@ -0,0 +1,236 @@
+"""Indexes the run logs under a log folder for fast searches.
+
+Every log is scanned once for the command line util._StreamOutputToFile
+writes first, the error lines util.ExtractErrorToConsole prints and the
+images/sec lines. Only the line offsets are kept, in log_index.json in the
+log folder, and files are only scanned again when their size or mtime
+changed. Searches read the matching lines through mmap, e.g. socket errors
+of non-chief tasks over the last 30 days:
+
+  python log_index.py --log_folder results --kind error \\
+      --grep 'E tensorflow.*[Ss]ocket' --nonzero_task --since_days 30
+"""
+import argparse
+import gzip
+import json
+import mmap
+import os
+import re
+import sys
+import time
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+import result_store
+import tracing
+
+INDEX_FILE = 'log_index.json'
+# Bumped when the entries change, which re-indexes every file.
+_INDEX_VERSION = 1
+
+# Lines util.ExtractErrorToConsole treats as errors.
+_ERROR_LINE = re.compile(br'^(?:E|[^\n]*E tensorflow)[^\n]*', re.M)
+_IMAGES_LINE = re.compile(br'^[^\n]*images/sec:', re.M)
+KINDS = ('error', 'images')
+
+# Output of the other runner tools that lives in the log folder.
+_SKIP_DIRS = (result_store.STORE_DIR, 'report')
+_SKIP_SUFFIXES = ('.json', '.jsonl', '.npz', '.tar.gz', '.part', '.md',
+                  '.csv', '.html', '.tmp')
+
+
+def _ReadBuffer(path):
+  """Returns the content of a log, mmapped unless it is compressed.
+
+  Compressed logs cannot be mapped, they are decompressed in memory and
+  their offsets refer to the decompressed content.
+
+  """
+  if path.endswith('.gz'):
+    with gzip.open(path, 'rb') as f:
+      return f.read()
+  if path.endswith('.zst'):
+    if zstandard is None:
+      raise IOError('zstandard is needed to read ' + path)
+    with open(path, 'rb') as f:
+      reader = zstandard.ZstdDecompressor().stream_reader(
+          f, read_across_frames=True)
+      return reader.read()
+  with open(path, 'rb') as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _Line(buf, offset):
+  end = buf.find(b'\n', offset)
+  return buf[offset:end if end != -1 else len(buf)].decode('utf-8', 'ignore')
+
+
+def IndexFile(path):
+  """Returns the index entry of one log."""
+  stat = os.stat(path)
+  buf = _ReadBuffer(path)
+  try:
+    command = _Line(buf, 0) if len(buf) else ''
+    job_name, task_index = tracing.TaskFromCommand(command)
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'command': command,
+        'job_name': job_name,
+        'task_index': task_index,
+        'error': [m.start() for m in _ERROR_LINE.finditer(buf)],
+        'images': [m.start() for m in _IMAGES_LINE.finditer(buf)],
+    }
+  finally:
+    if isinstance(buf, mmap.mmap):
+      buf.close()
+
+
+def _LogFiles(log_folder):
+  for root, dirs, files in os.walk(log_folder):
+    dirs[:] = [d for d in dirs
+               if os.path.relpath(os.path.join(root, d), log_folder)
+               not in _SKIP_DIRS]
+    for name in files:
+      if name != INDEX_FILE and not name.endswith(_SKIP_SUFFIXES):
+        yield os.path.join(root, name)
+
+
+class LogIndex(object):
+  """Offsets of the interesting lines of every log under log_folder.
+
+  Args:
+    log_folder: folder the runs write their logs to.
+    index_path: index file, defaults to log_index.json in log_folder.
+
+  """
+
+  def __init__(self, log_folder, index_path=None):
+    self.log_folder = log_folder
+    self.index_path = index_path or os.path.join(log_folder, INDEX_FILE)
+    self.files = {}
+    if os.path.exists(self.index_path):
+      with open(self.index_path) as f:
+        index = json.load(f)
+      if index.get('version') == _INDEX_VERSION:
+        self.files = index['files']
+
+  def Update(self):
+    """Indexes new and changed logs and drops deleted ones.
+
+    returns (number of files indexed, number unchanged).
+
+    """
+    seen = set()
+    indexed = unchanged = 0
+    for path in _LogFiles(self.log_folder):
+      rel = os.path.relpath(path, self.log_folder)
+      seen.add(rel)
+      stat = os.stat(path)
+      entry = self.files.get(rel)
+      if (entry and entry['size'] == stat.st_size and
+          entry['mtime'] == stat.st_mtime):
+        unchanged += 1
+        continue
+      try:
+        self.files[rel] = IndexFile(path)
+        indexed += 1
+      except (IOError, OSError, EOFError) as e:
+        # Usually a compressed log still being written.
+        print('Could not index {}:{}'.format(path, e))
+    for rel in set(self.files) - seen:
+      del self.files[rel]
+    return indexed, unchanged
+
+  def Save(self):
+    tmp_path = self.index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump({'version': _INDEX_VERSION, 'files': self.files}, f)
+    os.rename(tmp_path, self.index_path)
+
+  def Search(self,
+             kind='error',
+             pattern=None,
+             job_name=None,
+             task_index=None,
+             nonzero_task=False,
+             since=None):
+    """Yields (path, offset, line) of the indexed lines matching the filters.
+
+    Args:
+      kind: 'error' or 'images'.
+      pattern: optional regular expression the line has to contain.
+      job_name: only logs of this job, e.g. 'worker' or 'ps'.
+      task_index: only logs of this task index.
+      nonzero_task: only logs with a task index other than 0.
+      since: only logs modified at or after this time.time() value.
+
+    """
+    if kind not in KINDS:
+      raise ValueError('Unknown kind {}, expected one of {}'.format(
+          kind, KINDS))
+    regex = re.compile(pattern) if pattern else None
+    for rel, entry in sorted(self.files.items()):
+      if not entry[kind]:
+        continue
+      if job_name is not None and entry['job_name'] != job_name:
+        continue
+      if task_index is not None and entry['task_index'] != task_index:
+        continue
+      if nonzero_task and not entry['task_index']:
+        continue
+      if since is not None and entry['mtime'] < since:
+        continue
+      path = os.path.join(self.log_folder, rel)
+      buf = _ReadBuffer(path)
+      try:
+        for offset in entry[kind]:
+          line = _Line(buf, offset)
+          if regex is None or regex.search(line):
+            yield path, offset, line
+      finally:
+        if isinstance(buf, mmap.mmap):
+          buf.close()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument('--log_folder', default='results')
+  parser.add_argument('--kind', default='error', choices=KINDS)
+  parser.add_argument('--grep', default=None, help='Regular expression.')
+  parser.add_argument('--job_name', default=None)
+  parser.add_argument('--task_index', type=int, default=None)
+  parser.add_argument('--nonzero_task', action='store_true')
+  parser.add_argument('--since_days', type=float, default=None)
+  args = parser.parse_args(argv)
+
+  index = LogIndex(args.log_folder)
+  indexed, unchanged = index.Update()
+  index.Save()
+  print('Indexed {} logs, {} unchanged'.format(indexed, unchanged))
+
+  since = None
+  if args.since_days is not None:
+    since = time.time() - args.since_days * 24 * 3600
+  matches = 0
+  for path, _, line in index.Search(
+      kind=args.kind,
+      pattern=args.grep,
+      job_name=args.job_name,
+      task_index=args.task_index,
+      nonzero_task=args.nonzero_task,
+      since=since):
+    matches += 1
+    print('{}: {}'.format(path, line))
+  print('{} matching lines'.format(matches))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
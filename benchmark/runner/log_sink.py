@@ -0,0 +1,149 @@
+"""Buffered, optionally compressed log files for streamed command output."""
+import atexit
+import gzip
+import io
+import threading
+import time
+import weakref
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+COMPRESSION_SUFFIX = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+# How often the background thread looks for sinks with stale buffers.
+_FLUSHER_INTERVAL = 0.5
+
+_open_sinks = weakref.WeakSet()
+_open_sinks_lock = threading.Lock()
+_flusher = None
+
+
+def _GzipFrame(data):
+  buf = io.BytesIO()
+  with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+    f.write(data)
+  return buf.getvalue()
+
+
+def _ZstdFrame(data):
+  return zstandard.ZstdCompressor().compress(data)
+
+
+_FRAMERS = {None: lambda data: data, 'gzip': _GzipFrame, 'zstd': _ZstdFrame}
+
+
+def _FlushStaleSinks():
+  while True:
+    time.sleep(_FLUSHER_INTERVAL)
+    with _open_sinks_lock:
+      sinks = list(_open_sinks)
+    for sink in sinks:
+      sink.FlushIfStale()
+
+
+def _StartFlusher():
+  """Starts the one background thread that flushes idle sinks."""
+  global _flusher
+  with _open_sinks_lock:
+    if _flusher is None:
+      _flusher = threading.Thread(target=_FlushStaleSinks)
+      _flusher.daemon = True
+      _flusher.start()
+
+
+@atexit.register
+def _CloseOpenSinks():
+  with _open_sinks_lock:
+    sinks = list(_open_sinks)
+  for sink in sinks:
+    sink.Close()
+
+
+class LogSink(object):
+  """Append-only log file that batches writes.
+
+  Data is buffered in memory and written when `flush_bytes` are pending or the
+  oldest pending data is `flush_secs` old. A single daemon thread flushes
+  sinks whose stream went quiet, and open sinks are closed at interpreter
+  exit so the tail of a log is not lost.
+
+  With compression each flush is written as a complete gzip member or zstd
+  frame. Concatenated members/frames are valid files, so a log is readable
+  with zcat/zstdcat up to the last flush even if the runner is killed.
+
+  Args:
+    path: file to append to, the compression suffix is added to it.
+    compression: None, 'gzip' or 'zstd' (requires the zstandard package).
+    flush_bytes: buffered bytes that trigger a write.
+    flush_secs: maximum seconds data stays buffered.
+
+  """
+
+  def __init__(self, path, compression=None, flush_bytes=64 * 1024,
+               flush_secs=1.0):
+    if compression not in _FRAMERS:
+      raise ValueError('Unknown log compression:{}'.format(compression))
+    if compression == 'zstd' and zstandard is None:
+      raise ValueError('zstd log compression requires the zstandard package')
+    self.path = path + COMPRESSION_SUFFIX[compression]
+    self.flush_bytes = flush_bytes
+    self.flush_secs = flush_secs
+    self._frame = _FRAMERS[compression]
+    self._file = open(self.path, 'ab')
+    self._buffer = []
+    self._buffered = 0
+    self._oldest = None
+    self._lock = threading.Lock()
+    with _open_sinks_lock:
+      _open_sinks.add(self)
+    _StartFlusher()
+
+  def Write(self, data):
+    with self._lock:
+      if self._file is None:
+        raise ValueError('Write to closed log sink {}'.format(self.path))
+      if not self._buffer:
+        self._oldest = time.time()
+      self._buffer.append(data)
+      self._buffered += len(data)
+      if (self._buffered >= self.flush_bytes or
+          time.time() - self._oldest >= self.flush_secs):
+        self._Flush()
+
+  def _Flush(self):
+    if not self._buffer or self._file is None:
+      return
+    self._file.write(self._frame(b''.join(self._buffer)))
+    self._file.flush()
+    self._buffer = []
+    self._buffered = 0
+    self._oldest = None
+
+  def Flush(self):
+    with self._lock:
+      self._Flush()
+
+  def FlushIfStale(self):
+    with self._lock:
+      if self._oldest is not None and (
+          time.time() - self._oldest >= self.flush_secs):
+        self._Flush()
+
+  def Close(self):
+    with self._lock:
+      if self._file is None:
+        return
+      self._Flush()
+      self._file.close()
+      self._file = None
+    with _open_sinks_lock:
+      _open_sinks.discard(self)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self.Close()
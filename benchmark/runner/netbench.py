@@ -0,0 +1,283 @@
+"""Measures TCP bandwidth and latency between all pairs of cluster hosts.
+
+A small agent is uploaded to every host and started as a server. Pairs are
+then measured in the rounds of a round-robin tournament, so a host is never
+part of two measurements at once, and at most max_pairs pairs run at the
+same time so concurrent transfers do not skew each other through shared
+links. The matrix is stored with the run results and orders hosts so that
+parameter servers land on the best connected ones.
+"""
+import json
+import os
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+AGENT_FILE = 'tf_netbench.py'
+NETBENCH_PORT = 50100
+
+# Runs on the hosts, with python 2 or 3.
+_AGENT = r'''
+import json, socket, sys, threading, time
+
+CHUNK = 1 << 16
+
+
+def RecvExactly(conn, size):
+  data = b''
+  while len(data) < size:
+    more = conn.recv(size - len(data))
+    if not more:
+      break
+    data += more
+  return data
+
+
+def Handle(conn):
+  mode = conn.recv(1)
+  if mode == b'p':
+    while True:
+      data = conn.recv(64)
+      if not data:
+        break
+      conn.sendall(data)
+  elif mode == b'b':
+    total = 0
+    while True:
+      data = conn.recv(CHUNK)
+      if not data:
+        break
+      total += len(data)
+    conn.sendall(str(total).encode('ascii'))
+  conn.close()
+
+
+def Serve(port, lifetime):
+  server = socket.socket()
+  server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  server.bind(('', port))
+  server.listen(16)
+  deadline = time.time() + lifetime
+  while time.time() < deadline:
+    server.settimeout(max(deadline - time.time(), 0.1))
+    try:
+      conn, _ = server.accept()
+    except socket.timeout:
+      break
+    conn.settimeout(None)
+    t = threading.Thread(target=Handle, args=(conn,))
+    t.daemon = True
+    t.start()
+
+
+def Connect(host, port, mode):
+  deadline = time.time() + 30
+  while True:
+    try:
+      conn = socket.create_connection((host, port), timeout=30)
+      break
+    except socket.error:
+      # The server may still be starting.
+      if time.time() > deadline:
+        raise
+      time.sleep(0.2)
+  conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  conn.sendall(mode)
+  return conn
+
+
+def Client(host, port, seconds, pings):
+  conn = Connect(host, port, b'p')
+  rtts = []
+  for _ in range(pings):
+    start = time.time()
+    conn.sendall(b'12345678')
+    RecvExactly(conn, 8)
+    rtts.append(time.time() - start)
+  conn.close()
+
+  conn = Connect(host, port, b'b')
+  buf = b'\0' * CHUNK
+  start = time.time()
+  while time.time() - start < seconds:
+    conn.sendall(buf)
+  conn.shutdown(socket.SHUT_WR)
+  # Timed until the server confirms what it received.
+  received = int(RecvExactly(conn, 32) or 0)
+  elapsed = time.time() - start
+  conn.close()
+  rtts.sort()
+  print(json.dumps({
+      'gbps': received * 8 / elapsed / 1e9,
+      'rtt_ms': rtts[len(rtts) // 2] * 1e3 if rtts else None,
+  }))
+
+
+if __name__ == '__main__':
+  if sys.argv[1] == 'server':
+    Serve(int(sys.argv[2]), float(sys.argv[3]))
+  else:
+    Client(sys.argv[2], int(sys.argv[3]), float(sys.argv[4]), int(sys.argv[5]))
+'''
+
+
+def TournamentRounds(num_hosts):
+  """Returns rounds of disjoint (i, j) pairs covering every pair once."""
+  players = list(range(num_hosts))
+  if num_hosts % 2:
+    players.append(None)
+  rounds = []
+  for _ in range(len(players) - 1):
+    half = len(players) // 2
+    pairs = list(zip(players[:half], reversed(players[half:])))
+    rounds.append([p for p in pairs if None not in p])
+    # Circle method: the first player stays, the others rotate.
+    players = [players[0], players[-1]] + players[1:-1]
+  return rounds
+
+
+def _Port(instance):
+  return NETBENCH_PORT + getattr(instance, 'port_offset', 0)
+
+
+def _Measure(src, dst, seconds, pings, python):
+  cmd = '{} {} client {} {} {} {}'.format(python, AGENT_FILE, dst.private_ip,
+                                          _Port(dst), seconds, pings)
+  output = src.ExecuteCommandAndReturnStdout(cmd)
+  if isinstance(output, bytes):
+    output = output.decode('utf-8', 'ignore')
+  for line in reversed(output.splitlines()):
+    if line.startswith('{'):
+      return json.loads(line)
+  print('Network benchmark {} -> {} failed:{}'.format(
+      src.instance_id, dst.instance_id, output.strip()))
+  return {'gbps': None, 'rtt_ms': None}
+
+
+def MeasureMatrix(instances, seconds=3, pings=20, max_pairs=4,
+                  python='python'):
+  """Measures bandwidth and round trip time between all instance pairs.
+
+  Args:
+    instances: fleet to measure, AWSInstance or cluster_local.LocalInstance.
+    seconds: duration of each one way bandwidth measurement.
+    pings: round trips whose median is the latency.
+    max_pairs: pairs measured at the same time.
+    python: python binary on the hosts.
+
+  returns dict with 'instance_ids' and the 'gbps' and 'rtt_ms' matrices,
+  where [i][j] was measured from instances[i] to instances[j].
+
+  """
+  n = len(instances)
+  matrix = {
+      'instance_ids': [i.instance_id for i in instances],
+      'gbps': [[None] * n for _ in range(n)],
+      'rtt_ms': [[None] * n for _ in range(n)],
+  }
+  if n < 2:
+    return matrix
+
+  fd, agent = tempfile.mkstemp(suffix='.py')
+  with os.fdopen(fd, 'w') as f:
+    f.write(_AGENT)
+  pool = ThreadPool(max(n, max_pairs))
+  try:
+    pool.map(lambda i: i.UploadFile(agent, AGENT_FILE), instances)
+    # Generous lifetime, the servers exit on their own after it.
+    lifetime = len(TournamentRounds(n)) * 2 * (seconds + 5) + 60
+    pool.map(lambda i: i.ExecuteCommandAndWait(
+        'nohup {} {} server {} {} >/dev/null 2>&1 &'.format(
+            python, AGENT_FILE, _Port(i), lifetime)), instances)
+
+    def MeasurePair(pair):
+      a, b = pair
+      for i, j in ((a, b), (b, a)):
+        result = _Measure(instances[i], instances[j], seconds, pings, python)
+        matrix['gbps'][i][j] = result['gbps']
+        matrix['rtt_ms'][i][j] = result['rtt_ms']
+
+    for pairs in TournamentRounds(n):
+      for start in range(0, len(pairs), max_pairs):
+        pool.map(MeasurePair, pairs[start:start + max_pairs])
+  finally:
+    pool.map(lambda i: i.ExecuteCommandAndWait(
+        'pkill -f "[t]f_netbench.py server {}"'.format(_Port(i))), instances)
+    pool.close()
+    os.remove(agent)
+  return matrix
+
+
+def _Mean(values):
+  values = [v for v in values if v is not None]
+  return sum(values) / len(values) if values else 0.0
+
+
+def HostScores(matrix, instance_ids=None):
+  """Returns {instance_id: (mean gbps in and out, -mean rtt_ms)}.
+
+  Only the links between instances in instance_ids, by default all of the
+  matrix, are scored, so a partition is ordered by how well its members are
+  connected to each other rather than to the rest of the fleet.
+
+  """
+  ids = matrix['instance_ids']
+  if instance_ids is not None:
+    instance_ids = set(instance_ids)
+  members = [
+      i for i, instance_id in enumerate(ids)
+      if instance_ids is None or instance_id in instance_ids
+  ]
+  scores = {}
+  for i in members:
+    instance_id = ids[i]
+    others = [j for j in members if j != i]
+    gbps = _Mean([matrix['gbps'][i][j] for j in others] +
+                 [matrix['gbps'][j][i] for j in others])
+    rtt = _Mean([matrix['rtt_ms'][i][j] for j in others] +
+                [matrix['rtt_ms'][j][i] for j in others])
+    scores[instance_id] = (gbps, -rtt)
+  return scores
+
+
+def PlacementOrder(instances, matrix):
+  """Orders instances best connected first.
+
+  cluster_partition.BuildHostStrings puts ps i on instances[i], so the
+  parameter servers, which exchange data with every worker, get the hosts
+  with the most bandwidth. Instances missing from matrix go last. Pass
+  lambda p: PlacementOrder(p, matrix) as host_order of
+  cluster_partition.RunPartitioned, or run it with measure_network=True.
+
+  """
+  scores = HostScores(matrix, [i.instance_id for i in instances])
+  return sorted(
+      instances,
+      key=lambda i: scores.get(i.instance_id, (float('-inf'), 0)),
+      reverse=True)
+
+
+def SubMatrix(matrix, instance_ids):
+  """Returns the part of matrix between the instances in instance_ids."""
+  index = dict((instance_id, i)
+               for i, instance_id in enumerate(matrix['instance_ids']))
+  rows = [index[i] for i in instance_ids if i in index]
+  return {
+      'instance_ids': [matrix['instance_ids'][i] for i in rows],
+      'gbps': [[matrix['gbps'][i][j] for j in rows] for i in rows],
+      'rtt_ms': [[matrix['rtt_ms'][i][j] for j in rows] for i in rows],
+  }
+
+
+def AttachNetworkMatrix(run_config, matrix):
+  """Records the network matrix in the run config.
+
+  result_store.ResultStore.Commit keeps it in the 'extras' of the run.
+
+  """
+  run_config['network'] = matrix
+  return run_config
+
+
+def WriteMatrix(path, matrix):
+  with open(path, 'w') as f:
+    json.dump(matrix, f, indent=2, sort_keys=True)
@@ -0,0 +1,126 @@
+"""Tests netbench over loopback with local instances.
+
+Run from benchmark/runner with:
+
+  python -m unittest discover -p '*_test.py'
+"""
+import shutil
+import sys
+import tempfile
+import unittest
+
+import cluster_local
+import cluster_partition
+import netbench
+
+
+# local-40 is best connected to local-41 and local-42, while local-42 has by
+# far the fastest link of the fleet, to local-43.
+def _FleetMatrix():
+  gbps = {(0, 1): 5.0, (0, 2): 5.0, (2, 3): 100.0}
+  return {
+      'instance_ids': ['local-40', 'local-41', 'local-42', 'local-43'],
+      'gbps': [[None if i == j else gbps.get((min(i, j), max(i, j)), 1.0)
+                for j in range(4)] for i in range(4)],
+      'rtt_ms': [[None if i == j else 1.0 for j in range(4)]
+                 for i in range(4)],
+  }
+
+
+class TournamentRoundsTest(unittest.TestCase):
+
+  def testEveryPairOnceAndHostsOncePerRound(self):
+    for n in (2, 3, 6, 7):
+      rounds = netbench.TournamentRounds(n)
+      pairs = [tuple(sorted(p)) for r in rounds for p in r]
+      self.assertEqual(n * (n - 1) // 2, len(set(pairs)))
+      self.assertEqual(len(pairs), len(set(pairs)))
+      for r in rounds:
+        hosts = [h for p in r for h in p]
+        self.assertEqual(len(hosts), len(set(hosts)))
+
+
+class MeasureMatrixTest(unittest.TestCase):
+
+  def setUp(self):
+    self.work_dirs = []
+    self.instances = []
+    # High indices keep the agent ports clear of runs on this machine.
+    for index in range(40, 43):
+      work_dir = tempfile.mkdtemp()
+      self.work_dirs.append(work_dir)
+      self.instances.append(
+          cluster_local.LocalInstance(index=index, work_dir=work_dir))
+
+  def tearDown(self):
+    for work_dir in self.work_dirs:
+      shutil.rmtree(work_dir)
+
+  def testMeasuresAllPairsOverLoopback(self):
+    matrix = netbench.MeasureMatrix(
+        self.instances, seconds=0.2, pings=3, max_pairs=2,
+        python=sys.executable)
+
+    self.assertEqual(['local-40', 'local-41', 'local-42'],
+                     matrix['instance_ids'])
+    for i in range(3):
+      for j in range(3):
+        if i == j:
+          self.assertIsNone(matrix['gbps'][i][j])
+          continue
+        self.assertGreater(matrix['gbps'][i][j], 0)
+        self.assertGreater(matrix['rtt_ms'][i][j], 0)
+
+  def testPlacementOrderPutsBestConnectedHostFirst(self):
+    matrix = {
+        'instance_ids': ['local-40', 'local-41', 'local-42'],
+        'gbps': [[None, 1.0, 1.0], [9.0, None, 9.0], [1.0, 9.0, None]],
+        'rtt_ms': [[None, 1.0, 1.0], [1.0, None, 1.0], [1.0, 1.0, None]],
+    }
+    ordered = netbench.PlacementOrder(self.instances, matrix)
+    self.assertEqual('local-41', ordered[0].instance_id)
+    self.assertEqual('local-40', ordered[-1].instance_id)
+
+  def testPlacementOrderScoresLinksWithinThePartition(self):
+    matrix = _FleetMatrix()
+    self.assertEqual('local-42', max(
+        netbench.HostScores(matrix).items(), key=lambda s: s[1])[0])
+
+    ordered = netbench.PlacementOrder(self.instances, matrix)
+    self.assertEqual('local-40', ordered[0].instance_id)
+
+  def testRunPartitionedPlacesPsOnMeasuredNetwork(self):
+    instances = self.instances + [cluster_local.LocalInstance(index=43)]
+    measured = []
+
+    def FakeMeasureMatrix(fleet):
+      measured.append([i.instance_id for i in fleet])
+      return _FleetMatrix()
+
+    runs = []
+
+    def Run(run_config, partition, worker_hosts, ps_hosts):
+      runs.append((run_config, [i.instance_id for i in partition], ps_hosts))
+
+    original = netbench.MeasureMatrix
+    netbench.MeasureMatrix = FakeMeasureMatrix
+    try:
+      failed = cluster_partition.RunPartitioned(
+          [{'name': 'ps', 'workers': 3, 'ps_servers': 1}], instances, Run,
+          measure_network=True)
+    finally:
+      netbench.MeasureMatrix = original
+
+    self.assertEqual([], failed)
+    self.assertEqual([['local-40', 'local-41', 'local-42', 'local-43']],
+                     measured)
+    run_config, partition, ps_hosts = runs[0]
+    self.assertEqual('local-40', partition[0])
+    self.assertEqual('127.0.0.1:{}'.format(cluster_partition.PS_PORT + 80),
+                     ps_hosts)
+    self.assertEqual(partition, run_config['network']['instance_ids'])
+    self.assertEqual(5.0, run_config['network']['gbps'][0][1])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,200 @@
+"""Checks the health of every instance of a fleet before a sweep starts.
+
+All instances are checked at the same time with one remote command each:
+GPU count, driver and CUDA visibility, free disk and memory, the data_dir
+of the configs and the ps/worker ports. Failing hosts are dropped or
+quarantined, and optionally replaced, before any expensive config runs.
+"""
+import pipes
+from multiprocessing.pool import ThreadPool
+
+import cluster_partition
+
+# Order of the columns of the printed matrix.
+CHECKS = ('reachable', 'gpus', 'driver', 'cuda', 'disk_gb', 'memory_gb',
+          'data_dir', 'ports')
+
+# Prints key=value lines parsed by _ParseProbe.
+_PROBE = '; '.join([
+    'echo gpus=$(nvidia-smi --query-gpu=name --format=csv,noheader '
+    '2>/dev/null | wc -l)',
+    'echo driver=$(nvidia-smi --query-gpu=driver_version '
+    '--format=csv,noheader 2>/dev/null | head -1)',
+    'echo cuda=$(nvidia-smi 2>/dev/null | grep -o "CUDA Version: [0-9.]*" '
+    '| cut -d" " -f3)',
+    'echo disk_kb=$(df -Pk . | tail -1 | awk \'{{print $4}}\')',
+    'echo memory_kb=$(awk \'/MemAvailable/ {{print $2}}\' /proc/meminfo)',
+    'for d in {data_dirs}; do test -d "$d" && echo data_dir="$d"; done',
+    'for p in {ports}; do ss -ltn 2>/dev/null | grep -q ":$p " && '
+    'echo busy_port=$p; done',
+    'true',
+])
+
+
+def Requirements(run_configs, min_disk_gb=20, min_memory_gb=8):
+  """Returns what the instances need to run every one of run_configs.
+
+  run_configs has to be a list or tuple. A generator such as
+  LoadYamlRunConfig would be used up here and the sweep would run nothing.
+
+  """
+  if not isinstance(run_configs, (list, tuple)):
+    raise TypeError('run_configs must be a list, e.g. '
+                    'list(LoadYamlRunConfig(...)), got {}'.format(
+                        type(run_configs).__name__))
+  return {
+      'gpus': max([int(rc.get('gpus', 0)) for rc in run_configs] or [0]),
+      'data_dirs': sorted(set(rc['data_dir'] for rc in run_configs
+                              if rc.get('data_dir'))),
+      'min_disk_gb': min_disk_gb,
+      'min_memory_gb': min_memory_gb,
+  }
+
+
+def _Ports(instance):
+  offset = getattr(instance, 'port_offset', 0)
+  return [cluster_partition.PS_PORT + offset,
+          cluster_partition.WORKER_PORT + offset]
+
+
+def _ParseProbe(output):
+  probe = {'data_dir': [], 'busy_port': []}
+  for line in output.splitlines():
+    key, sep, value = line.strip().partition('=')
+    if not sep:
+      continue
+    if key in probe:
+      probe[key].append(value)
+    else:
+      probe[key] = value
+  return probe
+
+
+def _Int(value):
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    return 0
+
+
+def CheckInstance(instance, requirements):
+  """Returns {check: (passed, observed value)} for one instance."""
+  cmd = _PROBE.format(
+      data_dirs=' '.join(pipes.quote(d) for d in requirements['data_dirs']),
+      ports=' '.join(str(p) for p in _Ports(instance)))
+  try:
+    output = instance.ExecuteCommandAndReturnStdout(cmd)
+  except Exception as e:
+    return {'reachable': (False, str(e))}
+  if isinstance(output, bytes):
+    output = output.decode('utf-8', 'ignore')
+  probe = _ParseProbe(output)
+
+  gpus = _Int(probe.get('gpus'))
+  disk_gb = _Int(probe.get('disk_kb')) / float(1 << 20)
+  memory_gb = _Int(probe.get('memory_kb')) / float(1 << 20)
+  missing = sorted(set(requirements['data_dirs']) - set(probe['data_dir']))
+  needs_gpu = requirements['gpus'] > 0
+  return {
+      'reachable': (True, instance.hostname),
+      'gpus': (gpus >= requirements['gpus'], gpus),
+      'driver': (bool(probe.get('driver')) or not needs_gpu,
+                 probe.get('driver') or None),
+      'cuda': (bool(probe.get('cuda')) or not needs_gpu,
+               probe.get('cuda') or None),
+      'disk_gb': (disk_gb >= requirements['min_disk_gb'], round(disk_gb, 1)),
+      'memory_gb': (memory_gb >= requirements['min_memory_gb'],
+                    round(memory_gb, 1)),
+      'data_dir': (not missing, ','.join(missing) or 'ok'),
+      'ports': (not probe['busy_port'],
+                ','.join(probe['busy_port']) or 'free'),
+  }
+
+
+def Passed(checks):
+  return all(passed for passed, _ in checks.values())
+
+
+def PrintMatrix(instances, results):
+  """Prints one row per instance and one PASS/FAIL column per check."""
+  width = max([len(str(i.instance_id)) for i in instances] + [11])
+  print(' '.join(['instance'.ljust(width)] + [c.ljust(9) for c in CHECKS]))
+  for instance, checks in zip(instances, results):
+    row = [str(instance.instance_id).ljust(width)]
+    for check in CHECKS:
+      if check not in checks:
+        row.append('-'.ljust(9))
+      else:
+        row.append(('PASS' if checks[check][0] else 'FAIL').ljust(9))
+    print(' '.join(row))
+  for instance, checks in zip(instances, results):
+    failed = ['{}={}'.format(c, v) for c, (ok, v) in sorted(checks.items())
+              if not ok]
+    if failed:
+      print('instance({}) {}: {}'.format(instance.instance_id,
+                                        instance.hostname, ' '.join(failed)))
+
+
+def CheckFleet(instances, requirements, max_workers=32):
+  """Checks all instances in parallel and prints the result matrix.
+
+  returns list of {check: (passed, value)} in the order of instances.
+
+  """
+  if not instances:
+    return []
+  pool = ThreadPool(min(max_workers, len(instances)))
+  try:
+    results = pool.map(lambda i: CheckInstance(i, requirements), instances)
+  finally:
+    pool.close()
+  PrintMatrix(instances, results)
+  return results
+
+
+def Preflight(instances,
+              run_configs,
+              on_failure='drop',
+              replace_fn=None,
+              max_rounds=2,
+              min_disk_gb=20,
+              min_memory_gb=8):
+  """Checks the fleet and takes failing instances out of the sweep.
+
+  Args:
+    instances: fleet from AwsInstances/ReuseAwsInstances/WarmAwsInstances.
+    run_configs: list of the configs of the sweep, e.g.
+      list(LoadYamlRunConfig(...)).
+    on_failure: 'drop' to leave failing instances out of the returned list,
+      'quarantine' to keep them with instance.quarantined set.
+    replace_fn: optional function called with a number of instances that
+      returns that many new ready instances, which are checked in turn.
+    max_rounds: maximum rounds of replacements.
+    min_disk_gb: free disk needed in the home directory, where logs go.
+    min_memory_gb: available memory needed.
+
+  returns list of instances to run the sweep on.
+
+  """
+  if on_failure not in ('drop', 'quarantine'):
+    raise ValueError('Unknown on_failure: {}'.format(on_failure))
+  requirements = Requirements(run_configs, min_disk_gb, min_memory_gb)
+  healthy, failed = [], []
+  to_check = list(instances)
+  for round_num in range(max_rounds + 1):
+    results = CheckFleet(to_check, requirements)
+    bad = [i for i, checks in zip(to_check, results) if not Passed(checks)]
+    healthy.extend(i for i in to_check if i not in bad)
+    failed.extend(bad)
+    if not bad or replace_fn is None or round_num == max_rounds:
+      break
+    print('Replacing {} instances that failed preflight'.format(len(bad)))
+    to_check = replace_fn(len(bad))
+
+  print('Preflight: {} instances passed, {} failed'.format(
+      len(healthy), len(failed)))
+  if on_failure == 'drop':
+    return healthy
+  for instance in failed:
+    instance.quarantined = True
+  return healthy + failed
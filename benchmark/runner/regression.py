@@ -0,0 +1,208 @@
+"""Flags statistically significant slowdowns between benchmark sweeps.
+
+Compares the images/sec of every config in a candidate sweep with the same
+config in an earlier sweep stored in the result store, e.g.:
+
+  python regression.py --log_folder results
+
+Exits with status 1 if any config regressed so nightly sweeps fail loudly,
+and with status 2 if there is no store or no config to compare.
+"""
+import argparse
+import collections
+import math
+import os
+import sys
+
+import result_store
+
+# Fields that identify a benchmark across sweeps.
+CONFIG_KEY_FIELDS = ('model', 'gpus', 'workers', 'ps_servers',
+                     'variable_update', 'batch_size')
+
+
+def ConfigKey(run_config):
+  return tuple(str(run_config.get(f)) for f in CONFIG_KEY_FIELDS)
+
+
+def _BetaContinuedFraction(a, b, x):
+  """Continued fraction of the incomplete beta function (Numerical Recipes)."""
+  tiny = 1e-30
+  c, d = 1.0, 1.0 - (a + b) * x / (a + 1)
+  d = 1.0 / (d if abs(d) > tiny else tiny)
+  h = d
+  for m in range(1, 200):
+    for numerator in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                      -(a + m) * (a + b + m) * x / ((a + 2 * m) *
+                                                    (a + 2 * m + 1))):
+      d = 1.0 + numerator * d
+      d = 1.0 / (d if abs(d) > tiny else tiny)
+      c = 1.0 + numerator / c
+      c = c if abs(c) > tiny else tiny
+      h *= d * c
+    if abs(d * c - 1.0) < 1e-12:
+      break
+  return h
+
+
+def _RegularizedBeta(a, b, x):
+  if x <= 0:
+    return 0.0
+  if x >= 1:
+    return 1.0
+  front = math.exp(
+      math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) +
+      b * math.log(1 - x))
+  if x < (a + 1) / (a + b + 2):
+    return front * _BetaContinuedFraction(a, b, x) / a
+  return 1.0 - front * _BetaContinuedFraction(b, a, 1 - x) / b
+
+
+def _MeanVar(samples):
+  n = len(samples)
+  mean = sum(samples) / float(n)
+  var = sum((x - mean)**2 for x in samples) / (n - 1) if n > 1 else 0.0
+  return mean, var
+
+
+def WelchTTest(baseline, candidate):
+  """One sided Welch's t-test that candidate has a lower mean than baseline.
+
+  Both sides need at least 2 samples to estimate their variance.
+
+  returns (t, degrees of freedom, p-value).
+
+  """
+  if len(baseline) < 2 or len(candidate) < 2:
+    raise ValueError('Welch\'s t-test needs 2 samples per side, got {} and {}'
+                     .format(len(baseline), len(candidate)))
+  mean_b, var_b = _MeanVar(baseline)
+  mean_c, var_c = _MeanVar(candidate)
+  se2_b, se2_c = var_b / len(baseline), var_c / len(candidate)
+  if se2_b + se2_c == 0:
+    return 0.0, 0.0, 0.0 if mean_c < mean_b else 1.0
+  t = (mean_c - mean_b) / math.sqrt(se2_b + se2_c)
+  df = (se2_b + se2_c)**2 / (se2_b**2 / (len(baseline) - 1) +
+                             se2_c**2 / (len(candidate) - 1))
+  tail = 0.5 * _RegularizedBeta(df / 2.0, 0.5, df / (df + t * t))
+  p_value = tail if t < 0 else 1.0 - tail
+  return t, df, p_value
+
+
+def HedgesG(baseline, candidate):
+  """Standardized mean difference (candidate - baseline), bias corrected."""
+  n_b, n_c = len(baseline), len(candidate)
+  mean_b, var_b = _MeanVar(baseline)
+  mean_c, var_c = _MeanVar(candidate)
+  dof = n_b + n_c - 2
+  if dof <= 0:
+    return 0.0
+  pooled = math.sqrt(((n_b - 1) * var_b + (n_c - 1) * var_c) / dof)
+  if pooled == 0:
+    return 0.0
+  return (mean_c - mean_b) / pooled * (1 - 3.0 / (4 * dof - 1))
+
+
+def LoadSamples(store):
+  """Returns {config key: {sweep_id: [images/sec of each repeat]}}."""
+  samples = collections.defaultdict(lambda: collections.defaultdict(list))
+  for record in store.Records():
+    results = record.get('results') or {}
+    if results.get('images_per_sec'):
+      samples[ConfigKey(record['run_config'])][record['sweep_id']].append(
+          results['images_per_sec'])
+  return samples
+
+
+def FindRegressions(samples,
+                    candidate_sweep=None,
+                    baseline_sweep=None,
+                    alpha=0.05,
+                    min_slowdown=0.02):
+  """Compares the candidate sweep of each config with its baseline sweep.
+
+  Args:
+    samples: output of LoadSamples.
+    candidate_sweep: sweep to check, defaults to the latest with the config.
+    baseline_sweep: sweep to compare with, defaults to the latest earlier one.
+    alpha: significance level of the one sided Welch's t-test.
+    min_slowdown: relative slowdown below which a config is not flagged.
+
+  returns list of dicts, one per config with at least 2 runs in both sweeps.
+
+  """
+  findings = []
+  for key, sweeps in sorted(samples.items()):
+    sweep_ids = sorted(sweeps)
+    candidate = candidate_sweep or sweep_ids[-1]
+    if candidate not in sweeps:
+      continue
+    earlier = [s for s in sweep_ids if s < candidate]
+    baseline = baseline_sweep or (earlier[-1] if earlier else None)
+    if baseline not in sweeps:
+      continue
+    base, cand = sweeps[baseline], sweeps[candidate]
+    if len(base) < 2 or len(cand) < 2:
+      print('Skipping {}: {} baseline and {} candidate runs, need 2 each'
+            .format(' '.join(key), len(base), len(cand)))
+      continue
+    t, _, p_value = WelchTTest(base, cand)
+    change = _MeanVar(cand)[0] / _MeanVar(base)[0] - 1
+    findings.append({
+        'config': dict(zip(CONFIG_KEY_FIELDS, key)),
+        'baseline_sweep': baseline,
+        'candidate_sweep': candidate,
+        'baseline_mean': _MeanVar(base)[0],
+        'candidate_mean': _MeanVar(cand)[0],
+        'change': change,
+        't': t,
+        'p_value': p_value,
+        'effect_size': HedgesG(base, cand),
+        'regression': p_value < alpha and change <= -min_slowdown,
+    })
+  return findings
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--log_folder', default='results')
+  parser.add_argument('--candidate_sweep', default=None)
+  parser.add_argument('--baseline_sweep', default=None)
+  parser.add_argument('--alpha', type=float, default=0.05)
+  parser.add_argument('--min_slowdown', type=float, default=0.02)
+  args = parser.parse_args(argv)
+
+  store_root = os.path.join(args.log_folder, result_store.STORE_DIR)
+  if not os.path.isdir(store_root):
+    print('No result store at {}'.format(store_root))
+    return 2
+  store = result_store.ResultStore(store_root)
+  try:
+    samples = LoadSamples(store)
+  finally:
+    store.Close()
+  findings = FindRegressions(
+      samples,
+      candidate_sweep=args.candidate_sweep,
+      baseline_sweep=args.baseline_sweep,
+      alpha=args.alpha,
+      min_slowdown=args.min_slowdown)
+
+  if not findings:
+    print('No config has runs in both a baseline and a candidate sweep')
+    return 2
+  regressions = 0
+  for f in findings:
+    regressions += f['regression']
+    print('{} {}: {:.1f} -> {:.1f} images/sec ({:+.1%}) p={:.4f} g={:.2f}'
+          .format('REGRESSION' if f['regression'] else 'ok        ',
+                  ' '.join('{}={}'.format(k, v)
+                           for k, v in sorted(f['config'].items())),
+                  f['baseline_mean'], f['candidate_mean'], f['change'],
+                  f['p_value'], f['effect_size']))
+  print('{} of {} configs regressed'.format(regressions, len(findings)))
+  return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,123 @@
+"""Filters command output on the remote host to cut ssh traffic.
+
+Normally every line a worker prints crosses ssh so that the local
+line_extractor can pick the few worth printing. FilteredCommand wraps a
+command so the host tees its full output to a log on its own disk and only
+streams lines matching LIVE_PATTERNS. The log is compressed when the
+command ends, also when it ends because the ssh channel hung up, and
+ExecuteFilteredCommand pulls it once to where the streamed log would have
+been written.
+"""
+import os
+import pipes
+import posixpath
+import threading
+import uuid
+
+import log_sink
+
+# Lines util.ExtractErrorToConsole and util.ExtractImagePerSecond print.
+LIVE_PATTERNS = ('^E', 'E tensorflow', 'DMA: ', 'images/sec:')
+
+_COMPRESS_COMMAND = {
+    None: 'true',
+    'gzip': 'gzip -f {log}',
+    'zstd': 'zstd -q -f --rm {log}',
+}
+
+
+def FilteredCommand(command, remote_log, patterns=LIVE_PATTERNS,
+                    compression='gzip'):
+  """Returns a shell command running command with filtered output.
+
+  The full output goes to remote_log, preceded by the command line like the
+  logs written by util._StreamOutputToFile, and is compressed on every exit
+  path, including a SIGHUP from the ssh channel closing. Only lines matching
+  one of patterns, extended regular expressions, are printed. The exit status
+  is the one of command, or 128 plus the signal that ended the script.
+
+  """
+  log = pipes.quote(remote_log)
+  script = ('export PYTHONUNBUFFERED=1; '
+            'finalize() {{ status=$?; trap "" HUP INT TERM; {compress}; '
+            'exit $status; }}; '
+            'trap finalize EXIT; '
+            'trap "exit 129" HUP; trap "exit 130" INT; trap "exit 143" TERM; '
+            'printf "%s\\n" {quoted} > {log}; '
+            '({command}) 2>&1 | tee -a {log} | '
+            'grep --line-buffered -E {patterns}; '
+            'exit ${{PIPESTATUS[0]}}').format(
+                quoted=pipes.quote(command),
+                log=log,
+                command=command,
+                patterns=pipes.quote('|'.join(patterns)),
+                compress=_COMPRESS_COMMAND[compression].format(log=log))
+  return 'bash -c {}'.format(pipes.quote(script))
+
+
+def ExecuteFilteredCommand(instance,
+                           command,
+                           stdout_file,
+                           line_extractor=None,
+                           print_error=False,
+                           ok_exit_status=[0],
+                           compression='gzip',
+                           remote_dir='/tmp',
+                           patterns=LIVE_PATTERNS):
+  """Runs command on instance streaming only the lines matching patterns.
+
+  The streamed lines are passed to line_extractor and written to
+  stdout_file + '.live'. The full log is then retrieved to stdout_file plus
+  the log_sink.COMPRESSION_SUFFIX of compression, the file a LogSink with
+  that compression would have written, and removed from the host.
+
+  Args:
+    instance: AWSInstance or cluster_local.LocalInstance to run on.
+    command: command to run.
+    stdout_file: local file the full log is retrieved to.
+    line_extractor: method called with each streamed line.
+    print_error: True to print the command if it fails.
+    ok_exit_status: exit codes that are not errors.
+    compression: None, 'gzip' or 'zstd' to compress the log before transfer.
+    remote_dir: directory the log is kept in on the host.
+    patterns: extended regular expressions of the lines to stream.
+
+  returns True if the command succeeded.
+
+  """
+  remote_log = posixpath.join(remote_dir, 'tf_run_{}_{}.log'.format(
+      os.path.basename(stdout_file), uuid.uuid4().hex[:8]))
+  remote_file = remote_log + log_sink.COMPRESSION_SUFFIX[compression]
+  ok = False
+  try:
+    ok = instance.ExecuteCommandAndStreamOutput(
+        FilteredCommand(command, remote_log, patterns, compression),
+        stdout_file=stdout_file + '.live',
+        line_extractor=line_extractor,
+        print_error=print_error,
+        ok_exit_status=ok_exit_status)
+  finally:
+    # Also after the stream broke off, the host finalizes the log anyway.
+    _RetrieveLog(instance, remote_file,
+                 stdout_file + log_sink.COMPRESSION_SUFFIX[compression])
+  return ok
+
+
+def _RetrieveLog(instance, remote_file, local_file):
+  try:
+    instance.RetrieveFile(remote_file, local_file)
+  except Exception as e:
+    print('Failed to retrieve full log {} from {}:{}'.format(
+        remote_file, instance.hostname, e))
+    return
+  instance.ExecuteCommandAndWait('rm -f {}'.format(pipes.quote(remote_file)))
+
+
+def ExecuteFilteredCommandInThread(instance, command, stdout_file, **kwargs):
+  """Runs ExecuteFilteredCommand in a thread and returns the thread."""
+  t = threading.Thread(
+      target=ExecuteFilteredCommand,
+      args=(instance, command, stdout_file),
+      kwargs=kwargs)
+  t.start()
+  return t
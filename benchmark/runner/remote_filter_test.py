@@ -0,0 +1,77 @@
+"""Tests remote output filtering with local instances and bash.
+
+Run from benchmark/runner with:
+
+  python -m unittest discover -p '*_test.py'
+"""
+import gzip
+import os
+import shlex
+import shutil
+import signal
+import subprocess
+import tempfile
+import unittest
+
+import cluster_local
+import remote_filter
+
+_COMMAND = 'echo noise; echo "10\timages/sec: 212.3 +/- 0.4 (jitter = 1.2)"'
+
+
+class RemoteFilterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp()
+    self.remote_log = os.path.join(self.work_dir, 'remote.log')
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+
+  def _ReadLog(self, path):
+    with gzip.open(path) as f:
+      return f.read().decode('utf-8')
+
+  def testStreamsMatchingLinesAndRetrievesFullLog(self):
+    instance = cluster_local.LocalInstance(work_dir=self.work_dir)
+    stdout_file = os.path.join(self.work_dir, 'worker_0.log')
+    lines = []
+
+    self.assertTrue(
+        remote_filter.ExecuteFilteredCommand(
+            instance,
+            _COMMAND,
+            stdout_file,
+            line_extractor=lines.append,
+            remote_dir=self.work_dir))
+
+    self.assertEqual(1, len(lines))
+    self.assertIn('images/sec', lines[0])
+    log = self._ReadLog(stdout_file + '.gz')
+    self.assertTrue(log.startswith(_COMMAND + '\n'))
+    self.assertIn('noise\n', log)
+    self.assertEqual(['worker_0.log.gz', 'worker_0.log.live'],
+                     sorted(os.listdir(self.work_dir)))
+
+  def testFinalizesLogWhenChannelHangsUp(self):
+    command = remote_filter.FilteredCommand(_COMMAND + '; sleep 30',
+                                            self.remote_log)
+    with open(os.devnull, 'w') as devnull:
+      p = subprocess.Popen(
+          shlex.split(command),
+          stdout=subprocess.PIPE,
+          stderr=devnull,
+          preexec_fn=os.setsid)
+    self.assertIn(b'images/sec', p.stdout.readline())
+
+    # What closing the ssh channel of a pty does to the command.
+    p.stdout.close()
+    os.killpg(p.pid, signal.SIGHUP)
+
+    self.assertEqual(129, p.wait())
+    self.assertFalse(os.path.exists(self.remote_log))
+    self.assertIn('noise\n', self._ReadLog(self.remote_log + '.gz'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,227 @@
+"""Builds scaling efficiency tables from the runs in the result store.
+
+Groups every stored run by model, gpus, workers, ps_servers and
+variable_update and reports the mean and stddev of images/sec, the speedup
+over the 1 GPU run of the same model and the scaling efficiency, e.g.:
+
+  python report.py --log_folder results
+
+writes scaling.md, scaling.csv and scaling.html to results/report. The
+parsed runs are cached as numpy columns next to the store, so later reports
+only load the runs committed since.
+"""
+import argparse
+import csv
+import os
+import sys
+
+import numpy as np
+
+import cluster_partition
+import result_store
+
+CACHE_FILE = 'report_cache.npz'
+# Bumped when the cached columns change, which rebuilds the cache.
+_CACHE_VERSION = 1
+
+_STRING_COLUMNS = ('key', 'sweep_id', 'model', 'variable_update')
+_INT_COLUMNS = ('gpus', 'workers', 'ps_servers')
+_FLOAT_COLUMNS = ('images_per_sec',)
+
+REPORT_COLUMNS = ('model', 'variable_update', 'gpus', 'workers', 'ps_servers',
+                  'total_gpus', 'runs', 'images_per_sec_mean',
+                  'images_per_sec_stddev', 'speedup', 'efficiency')
+
+
+def _Row(key, record):
+  run_config = record['run_config']
+  results = record.get('results') or {}
+  workers = run_config.get('workers', 0)
+  return {
+      'key': key,
+      'sweep_id': record['sweep_id'],
+      'model': str(run_config.get('model')),
+      'variable_update': str(run_config.get('variable_update', '')),
+      'gpus': int(run_config.get('gpus', 0)),
+      'workers': (0 if str(workers) == '0' else
+                  cluster_partition.NumWorkers(run_config)),
+      'ps_servers': cluster_partition.NumPs(run_config),
+      'images_per_sec': float(results.get('images_per_sec') or np.nan),
+  }
+
+
+def _EmptyColumns():
+  columns = dict((c, np.array([], dtype='U')) for c in _STRING_COLUMNS)
+  columns.update((c, np.array([], dtype=np.int64)) for c in _INT_COLUMNS)
+  columns.update((c, np.array([], dtype=np.float64)) for c in _FLOAT_COLUMNS)
+  return columns
+
+
+def LoadColumns(store, cache_path=None):
+  """Returns {column: numpy array} with one entry per committed run.
+
+  Runs already in the cache at cache_path are not read again; the runs
+  committed since are appended and the cache rewritten.
+
+  """
+  columns = _EmptyColumns()
+  if cache_path and os.path.exists(cache_path):
+    with np.load(cache_path) as cache:
+      if int(cache['version']) == _CACHE_VERSION:
+        columns = dict((c, cache[c]) for c in columns)
+  cached = set(columns['key'].tolist())
+
+  rows = []
+  for key, op in sorted(store.status.items()):
+    if op != 'commit' or key in cached:
+      continue
+    sweep_id, config_hash = key.split('/')
+    record = store.Get(config_hash, sweep_id)
+    if record is not None:
+      rows.append(_Row(key, record))
+  if rows:
+    for c in columns:
+      new = np.array([row[c] for row in rows])
+      new = new.astype('U' if c in _STRING_COLUMNS else columns[c].dtype)
+      columns[c] = np.concatenate([columns[c], new])
+    if cache_path:
+      np.savez(cache_path, version=_CACHE_VERSION, **columns)
+  print('Report: {} runs cached, {} loaded'.format(len(cached), len(rows)))
+  return columns
+
+
+def ScalingTable(columns, sweep_ids=None):
+  """Aggregates runs into one row per configuration.
+
+  The baseline of a model is the mean of its 1 GPU runs with the same
+  variable_update, or of all its 1 GPU runs if there is none.
+
+  Args:
+    columns: output of LoadColumns.
+    sweep_ids: optional list of sweeps to restrict the table to.
+
+  returns list of dicts with the REPORT_COLUMNS.
+
+  """
+  keep = ~np.isnan(columns['images_per_sec'])
+  if sweep_ids:
+    keep &= np.isin(columns['sweep_id'], sweep_ids)
+  c = dict((k, v[keep]) for k, v in columns.items())
+  if not len(c['images_per_sec']):
+    return []
+  total_gpus = c['gpus'] * np.maximum(c['workers'], 1)
+  ips = c['images_per_sec']
+
+  group_keys = np.array([
+      '\t'.join(k) for k in zip(c['model'], c['variable_update'],
+                                c['gpus'].astype(str), c['workers'].astype(str),
+                                c['ps_servers'].astype(str))
+  ])
+  groups, group_of_run = np.unique(group_keys, return_inverse=True)
+  counts = np.bincount(group_of_run)
+  means = np.bincount(group_of_run, weights=ips) / counts
+  squares = np.bincount(group_of_run, weights=(ips - means[group_of_run])**2)
+  stddevs = np.sqrt(squares / np.maximum(counts - 1, 1))
+
+  single = total_gpus == 1
+  baselines = {}
+  for model in np.unique(c['model'][single]):
+    of_model = single & (c['model'] == model)
+    baselines[model] = ips[of_model].mean()
+    for update in np.unique(c['variable_update'][of_model]):
+      same = of_model & (c['variable_update'] == update)
+      baselines[(model, update)] = ips[same].mean()
+
+  table = []
+  for i, group in enumerate(groups):
+    model, update, gpus, workers, ps = group.split('\t')
+    first = np.argmax(group_of_run == i)
+    baseline = baselines.get((model, update), baselines.get(model))
+    speedup = float(means[i] / baseline) if baseline else None
+    gpus_used = int(total_gpus[first])
+    table.append({
+        'model': model,
+        'variable_update': update,
+        'gpus': int(gpus),
+        'workers': int(workers),
+        'ps_servers': int(ps),
+        'total_gpus': gpus_used,
+        'runs': int(counts[i]),
+        'images_per_sec_mean': float(means[i]),
+        'images_per_sec_stddev': float(stddevs[i]),
+        'speedup': speedup,
+        'efficiency': speedup / gpus_used if speedup and gpus_used else None,
+    })
+  table.sort(key=lambda r: (r['model'], r['variable_update'], r['total_gpus'],
+                            r['workers'], r['ps_servers']))
+  return table
+
+
+def _Format(value):
+  if value is None:
+    return ''
+  if isinstance(value, float):
+    return '{:.2f}'.format(value)
+  return str(value)
+
+
+def WriteMarkdown(table, path):
+  with open(path, 'w') as f:
+    f.write('| ' + ' | '.join(REPORT_COLUMNS) + ' |\n')
+    f.write('|' + '---|' * len(REPORT_COLUMNS) + '\n')
+    for row in table:
+      f.write('| ' + ' | '.join(_Format(row[c]) for c in REPORT_COLUMNS) +
+              ' |\n')
+
+
+def WriteCsv(table, path):
+  with open(path, 'w') as f:
+    writer = csv.writer(f)
+    writer.writerow(REPORT_COLUMNS)
+    for row in table:
+      writer.writerow([_Format(row[c]) for c in REPORT_COLUMNS])
+
+
+def _Escape(text):
+  return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def WriteHtml(table, path):
+  with open(path, 'w') as f:
+    f.write('<table>\n<tr>' +
+            ''.join('<th>{}</th>'.format(c) for c in REPORT_COLUMNS) +
+            '</tr>\n')
+    for row in table:
+      f.write('<tr>' + ''.join('<td>{}</td>'.format(
+          _Escape(_Format(row[c]))) for c in REPORT_COLUMNS) + '</tr>\n')
+    f.write('</table>\n')
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--log_folder', default='results')
+  parser.add_argument('--output_dir', default=None)
+  parser.add_argument(
+      '--sweep_id',
+      action='append',
+      default=None,
+      help='Only report these sweeps, may be repeated.')
+  args = parser.parse_args(argv)
+
+  store_root = os.path.join(args.log_folder, result_store.STORE_DIR)
+  store = result_store.ResultStore(store_root)
+  columns = LoadColumns(store, os.path.join(store_root, CACHE_FILE))
+  table = ScalingTable(columns, args.sweep_id)
+
+  output_dir = args.output_dir or os.path.join(args.log_folder, 'report')
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+  WriteMarkdown(table, os.path.join(output_dir, 'scaling.md'))
+  WriteCsv(table, os.path.join(output_dir, 'scaling.csv'))
+  WriteHtml(table, os.path.join(output_dir, 'scaling.html'))
+  print('Wrote {} rows to {}'.format(len(table), output_dir))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
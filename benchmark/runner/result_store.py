@@ -0,0 +1,305 @@
+"""Content addressed store of run results that lets sweeps resume.
+
+Results live under <log_folder>/result_store:
+
+  objects/<hash[:2]>/<hash>/<sweep_id>.json  config, results, extras and
+                                             log paths
+  journal.jsonl    write-ahead log of begin/commit/fail events
+  index.json       snapshot of the journal, see Compact()
+  active_sweep     id of the sweep RunSweep has not finished yet
+
+A run is recorded as 'begin' in the journal before it starts and 'commit'
+after its object has been written, so after a crash the journal tells which
+runs finished and which have to be run again.  Reopening the store without a
+sweep_id resumes the sweep left in active_sweep, as does passing the
+sweep_id of an interrupted sweep; a new sweep_id keeps the older results as
+history and runs everything again.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+STORE_DIR = 'result_store'
+ACTIVE_SWEEP_FILE = 'active_sweep'
+
+# Keys added to a run config while or after it runs.  They are not part of
+# the identity of the run.
+VOLATILE_KEYS = ('results', 'log_paths', 'visible_gpus', 'steady_state',
+                 'stragglers', 'network')
+# Volatile keys that are stored with the results under 'extras'.
+EXTRA_KEYS = ('visible_gpus', 'steady_state', 'stragglers', 'network')
+
+
+def ConfigHash(run_config, ignore=()):
+  """Returns a stable hash of run_config.
+
+  Args:
+    run_config: one of the configs produced by command_builder.LoadYamlRunConfig.
+    ignore: additional keys to leave out, e.g. 'copy' to hash all repeats of a
+      config to the same value.
+
+  """
+  identity = dict((k, v) for k, v in run_config.items()
+                  if k not in VOLATILE_KEYS and k not in ignore)
+  encoded = json.dumps(identity, sort_keys=True, default=str)
+  return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def _Key(sweep_id, config_hash):
+  return '{}/{}'.format(sweep_id, config_hash)
+
+
+def _IsValid(results):
+  return bool(results) and results.get('images_per_sec', 0) > 0
+
+
+def _WriteAtomic(path, data):
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump(data, f, sort_keys=True, default=str)
+    f.flush()
+    os.fsync(f.fileno())
+  os.rename(tmp_path, path)
+
+
+class ResultStore(object):
+  """Indexed store of run results keyed by ConfigHash.
+
+  Args:
+    root: directory of the store, usually <log_folder>/result_store.
+    sweep_id: id recorded with every result. Defaults to the unfinished sweep
+      in active_sweep if there is one, otherwise to the open time. Used to
+      tell results of different sweeps of the same config apart.
+
+  """
+
+  def __init__(self, root, sweep_id=None):
+    self.root = root
+    self.journal_path = os.path.join(root, 'journal.jsonl')
+    self.index_path = os.path.join(root, 'index.json')
+    self.active_path = os.path.join(root, ACTIVE_SWEEP_FILE)
+    if not os.path.isdir(os.path.join(root, 'objects')):
+      os.makedirs(os.path.join(root, 'objects'))
+    self.sweep_id = (sweep_id or self.ActiveSweep() or
+                     time.strftime('%Y%m%d-%H%M%S'))
+    self._Recover()
+    # Runs of a sweep commit from several threads, see gpu_scheduler.
+    self._lock = threading.Lock()
+    self._journal = open(self.journal_path, 'a')
+    if self._journal.tell() > 0 and not self._EndsWithNewline():
+      # Terminate a partial line so the next entry is not appended to it.
+      self._journal.write('\n')
+
+  def _Recover(self):
+    """Loads the index snapshot and replays the journal written after it."""
+    self.status = {}
+    offset = 0
+    if os.path.exists(self.index_path):
+      with open(self.index_path) as f:
+        index = json.load(f)
+      self.status = index['status']
+      offset = index['journal_offset']
+    if not os.path.exists(self.journal_path):
+      return
+    with open(self.journal_path) as f:
+      f.seek(offset)
+      for line in f:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          # Partial last line from a crash while appending.
+          continue
+        self.status[_Key(entry['sweep_id'], entry['hash'])] = entry['op']
+
+  def _EndsWithNewline(self):
+    with open(self.journal_path, 'rb') as f:
+      f.seek(-1, os.SEEK_END)
+      return f.read(1) == b'\n'
+
+  def _Append(self, op, config_hash, **fields):
+    fields.update(
+        op=op, hash=config_hash, sweep_id=self.sweep_id, time=time.time())
+    line = json.dumps(fields, sort_keys=True) + '\n'
+    with self._lock:
+      self._journal.write(line)
+      self._journal.flush()
+      os.fsync(self._journal.fileno())
+      self.status[_Key(self.sweep_id, config_hash)] = op
+
+  def ObjectPath(self, config_hash, sweep_id=None):
+    return os.path.join(self.root, 'objects', config_hash[:2], config_hash,
+                        (sweep_id or self.sweep_id) + '.json')
+
+  def Has(self, run_config):
+    """Returns True if run_config has valid results in the current sweep."""
+    config_hash = ConfigHash(run_config)
+    if self.status.get(_Key(self.sweep_id, config_hash)) != 'commit':
+      return False
+    record = self.Get(config_hash)
+    return record is not None and _IsValid(record.get('results'))
+
+  def Get(self, config_hash, sweep_id=None):
+    try:
+      with open(self.ObjectPath(config_hash, sweep_id)) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return None
+
+  def Begin(self, run_config):
+    self._Append('begin', ConfigHash(run_config))
+
+  def Commit(self, run_config, results, log_paths=()):
+    """Writes the results of a run and marks it as finished.
+
+    The EXTRA_KEYS of run_config, e.g. the steady state window or the network
+    matrix, are stored under 'extras' so they do not change the hash.
+
+    """
+    config_hash = ConfigHash(run_config)
+    path = self.ObjectPath(config_hash)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    identity = dict(
+        (k, v) for k, v in run_config.items() if k not in VOLATILE_KEYS)
+    extras = dict((k, run_config[k]) for k in EXTRA_KEYS if k in run_config)
+    _WriteAtomic(path, {
+        'hash': config_hash,
+        'run_config': identity,
+        'extras': extras,
+        'results': results,
+        'log_paths': list(log_paths),
+        'sweep_id': self.sweep_id,
+        'timestamp': time.time(),
+    })
+    self._Append('commit', config_hash)
+
+  def Fail(self, run_config, reason=''):
+    self._Append('fail', ConfigHash(run_config), reason=str(reason))
+
+  def ActiveSweep(self):
+    """Returns the id of the sweep that was started but not finished."""
+    try:
+      with open(self.active_path) as f:
+        return f.read().strip() or None
+    except IOError:
+      return None
+
+  def StartSweep(self):
+    """Records the current sweep as active until FinishSweep."""
+    with open(self.active_path + '.tmp', 'w') as f:
+      f.write(self.sweep_id)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(self.active_path + '.tmp', self.active_path)
+
+  def FinishSweep(self):
+    if self.ActiveSweep() == self.sweep_id:
+      os.remove(self.active_path)
+
+  def Interrupted(self):
+    """Returns hashes of runs of this sweep that began but never finished."""
+    prefix = _Key(self.sweep_id, '')
+    return [
+        key[len(prefix):] for key, op in self.status.items()
+        if op == 'begin' and key.startswith(prefix)
+    ]
+
+  def SweepIds(self):
+    return sorted(set(key.split('/')[0] for key in self.status))
+
+  def Records(self):
+    """Yields every committed record of every sweep in the store."""
+    for key, op in sorted(self.status.items()):
+      if op == 'commit':
+        sweep_id, config_hash = key.split('/')
+        record = self.Get(config_hash, sweep_id)
+        if record is not None:
+          yield record
+
+  def SkipCompleted(self, run_configs, repeat_controller=None):
+    """Yields the run configs that do not have valid results yet.
+
+    The stored results of skipped configs are recorded with the optional
+    command_builder.AdaptiveRepeat, so a resumed sweep does not repeat
+    configs that were already stable.
+
+    """
+    for run_config in run_configs:
+      if self.Has(run_config):
+        print('Skipping {} copy {}, results already stored.'.format(
+            run_config.get('name'), run_config.get('copy')))
+        if repeat_controller is not None:
+          record = self.Get(ConfigHash(run_config))
+          _RecordRepeat(repeat_controller, run_config, record['results'])
+        continue
+      yield run_config
+
+  def Compact(self):
+    """Snapshots the journal state into index.json for faster opens."""
+    with self._lock:
+      self._journal.flush()
+      _WriteAtomic(self.index_path, {
+          'status': dict(self.status),
+          'journal_offset': os.path.getsize(self.journal_path),
+      })
+
+  def Close(self):
+    self.Compact()
+    self._journal.close()
+
+
+def OpenForConfig(run_config, sweep_id=None):
+  """Opens the store under the log_folder of run_config."""
+  return ResultStore(
+      os.path.join(run_config.get('log_folder', 'results'), STORE_DIR),
+      sweep_id=sweep_id)
+
+
+def _RecordRepeat(repeat_controller, run_config, results):
+  if results.get('images_per_sec') is not None:
+    repeat_controller.Record(run_config, results['images_per_sec'])
+
+
+def RunSweep(store, run_configs, run_fn, repeat_controller=None):
+  """Runs every config that has no stored results, journaling each run.
+
+  The sweep stays active in the store until every config has been tried, so
+  if the runner dies the next ResultStore opened without a sweep_id resumes
+  it instead of starting over.
+
+  Args:
+    store: ResultStore to record the runs in.
+    run_configs: iterable of run configs, e.g. from LoadYamlRunConfig.
+    run_fn: function taking a run config and returning (results, log_paths).
+      Exceptions are recorded as failures and the sweep moves on; the config
+      is run again when the sweep is resumed with its sweep_id.
+    repeat_controller: optional command_builder.AdaptiveRepeat that was passed
+      to LoadYamlRunConfig. Each result is recorded with it before the next
+      config is pulled from run_configs.
+
+  returns list of the run configs that failed.
+
+  """
+  if store.ActiveSweep() == store.sweep_id:
+    print('Resuming sweep {}, {} runs were interrupted.'.format(
+        store.sweep_id, len(store.Interrupted())))
+  store.StartSweep()
+  failed = []
+  for run_config in store.SkipCompleted(run_configs, repeat_controller):
+    store.Begin(run_config)
+    try:
+      results, log_paths = run_fn(run_config)
+    except Exception as e:
+      print('Run {} copy {} failed:{}'.format(
+          run_config.get('name'), run_config.get('copy'), e))
+      store.Fail(run_config, e)
+      failed.append(run_config)
+      continue
+    store.Commit(run_config, results, log_paths)
+    if repeat_controller is not None:
+      _RecordRepeat(repeat_controller, run_config, results)
+  store.Compact()
+  store.FinishSweep()
+  return failed
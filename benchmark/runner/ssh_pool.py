@@ -0,0 +1,201 @@
+"""Per-host pool of ssh connections shared by exec and sftp channels."""
+import socket
+import threading
+
+import paramiko
+import util
+
+# OpenSSH's sshd allows 10 sessions (MaxSessions) per connection by default.
+# Stay below it so a burst of commands never gets a channel open failure.
+DEFAULT_MAX_CHANNELS = 8
+
+
+class _Connection(object):
+  """One ssh transport and the number of channels checked out on it.
+
+  ssh_client is None while the transport is being connected; `connected` is
+  set once that finished, successfully or not.
+
+  """
+
+  def __init__(self, ssh_client=None):
+    self.ssh_client = ssh_client
+    self.channels = 0
+    # Set after an ssh or socket error; no new channels are opened on it.
+    self.failed = False
+    self.connected = threading.Event()
+    if ssh_client is not None:
+      self.connected.set()
+
+  def IsHealthy(self):
+    if self.failed:
+      return False
+    if self.ssh_client is None:
+      # Still connecting, channels can be reserved on it.
+      return True
+    transport = self.ssh_client.get_transport()
+    return transport is not None and transport.is_active()
+
+  def Close(self):
+    if self.ssh_client is None:
+      return
+    try:
+      self.ssh_client.close()
+    except:
+      pass
+
+
+class SshConnectionPool(object):
+  """Multiplexes many exec and sftp channels over a few ssh transports.
+
+  Every connection costs a TCP connect plus key exchange, while opening a
+  channel on an established transport is a single round trip. The pool keeps
+  one transport per host and only opens another one when all existing ones
+  carry `max_channels` channels. Transports send keepalives, are checked
+  before being handed out and are replaced when they have died.
+
+  Args:
+    hostname: host name or ip address of the system to connect to.
+    ssh_key: full path to the ssh key to use to connect.
+    username: username to connect with.
+    max_channels: channels allowed on one transport at the same time.
+    keepalive: seconds between keepalive packets on each transport.
+    retry: number of times to retry connecting.
+    instance_id: instance the ssh_connect spans are recorded for.
+
+  """
+
+  def __init__(self,
+               hostname,
+               ssh_key=None,
+               username='ubuntu',
+               max_channels=DEFAULT_MAX_CHANNELS,
+               keepalive=30,
+               retry=10,
+               instance_id=None):
+    self.hostname = hostname
+    self.instance_id = instance_id
+    self.ssh_key = ssh_key
+    self.username = username
+    self.max_channels = max_channels
+    self.keepalive = keepalive
+    self.retry = retry
+    self._connections = []
+    self._lock = threading.Lock()
+
+  def _Connect(self):
+    ssh_client = util.SshToHost(
+        self.hostname,
+        retry=self.retry,
+        ssh_key=self.ssh_key,
+        username=self.username,
+        keepalive=self.keepalive,
+        instance_id=self.instance_id)
+    if ssh_client is None:
+      raise IOError('Unable to ssh to {}'.format(self.hostname))
+    return ssh_client
+
+  def _Find(self, ssh_client):
+    for conn in self._connections:
+      if conn.ssh_client is ssh_client:
+        return conn
+    return None
+
+  def _Unreserve(self, conn):
+    """Gives back a channel reserved on a connection that failed to connect."""
+    with self._lock:
+      conn.channels -= 1
+      if conn.channels <= 0 and conn in self._connections:
+        self._connections.remove(conn)
+
+  def Acquire(self):
+    """Returns a healthy ssh client with room for one more channel.
+
+    Every Acquire must be matched by a Release of the returned client. A new
+    transport is connected outside the lock, so other threads keep using the
+    existing ones, and can reserve channels on it, in the meantime.
+
+    """
+    connect = False
+    with self._lock:
+      for conn in list(self._connections):
+        if not conn.IsHealthy():
+          # Busy broken connections are dropped once their users release them.
+          if conn.channels == 0:
+            self._connections.remove(conn)
+            conn.Close()
+          continue
+        if conn.channels < self.max_channels:
+          conn.channels += 1
+          break
+      else:
+        conn = _Connection()
+        conn.channels = 1
+        self._connections.append(conn)
+        connect = True
+
+    if connect:
+      try:
+        conn.ssh_client = self._Connect()
+      except:
+        conn.failed = True
+        self._Unreserve(conn)
+        raise
+      finally:
+        conn.connected.set()
+    else:
+      conn.connected.wait()
+      if conn.ssh_client is None:
+        self._Unreserve(conn)
+        raise IOError('Unable to ssh to {}'.format(self.hostname))
+    return conn.ssh_client
+
+  def Release(self, ssh_client, failed=False):
+    """Returns a client to the pool, dropping its transport if it failed.
+
+    A failed transport is only closed once no channel is checked out on it
+    anymore, so commands still streaming on it are not cut off. Until then it
+    is not handed out again.
+
+    """
+    with self._lock:
+      conn = self._Find(ssh_client)
+      if conn is None:
+        return
+      conn.channels -= 1
+      if failed:
+        conn.failed = True
+      if conn.channels <= 0 and not conn.IsHealthy():
+        self._connections.remove(conn)
+        conn.Close()
+
+  def Call(self, func):
+    """Calls func(ssh_client) on a pooled connection and returns its result.
+
+    If func raises an ssh or socket error the transport is retired so the
+    next call reconnects. Other errors, e.g. an IOError for a missing remote
+    or local file, leave the transport in use. The command is not retried
+    since it may have started.
+
+    """
+    ssh_client = self.Acquire()
+    failed = False
+    try:
+      return func(ssh_client)
+    except (paramiko.SSHException, socket.error):
+      failed = True
+      raise
+    finally:
+      self.Release(ssh_client, failed=failed)
+
+  def Primary(self):
+    """Returns a healthy shared client without reserving a channel on it."""
+    ssh_client = self.Acquire()
+    self.Release(ssh_client)
+    return ssh_client
+
+  def Close(self):
+    with self._lock:
+      for conn in self._connections:
+        conn.Close()
+      self._connections = []
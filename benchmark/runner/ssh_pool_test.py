@@ -0,0 +1,135 @@
+"""Tests SshConnectionPool with fake ssh clients.
+
+Run from benchmark/runner with:
+
+  python -m unittest discover -p '*_test.py'
+"""
+import socket
+import threading
+import unittest
+
+import ssh_pool
+
+
+class _FakeTransport(object):
+
+  def __init__(self):
+    self.active = True
+
+  def is_active(self):
+    return self.active
+
+
+class _FakeClient(object):
+
+  def __init__(self):
+    self.transport = _FakeTransport()
+    self.closed = False
+
+  def get_transport(self):
+    return self.transport
+
+  def close(self):
+    self.closed = True
+    self.transport.active = False
+
+
+class _FakePool(ssh_pool.SshConnectionPool):
+  """Pool whose connections are fake clients, optionally held up by a gate."""
+
+  def __init__(self, max_channels=2):
+    super(_FakePool, self).__init__('host', max_channels=max_channels)
+    self.clients = []
+    self.gate = None
+    self.connecting = threading.Event()
+
+  def _Connect(self):
+    self.connecting.set()
+    if self.gate is not None:
+      self.gate.wait()
+    client = _FakeClient()
+    self.clients.append(client)
+    return client
+
+
+class SshConnectionPoolTest(unittest.TestCase):
+
+  def testOpensAnotherConnectionOnlyWhenChannelsAreUsedUp(self):
+    pool = _FakePool(max_channels=2)
+    clients = [pool.Acquire() for _ in range(3)]
+    self.assertIs(clients[0], clients[1])
+    self.assertIsNot(clients[0], clients[2])
+    self.assertEqual(2, len(pool.clients))
+    pool.Release(clients[0])
+    self.assertIs(clients[0], pool.Acquire())
+
+  def testReplacesUnhealthyConnectionOnceIdle(self):
+    pool = _FakePool()
+    client = pool.Acquire()
+    client.transport.active = False
+    replacement = pool.Acquire()
+    self.assertIsNot(client, replacement)
+    self.assertFalse(client.closed)
+    pool.Release(client)
+    self.assertTrue(client.closed)
+    self.assertEqual(1, len(pool._connections))
+
+  def testFailedReleaseWaitsForOtherChannels(self):
+    pool = _FakePool()
+    busy = pool.Acquire()
+    failing = pool.Acquire()
+    self.assertIs(busy, failing)
+    pool.Release(failing, failed=True)
+    self.assertFalse(busy.closed)
+    self.assertIsNot(busy, pool.Acquire())
+    pool.Release(busy)
+    self.assertTrue(busy.closed)
+
+  def testCallRetiresTransportOnlyOnSshErrors(self):
+    pool = _FakePool()
+
+    def Raise(error):
+
+      def Func(ssh_client):
+        raise error
+
+      return Func
+
+    with self.assertRaises(IOError):
+      pool.Call(Raise(IOError('missing file')))
+    self.assertIs(pool.clients[0], pool.Primary())
+    with self.assertRaises(socket.error):
+      pool.Call(Raise(socket.error('reset')))
+    self.assertTrue(pool.clients[0].closed)
+    self.assertIsNot(pool.clients[0], pool.Primary())
+
+  def testConnectsWithoutBlockingOtherThreads(self):
+    pool = _FakePool(max_channels=1)
+    first = pool.Acquire()
+    pool.gate = threading.Event()
+    pool.connecting.clear()
+    result = []
+    t = threading.Thread(target=lambda: result.append(pool.Acquire()))
+    t.start()
+    pool.connecting.wait()
+    # The connect in the other thread is still held up by the gate.
+    pool.Release(first)
+    self.assertIs(first, pool.Acquire())
+    pool.gate.set()
+    t.join()
+    self.assertIsNot(first, result[0])
+
+  def testConnectFailureLeavesNoReservation(self):
+    pool = _FakePool()
+
+    def Fail():
+      raise IOError('Unable to ssh to host')
+
+    pool._Connect = Fail
+    with self.assertRaises(IOError):
+      pool.Acquire()
+    self.assertEqual([], pool._connections)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,169 @@
+"""Detects steady state throughput and stops runs once it is measured."""
+import collections
+import pipes
+import threading
+
+import command_builder
+import throughput
+
+# Matches the worker and ps processes but not a shell running the pattern.
+_BENCHMARK_PROCESS = '[t]f_cnn_benchmarks.py'
+
+
+class SteadyStateDetector(object):
+  """Finds the end of warmup and when steady throughput is measured.
+
+  The images/sec of a step line is over all steps so far, so consecutive
+  lines are far from independent. The detector turns each pair of them into
+  the images/sec of the steps in between, see throughput.IntervalRate, and
+  works on those interval rates. The one decimal the log prints adds noise to
+  the rates of long runs, which only widens the confidence interval.
+
+  Warmup ends when the mean of the last `window` interval rates is within
+  `rel_tolerance` of the mean of the `window` rates before them and both
+  windows vary by less than `rel_tolerance`. Rates from then on are the
+  steady state. The measurement is settled once at least
+  `min_steady_samples` steady rates give a 95% confidence interval of the
+  mean narrower than `ci_width` relative to the mean.
+
+  Register Add as a listener of a throughput.ThroughputParser.
+
+  Args:
+    window: number of step records compared to detect the end of warmup.
+    rel_tolerance: relative change between windows accepted as steady.
+    ci_width: relative confidence interval width that settles the run.
+    min_steady_samples: minimum steady records before the run can settle.
+    on_settled: function called with the detector once when it settles.
+
+  """
+
+  def __init__(self,
+               window=5,
+               rel_tolerance=0.02,
+               ci_width=0.01,
+               min_steady_samples=10,
+               on_settled=None):
+    self.window = window
+    self.rel_tolerance = rel_tolerance
+    self.ci_width = ci_width
+    self.min_steady_samples = min_steady_samples
+    self.on_settled = on_settled
+    self.warmup_end_step = None
+    self.settled_step = None
+    self.last_step = None
+    self.stats = throughput.RunningStats()
+    # (step, interval rate) of the last 2 * window records during warmup.
+    self._recent = collections.deque(maxlen=2 * window)
+    self._previous = None
+
+  @property
+  def settled(self):
+    return self.settled_step is not None
+
+  def _IsStable(self, values, mean):
+    spread = max(values) - min(values)
+    return mean > 0 and spread / mean <= 2 * self.rel_tolerance
+
+  def _IntervalRate(self, record):
+    """Returns the images/sec of the steps since the previous record."""
+    previous = self._previous or (0, None)
+    self._previous = (record.step, record.images_per_sec)
+    return throughput.IntervalRate(record.step, record.images_per_sec,
+                                   *previous)
+
+  def Add(self, record):
+    if self.settled:
+      return
+    rate = self._IntervalRate(record)
+    if rate is None:
+      return
+    self.last_step = record.step
+    if self.warmup_end_step is None:
+      self._recent.append((record.step, rate))
+      if len(self._recent) < self._recent.maxlen:
+        return
+      values = [r for _, r in self._recent]
+      before, after = values[:self.window], values[self.window:]
+      mean_before = sum(before) / len(before)
+      mean_after = sum(after) / len(after)
+      if (self._IsStable(before, mean_before) and
+          self._IsStable(after, mean_after) and
+          abs(mean_after - mean_before) <= self.rel_tolerance * mean_before):
+        self.warmup_end_step = self._recent[self.window][0]
+        for value in after:
+          self.stats.Add(value)
+    else:
+      self.stats.Add(rate)
+
+    width = self.stats.RelativeCiWidth()
+    if (self.stats.count >= self.min_steady_samples and width is not None and
+        width <= self.ci_width):
+      self.settled_step = record.step
+      if self.on_settled:
+        self.on_settled(self)
+
+  def Summary(self):
+    return {
+        'warmup_end_step': self.warmup_end_step,
+        'settled_step': self.settled_step,
+        'last_step': self.last_step,
+        'samples': self.stats.count,
+        'images_per_sec_mean': self.stats.mean,
+        'images_per_sec_stddev': self.stats.stddev,
+        'relative_ci_width': self.stats.RelativeCiWidth(),
+    }
+
+
+def StopRemoteTasks(instances, run_config, signal='INT'):
+  """Signals the benchmark processes of a run on all instances at once.
+
+  Only processes started with the command_builder.RunMarker of run_config in
+  their environment are signalled, so other runs packed on the same hosts
+  keep running. SIGINT lets the worker and ps processes exit cleanly. Their
+  commands then end with a non-zero exit status, which callers should expect
+  once a run was stopped early.
+
+  """
+  marker = '{}={}'.format(command_builder.RUN_MARKER_ENV,
+                          command_builder.RunMarker(run_config))
+  cmd = ('for pid in $(pgrep -f {}); do '
+         'grep -qxz {} /proc/$pid/environ 2>/dev/null && kill -{} $pid; '
+         'done; true').format(
+             pipes.quote(_BENCHMARK_PROCESS), pipes.quote(marker), signal)
+  threads = [
+      threading.Thread(target=instance.ExecuteCommandAndWait, args=(cmd,))
+      for instance in instances
+  ]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+
+
+def EarlyStopper(instances, run_config, **detector_args):
+  """Returns a detector that stops the run on instances once it settles.
+
+  Attach it to the ThroughputParser of one worker (usually task 0). Every
+  worker and ps task of run_config on the instances is stopped once, when it
+  settles.
+
+  """
+  stopped = threading.Event()
+
+  def Stop(detector):
+    if stopped.is_set():
+      return
+    stopped.set()
+    print('Throughput settled at step {} ({:.1f} images/sec), stopping run.'
+          .format(detector.settled_step, detector.stats.mean))
+    # Stop from another thread, the detector runs in a log streaming thread.
+    threading.Thread(
+        target=StopRemoteTasks, args=(instances, run_config)).start()
+
+  return SteadyStateDetector(on_settled=Stop, **detector_args)
+
+
+def AttachSteadyState(run_config, detector):
+  """Records the detected steady state window in the run config."""
+  run_config['steady_state'] = detector.Summary()
+  return run_config
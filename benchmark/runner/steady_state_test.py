@@ -0,0 +1,56 @@
+"""Tests SteadyStateDetector on step lines built from known step times.
+
+Run from benchmark/runner with:
+
+  python -m unittest discover -p '*_test.py'
+"""
+import unittest
+
+import steady_state
+import throughput
+
+_BATCH_SIZE = 64
+
+
+def _StepLines(step_times, every=10):
+  """Returns the step lines tf_cnn_benchmarks logs for the step times."""
+  lines = []
+  elapsed = 0.0
+  for step, step_time in enumerate(step_times, 1):
+    elapsed += step_time
+    if step % every == 0:
+      lines.append('{}\timages/sec: {:.1f} +/- 0.1 (jitter = 0.5)\t7.123'
+                   .format(step, _BATCH_SIZE * step / elapsed))
+  return lines
+
+
+class SteadyStateDetectorTest(unittest.TestCase):
+
+  def setUp(self):
+    # 50 slow warmup steps at 160 images/sec, then 320 images/sec.
+    self.lines = _StepLines([0.4] * 50 + [0.2] * 250)
+
+  def testIntervalRatesMatchStepTimes(self):
+    detector = steady_state.SteadyStateDetector()
+    rates = [
+        detector._IntervalRate(throughput.ParseStepLine(line))
+        for line in self.lines
+    ]
+    for rate in rates[:5]:
+      self.assertAlmostEqual(160.0, rate, delta=0.5)
+    for rate in rates[5:]:
+      self.assertAlmostEqual(320.0, rate, delta=0.05 * 320)
+
+  def testWarmupEndsWhenStepTimesChange(self):
+    detector = steady_state.SteadyStateDetector(ci_width=0.02)
+    for line in self.lines:
+      detector.Add(throughput.ParseStepLine(line))
+
+    # The first steady rates are compared with the next window of them.
+    self.assertEqual(60 + 10 * detector.window, detector.warmup_end_step)
+    self.assertTrue(detector.settled)
+    self.assertAlmostEqual(320.0, detector.stats.mean, delta=0.005 * 320)
+
+
+if __name__ == '__main__':
+  unittest.main()
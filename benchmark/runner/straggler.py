@@ -0,0 +1,187 @@
+"""Detects workers that stay slower than the rest of the cluster.
+
+One host with a bad GPU or thermal throttling slows a whole synchronous run,
+and until now only the DMA: lines printed by util.ExtractErrorToConsole
+hinted at it. StragglerDetector compares the step throughput of every
+worker with the cluster median while the run streams its logs, and flagged
+hosts are quarantined so later configs of the sweep avoid them.
+"""
+import collections
+import gzip
+import threading
+
+import numpy as np
+
+import throughput
+
+
+class StragglerDetector(object):
+  """Flags workers whose throughput stays below the cluster median.
+
+  Each worker's images/sec over the steps since its previous record, see
+  throughput.IntervalRate, is averaged over its last `window` step records
+  and divided by the median of these averages over all workers. A worker
+  whose ratio is below `threshold` for `patience` records in a row is a
+  straggler. Interval rates rather than the cumulative rates of the step
+  lines let a worker that slows down late in a run be flagged.
+
+  Register Add as a listener of the ThroughputParser of every worker, each
+  created with the host and task_index of its worker. The parsers run in
+  different threads, so Add is thread safe.
+
+  Args:
+    threshold: ratio to the median below which a worker is slow.
+    patience: consecutive slow records before a worker is flagged.
+    window: step records averaged per worker.
+    skip_steps: records with step <= skip_steps are ignored as warmup.
+    min_workers: workers that must report before any is compared.
+    on_straggler: function called as on_straggler(detector, host,
+      task_index) once per flagged worker.
+
+  """
+
+  def __init__(self,
+               threshold=0.85,
+               patience=5,
+               window=5,
+               skip_steps=10,
+               min_workers=2,
+               on_straggler=None):
+    self.threshold = threshold
+    self.patience = patience
+    self.window = window
+    self.skip_steps = skip_steps
+    self.min_workers = min_workers
+    self.on_straggler = on_straggler
+    # (host, task_index) -> step at which the worker was flagged.
+    self.stragglers = collections.OrderedDict()
+    self.ratios = {}
+    self._recent = {}
+    # worker -> (step, images/sec) of its previous record.
+    self._previous = {}
+    self._strikes = collections.defaultdict(int)
+    self._lock = threading.Lock()
+
+  def Add(self, record):
+    worker = (record.host, record.task_index)
+    with self._lock:
+      previous = self._previous.get(worker, (0, None))
+      self._previous[worker] = (record.step, record.images_per_sec)
+      if record.step <= self.skip_steps:
+        return
+      rate = throughput.IntervalRate(record.step, record.images_per_sec,
+                                     *previous)
+      if rate is None:
+        return
+      recent = self._recent.setdefault(
+          worker, collections.deque(maxlen=self.window))
+      recent.append(rate)
+      means = dict((w, sum(v) / len(v))
+                   for w, v in self._recent.items()
+                   if len(v) == self.window)
+      if worker not in means or len(means) < self.min_workers:
+        return
+      median = float(np.median(list(means.values())))
+      ratio = means[worker] / median if median > 0 else 1.0
+      self.ratios[worker] = ratio
+      if ratio < self.threshold:
+        self._strikes[worker] += 1
+      else:
+        self._strikes[worker] = 0
+      flagged = (self._strikes[worker] >= self.patience and
+                 worker not in self.stragglers)
+      if flagged:
+        self.stragglers[worker] = record.step
+    if flagged:
+      print('Straggler {} task {} at step {}: {:.0%} of the median images/sec'
+            .format(record.host, record.task_index, record.step, ratio))
+      if self.on_straggler:
+        self.on_straggler(self, record.host, record.task_index)
+
+  def Summary(self):
+    with self._lock:
+      return [{
+          'host': host,
+          'task_index': task_index,
+          'step': step,
+          'ratio_to_median': self.ratios.get((host, task_index)),
+      } for (host, task_index), step in self.stragglers.items()]
+
+
+def Quarantine(instances, instance_ids):
+  """Marks the instances with an instance_id in instance_ids as quarantined.
+
+  Matched on instance_id since hostnames are not unique, e.g. every
+  cluster_local.LocalInstance is localhost.
+
+  """
+  for instance in instances:
+    if instance.instance_id in instance_ids and not instance.quarantined:
+      print('Quarantining instance({}) {}'.format(instance.instance_id,
+                                                 instance.hostname))
+      instance.quarantined = True
+
+
+def HealthyInstances(instances):
+  """Returns the instances that are not quarantined."""
+  return [instance for instance in instances if not instance.quarantined]
+
+
+def QuarantiningDetector(instances, **detector_args):
+  """Returns a detector that quarantines the hosts of stragglers.
+
+  Worker i has to run on instances[i], as cluster_partition.BuildHostStrings
+  places them, and its ThroughputParser needs task_index=i.
+
+  cluster_partition.RunPartitioned stops scheduling on quarantined instances
+  once the config using them ends. Use HealthyInstances to leave them out
+  elsewhere, or WarmPool.Resize to provision replacements.
+
+  """
+
+  def OnStraggler(detector, host, task_index):
+    if task_index is None or not 0 <= task_index < len(instances):
+      print('No instance runs worker {} on {}, not quarantining'.format(
+          task_index, host))
+      return
+    Quarantine(instances, [instances[task_index].instance_id])
+
+  return StragglerDetector(on_straggler=OnStraggler, **detector_args)
+
+
+def AttachStragglers(run_config, detector):
+  """Records the flagged workers in the run config.
+
+  result_store.ResultStore.Commit keeps them in the 'extras' of the run.
+
+  """
+  run_config['stragglers'] = detector.Summary()
+  return run_config
+
+
+def ReplayLogs(detector, logs):
+  """Feeds recorded worker logs to a detector, e.g. to test thresholds.
+
+  The records of all logs are interleaved by step, the order in which a
+  synchronous run produces them.
+
+  Args:
+    detector: StragglerDetector to feed.
+    logs: list of (host, task_index, path) of worker logs, optionally
+      gzipped as written by log_sink.LogSink.
+
+  returns the detector.
+
+  """
+  records = []
+  for order, (host, task_index, path) in enumerate(logs):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+      for line in f:
+        record = throughput.ParseStepLine(
+            line.decode('utf-8', 'ignore'), host=host, task_index=task_index)
+        if record is not None:
+          records.append((record.step, order, record))
+  for _, _, record in sorted(records, key=lambda r: r[:2]):
+    detector.Add(record)
+  return detector
@@ -0,0 +1,61 @@
+"""Tests StragglerDetector on recorded worker logs.
+
+Run from benchmark/runner with:
+
+  python -m unittest discover -p '*_test.py'
+"""
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import cluster_local
+import straggler
+
+# Three workers at 320 images/sec; worker 2 drops to 160 after step 170.
+_TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'testdata', 'straggler')
+
+
+def _Logs():
+  return [('localhost', i, os.path.join(_TESTDATA, 'worker_{}.log'.format(i)))
+          for i in range(3)]
+
+
+class StragglerDetectorTest(unittest.TestCase):
+
+  def testFlagsWorkerSlowOnlyInTheLastIntervals(self):
+    detector = straggler.ReplayLogs(straggler.StragglerDetector(), _Logs())
+
+    self.assertEqual([('localhost', 2)], list(detector.stragglers))
+    # Flagged `patience` records after its interval rate fell below 85%.
+    self.assertEqual(230, detector.stragglers[('localhost', 2)])
+    self.assertAlmostEqual(0.5, detector.ratios[('localhost', 2)], delta=0.02)
+    self.assertAlmostEqual(1.0, detector.ratios[('localhost', 0)], delta=0.02)
+
+  def testReplaysGzippedLogs(self):
+    work_dir = tempfile.mkdtemp()
+    try:
+      logs = []
+      for host, task_index, path in _Logs():
+        gz_path = os.path.join(work_dir, os.path.basename(path) + '.gz')
+        with open(path, 'rb') as src, gzip.open(gz_path, 'wb') as dst:
+          shutil.copyfileobj(src, dst)
+        logs.append((host, task_index, gz_path))
+
+      detector = straggler.ReplayLogs(straggler.StragglerDetector(), logs)
+    finally:
+      shutil.rmtree(work_dir)
+
+    self.assertEqual([('localhost', 2)], list(detector.stragglers))
+
+  def testQuarantinesInstanceOfFlaggedWorker(self):
+    instances = [cluster_local.LocalInstance(index=i) for i in range(3)]
+    straggler.ReplayLogs(straggler.QuarantiningDetector(instances), _Logs())
+
+    self.assertEqual(instances[:2], straggler.HealthyInstances(instances))
+
+
+if __name__ == '__main__':
+  unittest.main()
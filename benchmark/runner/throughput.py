@@ -0,0 +1,320 @@
+"""Parses tf_cnn_benchmarks step lines into typed records and statistics."""
+import collections
+import math
+import re
+import time
+
+import numpy
+
+# Step lines look like:
+#   10	images/sec: 212.3 +/- 0.4 (jitter = 1.2)	7.654
+_STEP_LINE = re.compile(r'^\s*(\d+)\s+images/sec:\s*([\d.]+)\s*\+/-\s*([\d.]+)'
+                        r'\s*\(jitter\s*=\s*([\d.]+)\)\s*([-\w.+]+)?')
+_TOTAL_LINE = re.compile(r'total images/sec:\s*([\d.]+)')
+
+# Two sided 95% Student's t critical values for 1 to 30 degrees of freedom.
+_T_95 = [
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042
+]
+
+# stderr is the '+/-' of the step line, the standard error of the mean
+# images/sec tf_cnn_benchmarks computes over the steps so far.
+StepRecord = collections.namedtuple('StepRecord', [
+    'step', 'images_per_sec', 'stderr', 'jitter', 'loss', 'host',
+    'task_index', 'timestamp'
+])
+
+
+def ParseStepLine(line, host=None, task_index=None):
+  """Returns a StepRecord for a tf_cnn_benchmarks step line or None."""
+  match = _STEP_LINE.match(line)
+  if not match:
+    return None
+  loss = None
+  if match.group(5):
+    try:
+      loss = float(match.group(5))
+    except ValueError:
+      pass
+  return StepRecord(
+      step=int(match.group(1)),
+      images_per_sec=float(match.group(2)),
+      stderr=float(match.group(3)),
+      jitter=float(match.group(4)),
+      loss=loss,
+      host=host,
+      task_index=task_index,
+      timestamp=time.time())
+
+
+def IntervalRate(step, images_per_sec, prev_step=0, prev_images_per_sec=None):
+  """Returns the images/sec of the steps between two step lines.
+
+  The images/sec of a step line is the images of all steps so far over their
+  total time. With the same images in every step, steps m+1..n take
+  n / r_n - m / r_m times the time of one image, so their rate is
+  (n - m) / (n / r_n - m / r_m).
+
+  returns None if the interval is empty or the rounding of the logged rates
+  leaves it no time.
+
+  """
+  if step <= prev_step or images_per_sec <= 0:
+    return None
+  elapsed = float(step) / images_per_sec
+  if prev_step:
+    if not prev_images_per_sec:
+      return None
+    elapsed -= float(prev_step) / prev_images_per_sec
+  if elapsed <= 0:
+    return None
+  return (step - prev_step) / elapsed
+
+
+def ParseTotalLine(line):
+  """Returns the value of a 'total images/sec:' line or None."""
+  match = _TOTAL_LINE.search(line)
+  if match:
+    return float(match.group(1))
+  return None
+
+
+class _P2Quantile(object):
+  """Streaming quantile estimate in constant memory (Jain & Chlamtac P^2)."""
+
+  def __init__(self, p=0.5):
+    self.p = p
+    self.heights = []
+    self.positions = [0, 1, 2, 3, 4]
+    self.desired = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+    self.increments = [0, p / 2.0, p, (1 + p) / 2.0, 1]
+
+  def Add(self, x):
+    q = self.heights
+    if len(q) < 5:
+      q.append(x)
+      q.sort()
+      return
+
+    if x < q[0]:
+      q[0] = x
+      k = 0
+    elif x >= q[4]:
+      q[4] = x
+      k = 3
+    else:
+      k = 0
+      while x >= q[k + 1]:
+        k += 1
+    n = self.positions
+    for i in range(k + 1, 5):
+      n[i] += 1
+    for i in range(5):
+      self.desired[i] += self.increments[i]
+
+    for i in range(1, 4):
+      d = self.desired[i] - n[i]
+      if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+        d = 1 if d > 0 else -1
+        parabolic = q[i] + float(d) / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+        if q[i - 1] < parabolic < q[i + 1]:
+          q[i] = parabolic
+        else:
+          q[i] += float(d) * (q[i + d] - q[i]) / (n[i + d] - n[i])
+        n[i] += d
+
+  def Value(self):
+    q = self.heights
+    if not q:
+      return None
+    if len(q) < 5:
+      # Exact quantile of the few samples seen so far.
+      return float(numpy.percentile(q, self.p * 100))
+    return q[2]
+
+
+class RunningStats(object):
+  """Count, mean, stddev (Welford) and median (P^2) in constant memory."""
+
+  def __init__(self):
+    self.count = 0
+    self.mean = 0.0
+    self._m2 = 0.0
+    self._median = _P2Quantile(0.5)
+
+  def Add(self, x):
+    self.count += 1
+    delta = x - self.mean
+    self.mean += delta / self.count
+    self._m2 += delta * (x - self.mean)
+    self._median.Add(x)
+
+  @property
+  def stddev(self):
+    if self.count < 2:
+      return 0.0
+    return math.sqrt(self._m2 / (self.count - 1))
+
+  @property
+  def median(self):
+    return self._median.Value()
+
+  def RelativeCiWidth(self):
+    """Returns the 95% interval width of the mean over the mean.
+
+    returns None with fewer than 2 samples or a non-positive mean.
+
+    """
+    if self.count < 2 or self.mean <= 0:
+      return None
+    df = self.count - 1
+    t = _T_95[df - 1] if df <= len(_T_95) else 1.96
+    return 2 * t * self.stddev / math.sqrt(self.count) / self.mean
+
+
+class ThroughputParser(object):
+  """Line extractor that turns step lines of one task into StepRecords.
+
+  Pass an instance as the `line_extractor` of the util/AWSInstance execute
+  functions. Statistics are kept in constant memory while the run is in
+  progress; the records themselves are only kept when keep_records is True.
+
+  Args:
+    host: host the task runs on, copied into each record.
+    task_index: task index of the worker, copied into each record.
+    line_extractor: optional extractor each line is forwarded to, e.g.
+      util.ExtractImagePerSecond to keep printing step lines.
+    keep_records: True to keep every StepRecord in `records`.
+    skip_steps: records with step <= skip_steps are not added to the stats.
+
+  """
+
+  def __init__(self,
+               host=None,
+               task_index=None,
+               line_extractor=None,
+               keep_records=False,
+               skip_steps=0):
+    self.host = host
+    self.task_index = task_index
+    self.line_extractor = line_extractor
+    self.keep_records = keep_records
+    self.skip_steps = skip_steps
+    self.records = []
+    self.stats = RunningStats()
+    self.last_record = None
+    self.total_images_per_sec = None
+    self._listeners = []
+
+  def AddListener(self, listener):
+    """Registers listener(record) to be called for every parsed StepRecord."""
+    self._listeners.append(listener)
+
+  def __call__(self, line):
+    record = ParseStepLine(line, host=self.host, task_index=self.task_index)
+    if record is not None:
+      self.last_record = record
+      if record.step > self.skip_steps:
+        self.stats.Add(record.images_per_sec)
+      if self.keep_records:
+        self.records.append(record)
+      for listener in self._listeners:
+        listener(record)
+    else:
+      total = ParseTotalLine(line)
+      if total is not None:
+        self.total_images_per_sec = total
+    if self.line_extractor:
+      self.line_extractor(line)
+
+  def Summary(self):
+    last = self.last_record
+    return {
+        'host': self.host,
+        'task_index': self.task_index,
+        'steps': self.stats.count,
+        'last_step': last.step if last else None,
+        'final_loss': last.loss if last else None,
+        'images_per_sec_mean': self.stats.mean,
+        'images_per_sec_median': self.stats.median,
+        'images_per_sec_stddev': self.stats.stddev,
+        'total_images_per_sec': self.total_images_per_sec,
+    }
+
+
+def SummarizeRecords(records):
+  """Aggregates the StepRecords of a whole cluster with numpy.
+
+  Per task statistics are computed over columnar arrays in one pass. The
+  cluster throughput is the sum of the per worker mean images/sec, matching
+  how tf_cnn_benchmarks reports distributed runs.
+
+  Args:
+    records: iterable of StepRecord from any number of tasks.
+
+  returns dict with the cluster wide throughput and per task statistics.
+
+  """
+  records = list(records)
+  if not records:
+    return {'images_per_sec': 0.0, 'steps': 0, 'tasks': {}}
+  images_per_sec = numpy.array([r.images_per_sec for r in records],
+                               dtype=numpy.float64)
+  tasks = numpy.array(
+      [-1 if r.task_index is None else int(r.task_index) for r in records])
+  task_ids, task_of_record = numpy.unique(tasks, return_inverse=True)
+  counts = numpy.bincount(task_of_record)
+  sums = numpy.bincount(task_of_record, weights=images_per_sec)
+  means = sums / counts
+  squares = numpy.bincount(
+      task_of_record, weights=(images_per_sec - means[task_of_record])**2)
+  stddevs = numpy.sqrt(squares / numpy.maximum(counts - 1, 1))
+
+  per_task = {}
+  for i, task in enumerate(task_ids):
+    key = None if task == -1 else int(task)
+    per_task[key] = {
+        'steps': int(counts[i]),
+        'images_per_sec_mean': float(means[i]),
+        'images_per_sec_median':
+            float(numpy.median(images_per_sec[task_of_record == i])),
+        'images_per_sec_stddev': float(stddevs[i]),
+    }
+  return {
+      'images_per_sec': float(means.sum()),
+      'images_per_sec_stddev': float(numpy.sqrt((stddevs**2).sum())),
+      'steps': int(counts.sum()),
+      'tasks': per_task,
+  }
+
+
+def AttachResults(run_config, parsers):
+  """Stores the throughput summary of a finished run in its run_config.
+
+  Args:
+    run_config: one of the configs produced by command_builder.LoadYamlRunConfig.
+    parsers: ThroughputParser of every worker of the run.
+
+  returns the run_config with a 'results' entry added.
+
+  """
+  parsers = list(parsers)
+  records = []
+  for parser in parsers:
+    records.extend(r for r in parser.records if r.step > parser.skip_steps)
+  if records:
+    results = SummarizeRecords(records)
+  else:
+    # Records were not kept, fall back to the constant memory statistics.
+    results = {
+        'images_per_sec': sum(p.stats.mean for p in parsers),
+        'steps': sum(p.stats.count for p in parsers),
+        'tasks': {},
+    }
+  results['workers'] = [p.Summary() for p in parsers]
+  run_config['results'] = results
+  return run_config
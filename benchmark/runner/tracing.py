@@ -0,0 +1,185 @@
+"""Records orchestration phases and writes them as a Chrome trace.
+
+Spans are kept in memory as tuples, which costs about a microsecond each,
+so tracing is on by default. Load the file written by WriteChromeTrace in
+chrome://tracing or https://ui.perfetto.dev; every instance is a process and
+every ps/worker task a thread. Spans are keyed by instance_id rather than
+hostname, since local instances all run on localhost.
+
+Spans go to a default Recorder holding the latest DEFAULT_CAPACITY spans.
+Runs that share the runner process, e.g. the partitions of
+cluster_partition.RunPartitioned, each collect their own spans with a
+Recorder limited to their instances:
+
+  with tracing.Recorder(
+      instance_ids=[i.instance_id for i in instances]) as recorder:
+    ...
+  tracing.WriteChromeTrace(path, recorder=recorder)
+"""
+import collections
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+_TASK_INDEX = re.compile(r'--task_index=(\d+)')
+_JOB_NAME = re.compile(r'--job_name=(\w+)')
+
+# Spans kept by a Recorder, the oldest are dropped first.
+DEFAULT_CAPACITY = 100000
+
+_enabled = [True]
+_lock = threading.Lock()
+
+
+class Recorder(object):
+  """Collects the spans recorded while it is active, as a with statement.
+
+  Args:
+    instance_ids: ids of the instances whose spans are collected, None for
+      all. Spans without an instance come from the runner and are always
+      collected.
+    capacity: most spans kept.
+
+  """
+
+  def __init__(self, instance_ids=None, capacity=DEFAULT_CAPACITY):
+    self.instance_ids = (set(instance_ids) if instance_ids is not None else
+                         None)
+    self.events = collections.deque(maxlen=capacity)
+
+  def Collects(self, instance_id):
+    return (self.instance_ids is None or instance_id is None or
+            instance_id in self.instance_ids)
+
+  def __enter__(self):
+    global _recorders
+    with _lock:
+      _recorders = _recorders + (self,)
+    return self
+
+  def __exit__(self, *unused):
+    global _recorders
+    with _lock:
+      _recorders = tuple(r for r in _recorders if r is not self)
+
+
+_default = Recorder()
+# Replaced, never modified, so Record can iterate without the lock.
+_recorders = (_default,)
+
+
+def Enable():
+  _enabled[0] = True
+
+
+def Disable():
+  _enabled[0] = False
+
+
+def Record(name, start, end, instance_id=None, task_index=None, **args):
+  """Records a span that ran from start to end, both from time.time()."""
+  if _enabled[0]:
+    event = (name, start, end, instance_id, task_index, args)
+    # deque.append is atomic, so no lock is needed between threads.
+    for recorder in _recorders:
+      if recorder.Collects(instance_id):
+        recorder.events.append(event)
+
+
+@contextmanager
+def Span(name, instance_id=None, task_index=None, **args):
+  """Records the time spent in the with block."""
+  start = time.time()
+  try:
+    yield
+  finally:
+    Record(name, start, time.time(), instance_id, task_index, **args)
+
+
+def TaskFromCommand(command):
+  """Returns the (job_name, task_index) of a tf_cnn_benchmarks command."""
+  job = _JOB_NAME.search(command)
+  task = _TASK_INDEX.search(command)
+  return (job.group(1) if job else None, int(task.group(1)) if task else None)
+
+
+class CommandTrace(object):
+  """Line extractor wrapper that splits a run into startup and training.
+
+  Startup lasts from launching the command to its first images/sec line and
+  training from then until the command ends. Call Finish when it ended.
+
+  """
+
+  def __init__(self, instance_id, command, line_extractor=None):
+    self.instance_id = instance_id
+    self.job, self.task_index = TaskFromCommand(command)
+    self.line_extractor = line_extractor
+    self.start = time.time()
+    self.first_step = None
+
+  def __call__(self, line):
+    if self.first_step is None and 'images/sec:' in line:
+      self.first_step = time.time()
+    if self.line_extractor:
+      self.line_extractor(line)
+
+  def Finish(self):
+    end = time.time()
+    if self.first_step is None:
+      Record('command', self.start, end, self.instance_id, self.task_index,
+             job=self.job)
+      return
+    Record('startup', self.start, self.first_step, self.instance_id,
+           self.task_index, job=self.job)
+    Record('training', self.first_step, end, self.instance_id,
+           self.task_index, job=self.job)
+
+
+def WriteChromeTrace(path, clear=True, recorder=None):
+  """Writes the recorded spans as Chrome trace JSON to path.
+
+  Args:
+    path: file to write, e.g. trace.json next to the run logs.
+    clear: True to drop the written spans so the next run starts empty.
+    recorder: Recorder of the run, defaults to the one collecting all spans.
+      Runs sharing the runner process should pass their own, otherwise
+      clearing drops the spans of the others.
+
+  """
+  recorder = recorder or _default
+  events = list(recorder.events)
+  if clear:
+    for _ in events:
+      recorder.events.popleft()
+  origin = min(e[1] for e in events) if events else time.time()
+  pids = {}
+  tids = {}
+  trace = []
+  for name, start, end, instance_id, task_index, args in events:
+    instance_id = instance_id or 'runner'
+    if instance_id not in pids:
+      pids[instance_id] = len(pids)
+      trace.append({'name': 'process_name', 'ph': 'M',
+                    'pid': pids[instance_id], 'args': {'name': instance_id}})
+    # ps and worker tasks with the same index get their own rows.
+    task = (instance_id, args.get('job'), task_index)
+    if task not in tids:
+      tids[task] = len(tids)
+      label = ' '.join(str(t) for t in task[1:] if t is not None) or 'runner'
+      trace.append({'name': 'thread_name', 'ph': 'M',
+                    'pid': pids[instance_id], 'tid': tids[task],
+                    'args': {'name': label}})
+    trace.append({
+        'name': name,
+        'ph': 'X',
+        'pid': pids[instance_id],
+        'tid': tids[task],
+        'ts': int((start - origin) * 1e6),
+        'dur': int((end - start) * 1e6),
+        'args': args,
+    })
+  with open(path, 'w') as f:
+    json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
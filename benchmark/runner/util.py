@@ -1,5 +1,6 @@
 import exceptions
 import functools
+import log_sink
 import logging
 import os
 import paramiko
@@ -7,6 +8,7 @@ import numpy
 import sys
 import threading
 import time
+import tracing
 
 
 def ExtractErrorToConsole(line):
@@ -61,26 +63,46 @@ def ExecuteCommandAndReturnStdout(ssh_client, command):
   return stdout.read()
 
 
-def _StreamOutputToFile(fd, file, line_extractor, command=None):
+def _StreamOutputToFile(fd, file, line_extractor, command=None,
+                        compression=None):
   """Stream output to local file print select content to console
 
   Streams output to a local file and if a line_extractor is passed
   uses it to determine which data is printed to the local console.
+  Writes are batched by a log_sink.LogSink, optionally compressed. Without a
+  file the output is only passed to line_extractor.
+
+  fd may return unicode lines, as paramiko channel files do, or byte
+  strings, as local subprocess pipes do. Bytes are written as they are and
+  decoded for line_extractor. The stream is read to the end even after a
+  decoding error so the command never blocks on a full pipe.
 
   """
   def func(fd, file, line_extractor):
-    with open(file, 'a+') as f:
-      if command:
-        f.write(command + '\n')
-      try:
-        for line in iter(lambda: fd.readline(2048), ''):
-          f.write(line.encode('utf-8', errors='ignore'))
-          f.flush()
-          if line_extractor:
-            line_extractor(line)
-      except exceptions.UnicodeDecodeError as err:
-        print('UnicodeDecodeError parsing stdout/stderr, bug in paramiko:{}'
-              .format(err))
+    f = log_sink.LogSink(file, compression=compression) if file else None
+    try:
+      if f and command:
+        f.Write(command + '\n')
+      while True:
+        try:
+          line = fd.readline(2048)
+        except exceptions.UnicodeDecodeError as err:
+          print('UnicodeDecodeError parsing stdout/stderr, bug in paramiko:{}'
+                .format(err))
+          continue
+        if not line:
+          break
+        if isinstance(line, bytes):
+          if f:
+            f.Write(line)
+          line = line.decode('utf-8', 'ignore')
+        elif f:
+          f.Write(line.encode('utf-8', 'ignore'))
+        if line_extractor:
+          line_extractor(line)
+    finally:
+      if f:
+        f.Close()
   t = threading.Thread(target=func, args=(fd, file, line_extractor))
   t.start()
   return t
@@ -92,7 +114,8 @@ def ExecuteCommandAndStreamOutput(ssh_client,
                                   stderr_file=None,
                                   line_extractor=None,
                                   print_error=False,
-                                  ok_exit_status=[0]):
+                                  ok_exit_status=[0],
+                                  compression=None):
   """Executes command in ssh_client.  Blocking call.
 
 
@@ -102,17 +125,22 @@ def ExecuteCommandAndStreamOutput(ssh_client,
     stdout_file: local file to write standard output of the command to
     stderr_file: local file to write standard error of the command to
     line_extractor: method to call on each line to determine if the line
-    should be printed to the local console.
+    should be printed to the local console. Called for standard output even
+    without stdout_file.
     print_error: True to print output if there is an error
     ok_exit_status: List of status codes that are not errors, defaults to '0'
+    compression: None, 'gzip' or 'zstd' to compress the log files.
 
   """
   _, stdout, stderr = ssh_client.exec_command(command, get_pty=True)
-  if stdout_file:
-    t1 = _StreamOutputToFile(stdout, stdout_file, line_extractor, command=command)
+  stream_stdout = stdout_file or line_extractor
+  if stream_stdout:
+    t1 = _StreamOutputToFile(stdout, stdout_file, line_extractor,
+                             command=command, compression=compression)
   if stderr_file:
-    t2 = _StreamOutputToFile(stderr, stderr_file, line_extractor)
-  if stdout_file:
+    t2 = _StreamOutputToFile(stderr, stderr_file, line_extractor,
+                             compression=compression)
+  if stream_stdout:
     t1.join()
   if stderr_file:
     t2.join()
@@ -130,7 +158,8 @@ def ExecuteCommandInThread(ssh_client,
                            stdout_file=None,
                            stderr_file=None,
                            line_extractor=None,
-                           print_error=False):
+                           print_error=False,
+                           compression=None):
   """Returns a thread that executes the given command.  Non-Blocking call.
 
   
@@ -143,6 +172,7 @@ def ExecuteCommandInThread(ssh_client,
     line_extractor: method to call on each line to determine if the line
     should be printed to the local console.
     print_error: True to print output if there is an error, e.g. non-'0' exit code.
+    compression: None, 'gzip' or 'zstd' to compress the log files.
 
   returns a thread that executes the given command
 
@@ -150,16 +180,31 @@ def ExecuteCommandInThread(ssh_client,
   t = threading.Thread(
       target=ExecuteCommandAndStreamOutput,
       args=(ssh_client, command, stdout_file, stderr_file, line_extractor,
-            print_error))
+            print_error),
+      kwargs={'compression': compression})
   t.start()
   return t
 
 
+_rsa_keys = {}
+_rsa_keys_lock = threading.Lock()
+
+
+def LoadRsaKey(ssh_key):
+  """Returns the RSAKey in ssh_key, parsing each key file once per process."""
+  with _rsa_keys_lock:
+    if ssh_key not in _rsa_keys:
+      _rsa_keys[ssh_key] = paramiko.RSAKey.from_private_key_file(ssh_key)
+    return _rsa_keys[ssh_key]
+
+
 def SshToHost(hostname,
               retry=10,
               ssh_key=os.path.join(os.environ['HOME'], '.ssh/aws.pem'),
               password=None,
-              username='ubuntu'):
+              username='ubuntu',
+              keepalive=0,
+              instance_id=None):
 
   """Create ssh connection to host
 
@@ -170,6 +215,8 @@ def SshToHost(hostname,
     retry: number of time to retry.
     ssh_key: full path to the ssk hey to use to connect.
     username: username to connect with.
+    keepalive: seconds between transport keepalive packets, 0 to disable.
+    instance_id: instance the ssh_connect span is recorded for.
 
   returns SSH client connected to host.
 
@@ -179,11 +226,12 @@ def SshToHost(hostname,
   # paramiko.util.log_to_file("/tmp/paramiko.log")
   k = None
   if ssh_key: 
-    k = paramiko.RSAKey.from_private_key_file(ssh_key)
+    k = LoadRsaKey(ssh_key)
   
   ssh_client = paramiko.SSHClient()
   ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
+  start = time.time()
   counter = retry
   while counter > 0:
     try:
@@ -197,6 +245,12 @@ def SshToHost(hostname,
       print('Exception connecting to host via ssh (could be a timeout):'.format(e))
       if counter == 0:
         print('Got impatient with retrying ssh to host. Time to give up.')
+        tracing.Record('ssh_connect', start, time.time(), instance_id,
+                       host=hostname, attempts=retry, failed=True)
         return None
+  tracing.Record('ssh_connect', start, time.time(), instance_id,
+                 host=hostname, attempts=retry - counter + 1)
 
+  if keepalive:
+    ssh_client.get_transport().set_keepalive(keepalive)
   return ssh_client